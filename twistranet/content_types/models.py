@@ -7,6 +7,7 @@ from twistranet.twistapp.lib import permissions
 from twistranet.twistapp.lib.utils import formatbytes
 from twistranet.twistapp.models.content import Content
 from twistranet.twistapp.models import fields
+from twistranet.twistapp.signals import content_created
 
 class StatusUpdate(Content):
     """
@@ -63,7 +64,8 @@ class Comment(StatusUpdate):
                 if not l.id in listener_ids and not l.id in additional_listeners:
                     additional_listeners.append(l)
         if additional_listeners:
-            content_created.send(
+            self._send_signal(
+                content_created,
                 sender = self.__class__, 
                 instance = self, 
                 target = additional_listeners,
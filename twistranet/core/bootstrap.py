@@ -21,6 +21,7 @@ import twistranet
 from twistranet.twistapp.models import *
 from twistranet.twistapp.lib import permissions
 from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.lib.account_context import as_account
 from twistranet.twistapp.lib.log import *
 
 from django.conf import settings
@@ -36,14 +37,21 @@ def repair():
     Will not erase data it doesn't know how to handle.
     """
     # Login
-    __account__ = SystemAccount.objects.get()
-    
-    # Put all Django admin users inside the first admin community
-    django_admins = UserAccount.objects.filter(user__is_superuser = True)
-    admin_community = AdminCommunity.objects.get()
-    for user in django_admins:
-        if not admin_community in user.communities:
-            admin_community.join(user, is_manager = True)
+    with as_account(SystemAccount.objects.get()):
+        # Put all Django admin users inside the first admin community
+        django_admins = UserAccount.objects.filter(user__is_superuser = True)
+        admin_community = AdminCommunity.objects.get()
+        for user in django_admins:
+            if not admin_community in user.communities:
+                admin_community.join(user, is_manager = True)
+
+        # Notification parameters used to be pickled, store them as JSON
+        from twistranet.notifier.models import Notification
+        legacy = Notification.objects.__booster__.exclude(_encoded_parameters__startswith = "{").exclude(_encoded_parameters = "")
+        for id, encoded in legacy.values_list("id", "_encoded_parameters"):
+            n = Notification(_encoded_parameters = encoded)
+            n.parameters = n.parameters
+            Notification.objects.__booster__.filter(id = id).update(_encoded_parameters = n._encoded_parameters)
 
 
 def bootstrap():
@@ -55,7 +63,7 @@ def bootstrap():
     """
     try:
         # Let's log in.
-        __account__ = SystemAccount.objects.__booster__.get()
+        system = SystemAccount.objects.__booster__.get()
     except SystemAccount.DoesNotExist:
         log.info("No SystemAccount available. That means this instance has never been bootstraped, so let's do it now.")
         raise RuntimeError("Please sync your databases with 'manage.py syncdb' before bootstraping.")
@@ -64,7 +72,13 @@ def bootstrap():
         log.info("DatabaseError while bootstraping. Your tables are probably not created yet.")
         traceback.print_exc()
         return
+    with as_account(system):
+        _bootstrap(system)
 
+def _bootstrap(system):
+    """
+    Actually load initial data, logged in as the given SystemAccount.
+    """
     # Now create the bootstrap / default / help fixture objects.
     # Import your fixture there, if you don't do so they may not be importable.
     from twistranet.fixtures.bootstrap import FIXTURES as BOOTSTRAP_FIXTURES
@@ -119,8 +133,8 @@ def bootstrap():
         break   # XXX We don't handle subdirs yet.
     
     # Set SystemAccount picture (which is a way to check if things are working properly).
-    __account__.picture = Resource.objects.get(slug = "default_tn_picture")
-    __account__.save()
+    system.picture = Resource.objects.get(slug = "default_tn_picture")
+    system.save()
 
     # Install HELP fixture.
     for obj in HELP_EN_FIXTURES:            obj.apply()
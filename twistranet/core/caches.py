@@ -1,10 +1,55 @@
 """
 Various caching help functions and classes.
 """
+import array
+import bisect
+from django.conf import settings
 from django.core.cache import cache
 
 DEFAULT_CACHE_DELAY = 60 * 60           # Default cache delay is 1hour. It's quite long.
 USERACCOUNT_CACHE_DELAY = 60 * 3        # 3 minutes here. This is used to know if a user is online or not.
+ACCOUNT_CACHE_DELAY = 60 * 5            # Security data: keep it short, in case an invalidation gets lost.
+
+# Cache backends which all the processes of a site share
+SHARED_CACHE_BACKENDS = ("memcached", "db", )
+
+# Hit / miss counters, per cached attribute. They're per-process.
+_stats = {}
+
+def _count(attr, hit):
+    counters = _stats.setdefault(attr, [0, 0])
+    counters[hit and 0 or 1] += 1
+
+def get_stats():
+    """
+    Return a {attr: {"hits": n, "misses": n}} dict for this process.
+    """
+    return dict([
+        (attr, {"hits": counters[0], "misses": counters[1]})
+        for attr, counters in _stats.items()
+    ])
+
+def reset_stats():
+    _stats.clear()
+
+def is_shared():
+    """
+    True if the cache backend is shared by all processes, so that an invalidation done by one of them
+    is seen by the others. Set TWISTRANET_SHARED_CACHE to force it (eg. for a third-party backend).
+    """
+    shared = getattr(settings, "TWISTRANET_SHARED_CACHE", None)
+    if shared is None:
+        shared = cache.__class__.__module__.split(".")[-1] in SHARED_CACHE_BACKENDS
+    return shared
+
+class IdArray(array.array):
+    """
+    A compact, sorted array of ids. It pickles small and 'in' is a binary search.
+    Build it with IdArray('l', sorted(ids)).
+    """
+    def __contains__(self, value):
+        i = bisect.bisect_left(self, value)
+        return i < len(self) and self[i] == value
 
 class _AbstractCache(object):
     """
@@ -29,6 +74,9 @@ class _AbstractCache(object):
         
     def _set(self, attr, value):
         cache.set("%s#%s" % (self.key_prefix, attr), value, self.delay)
+        
+    def _delete(self, *attrs):
+        cache.delete_many([ "%s#%s" % (self.key_prefix, attr) for attr in attrs ])
 
 class UserAccountCache(_AbstractCache):
     
@@ -48,6 +96,68 @@ class UserAccountCache(_AbstractCache):
     def get_online(self):       return self._get("online", False)
     def set_online(self, v):    return self._set("online", v)
     online = property(get_online, set_online)
-        
 
 
+class AccountCache(_AbstractCache):
+    """
+    Security-related information about an account, shared across requests.
+    Everything here is derived from the Network table and is invalidated
+    when a relation involving the account changes (see network.py).
+    
+    Invalidations must reach every process, so values are only shared across requests
+    if the cache backend is (see is_shared()). Otherwise, they're only memoized for the current request.
+    """
+    delay = ACCOUNT_CACHE_DELAY
+    ids_attrs = ("network_ids", "community_ids", "member_ids", )
+    flag_attrs = ("is_admin", )
+    
+    def __init__(self, account_or_id):
+        from twistranet.twistapp import Twistable
+        if isinstance(account_or_id, Twistable):
+            account_or_id = account_or_id.id
+        super(AccountCache, self).__init__("AC%d" % account_or_id)
+
+    def _get_request_cache(self):
+        from twistranet.twistapp.lib import account_context
+        return account_context.get_request_cache("accounts")
+
+    def _cached(self, attr, compute):
+        """
+        Return the cached value of attr, or store the result of compute().
+        """
+        if is_shared():
+            v = self._get(attr)
+            _count(attr, v is not None)
+            if v is None:
+                v = compute()
+                self._set(attr, v)
+            return v
+        memo = self._get_request_cache()
+        if memo is None:
+            return compute()
+        key = "%s#%s" % (self.key_prefix, attr)
+        v = memo.get(key)
+        _count(attr, v is not None)
+        if v is None:
+            v = memo[key] = compute()
+        return v
+
+    def get_ids(self, attr, compute):
+        """
+        Return the cached IdArray for attr, or store the result of compute() (an iterable of ids).
+        """
+        return self._cached(attr, lambda: IdArray('l', sorted(compute())))
+        
+    def get_flag(self, attr, compute):
+        """
+        Same as get_ids() for a boolean value.
+        """
+        return self._cached(attr, lambda: bool(compute()))
+        
+    def invalidate(self):
+        attrs = self.ids_attrs + self.flag_attrs
+        self._delete(*attrs)
+        memo = self._get_request_cache()
+        if memo:
+            for attr in attrs:
+                memo.pop("%s#%s" % (self.key_prefix, attr), None)
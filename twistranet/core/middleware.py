@@ -3,9 +3,13 @@ Middlewares for twistranet
 """
 from django.conf import settings
 from django.core import signals
+from django.core.exceptions import MiddlewareNotUsed
 from django.core.urlresolvers import get_script_prefix
 from twistranet.twistapp.lib.log import *
 
+DEFAULT_TWISTRANET_PROFILING = False
+PROFILE_HEADER = "X-Twistranet-Profile"
+
 def set_runtime_paths(sender,**kwds):
     """Dynamically adjust path settings based on runtime configuration.
 
@@ -53,3 +57,54 @@ class RuntimePathsMiddleware:
 
 
 
+
+class AccountContextMiddleware(object):
+    """
+    Bind the current request to the account context, so that the security model
+    can find the authenticated account without digging the stack.
+    
+    Must be placed after django's AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        from twistranet.twistapp.lib import account_context
+        account_context.clear()
+        account_context.set_current_request(request)
+
+    def process_response(self, request, response):
+        from twistranet.twistapp.lib import account_context
+        account_context.clear()
+        return response
+
+
+class ProfilingMiddleware(object):
+    """
+    Count SQL queries, rows and time per call site for each request.
+    See twistranet.twistapp.lib.profiling for the hook API.
+    
+    Enabled with the TWISTRANET_PROFILING setting. In DEBUG mode, a summary
+    is added to the response in the X-Twistranet-Profile header.
+    Should be placed first, so that other middlewares are profiled as well.
+    """
+    def __init__(self):
+        if not getattr(settings, "TWISTRANET_PROFILING", DEFAULT_TWISTRANET_PROFILING):
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        from twistranet.twistapp.lib import profiling
+        profiling.start(request.path)
+        
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        from twistranet.twistapp.lib import profiling
+        profile = profiling.get_current_profile()
+        if profile is not None:
+            profile.view = getattr(view_func, "__name__", None)
+
+    def process_response(self, request, response):
+        from twistranet.twistapp.lib import profiling
+        profile = profiling.stop()
+        if profile is None:
+            return response
+        if settings.DEBUG:
+            response[PROFILE_HEADER] = profile.as_header()
+        profiling.run_hooks(request, response, profile)
+        return response
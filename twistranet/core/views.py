@@ -20,7 +20,8 @@ from django.shortcuts import get_object_or_404
 from twistranet.twistapp.models import *
 from twistranet.twistapp.forms import form_registry
 from twistranet.twistapp.lib.log import *
-from twistranet.twistapp.lib import utils
+from twistranet.twistapp.lib import utils, cursor, permissions
+from twistranet.twistapp.lib.profiling import profiled, section
 from twistranet.core import caches
 from twistranet.content_types.forms import CommentForm
 
@@ -66,8 +67,10 @@ class AsPublicView(object):
             # Instanciate the actual view class with global view arguments
             # and call its view() method with request-specific arguments
             instance_view = self.view_instance_class(request, *self.args, **self.kw)
-            instance_view.prepare_view(*args, **kw)
-            return instance_view.render_view()
+            with section("%s.prepare_view" % self.__name__):
+                instance_view.prepare_view(*args, **kw)
+            with section("%s.render_view" % self.__name__):
+                return instance_view.render_view()
             
         except MustRedirect:
             # Here we redirect if necessary
@@ -113,12 +116,10 @@ class BaseView(object):
     # category = GLOBAL_ACTIONS   # Override this if you want to give another default category to this view.
 
     page = 1
-    nextpage = 2
     # The view attribute which will be passed to the templates
     template_variables = [
         ("title", "get_title"),
         "page",
-        "nextpage",
         "path",
         "context_boxes",
         "global_boxes",
@@ -152,7 +153,6 @@ class BaseView(object):
             self.auth = Twistable.objects.getCurrentAccount(request)
             self.current_url = self.get_current_url()
             self.page = int(request.GET.get('page',1))
-            self.nextpage = self.page + 1
             if not self.auth.is_anonymous:
                 self.useraccount_cache = caches.UserAccountCache(self.auth)
                 self.useraccount_cache.online = True            # Set as online
@@ -218,6 +218,7 @@ class BaseView(object):
     #                                       Actions Management                                      #
     #                                                                                               #
             
+    @profiled("get_actions")
     def get_actions(self,):
         """
         Transform the available_actions list into an actions{} dict.
@@ -273,7 +274,8 @@ class BaseView(object):
             raise NotImplementedError("You must override the title property or get_title() method in %s. Don't forget to _() your get_title() result!" % self.__class__)
         return _(self.title)
              
-    @property           
+    @property
+    @profiled("breadcrumb")
     def breadcrumb(self,):
         """
         Return a list of (translated title, url) tuples. The first one should be the root.
@@ -354,18 +356,8 @@ class BaseView(object):
             return self.render_ajax_view(params)
         t = get_template(self.template)
         c = RequestContext(self.request, params)
-        return self.response_handler_method(t.render(c))
-
-    def batch_list(self, nb_all):
-        """
-        very simple batch for pages which need it
-        (XXX : improve it)
-        return tuple (start, end)
-        """
-        page_size = settings.TWISTRANET_CONTENT_PER_PAGE
-        nb_from = page_size*(self.page - 1)
-        nb_to = page_size*(self.page)
-        return nb_from, nb_to
+        with section("render_template"):
+            return self.response_handler_method(t.render(c))
 
     def render_ajax_view(self, params):
         if self.ajax_template:
@@ -547,13 +539,16 @@ class BaseObjectActionView(BaseIndividualView):
         
 class BaseWallView(BaseIndividualView):
     """
-    A wall has a latest_content_list parameter
+    A wall has a latest_content_list parameter.
+    It's paginated with an opaque 'cursor' GET parameter, see twistapp/lib/cursor.py.
     """
     template_variables = BaseIndividualView.template_variables + [
         "content_forms",
         "latest_content_list",
-        "nextpage"
+        "next_cursor",
     ]
+    cursor = None
+    next_cursor = None
 
     select_related_summary_fields = (
         "owner",
@@ -631,22 +626,40 @@ class BaseWallView(BaseIndividualView):
 
     def get_recent_content_list(self,):
         """
-        render the batched list
-        must be overloaded
+        Return the current page of objects_list, starting after self.cursor.
+        Set self.next_cursor to the token of the next page (or None).
         """
-        pass
+        ids, self.next_cursor = cursor.keyset_page(
+            self.objects_list,
+            self.cursor,
+            settings.TWISTRANET_CONTENT_PER_PAGE,
+        )
+        if not ids:
+            return []
+        content_list = Content.objects.__booster__.filter(id__in = ids).order_by("-created_at", "-id").as_concrete(
+            *self.select_related_summary_fields
+        )
+        
+        # Pre-compute the permissions the summary template checks for each content
+        self.auth.has_permissions_bulk(content_list, (permissions.can_edit, permissions.can_delete, ))
+        
+        # Let content types prepare their summaries in bulk (eg. notification messages)
+        for model in set([ content.__class__ for content in content_list ]):
+            prepare_summaries = getattr(model, "prepare_summaries", None)
+            if prepare_summaries:
+                prepare_summaries([ content for content in content_list if content.__class__ is model ])
+        return content_list
     
     def prepare_view(self, value = None):
         """
         Fetch the individual object, plus its latest content.
         """
+        self.cursor = self.request.GET.get("cursor", None)
         super(BaseWallView, self).prepare_view(value)
         # if self.object:
-        self.objects_list = total_list = self.get_objects_list()
+        self.objects_list = self.get_objects_list()
         self.latest_content_list = self.get_recent_content_list()
         self.content_forms = self.get_inline_forms(self.object)
-        if len(total_list)< settings.TWISTRANET_CONTENT_PER_PAGE:
-            self.nextpage= 0
 
     def render_last_post(self, params):
         "could be improved in each subclass for better performance"
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 """
 Some sample data in there.
+
+Nothing happens on import: call load() to generate the data, for example from './manage.py shell'.
+The benchmark command (twistranet_benchmark) uses it to seed its dataset.
 """
 from twistranet import *
-from twistranet.twistapp.lib.python_fixture import Fixture
+from twistranet.twistapp.lib.python_fixture import Fixture, BulkLoader, get_by_slugs
+from twistranet.twistapp.lib.account_context import set_current_account
 from django.contrib.auth.models import User
+from django.db import transaction
 import random
 
 
@@ -57,120 +62,127 @@ LAST_NAMES = [
 
 USERACCOUNT_PERMISSIONS = UserAccount.permission_templates.perm_dict.keys()
 PICTURES = ['default_admin_picture', 'default_a_picture', 'default_b_picture']
+PASSWORD = "azerty"
 
-FIXTURES = []
-USERNAMES = []
-COMMUNITIES = []
+def load(n_users = N_USERS, n_communities = N_COMMUNITIES, n_documents = N_DOCUMENTS, n_status_updates = N_STATUS_UPDATES):
+    """
+    Generate users (with PASSWORD as password), communities, documents and status updates.
+    Return a dict with the "usernames" and "communities" slugs that have been created.
+    """
+    FIXTURES = []
+    USERNAMES = []
+    COMMUNITIES = []
 
-# Create users and add Admin as a friend
-while True:
-    rnd = random.randrange(0, 9999)
-    if User.objects.filter(username = "user%i" % rnd).exists():
-        continue
-    if User.objects.filter(username = "user%i" % (rnd + N_USERS,)).exists():
-        continue
-    break
-print "User range is %i to %i" % (rnd, rnd + N_USERS)
+    # Create users and add Admin as a friend
+    while True:
+        rnd = random.randrange(0, 9999)
+        if User.objects.filter(username = "user%i" % rnd).exists():
+            continue
+        if User.objects.filter(username = "user%i" % (rnd + n_users,)).exists():
+            continue
+        break
+    print "User range is %i to %i" % (rnd, rnd + n_users)
 
-for i in range(rnd, rnd + N_USERS):
-    # Basic user information
-    fn = random.choice(FIRST_NAMES)
-    ln = random.choice(LAST_NAMES)
-    pw = "azerty"
-    username = "user%i" % i
-    permission = random.choice(USERACCOUNT_PERMISSIONS)
-    USERNAMES.append(username)
-    
-    # Create the actual user
-    u = User.objects.create(
-        username = username,
-        password = pw,
-        email = "%s@localhost" % (username,),
-    )
-    
-    # Add the UserAccount fixture in the stack
-    FIXTURES.append(
-        Fixture(
-            UserAccount,
-            slug = username,
-            title = "%s %s" % (fn, ln),
-            description = "Sample user account %i for %s %s with %s permissions" % (i, fn, ln, permission),
-            permissions = permission,
-            user = User.objects.get(id = u.id),
-            picture = Resource.objects.filter(slug = random.choice(PICTURES))
+    for i in range(rnd, rnd + n_users):
+        # Basic user information
+        fn = random.choice(FIRST_NAMES)
+        ln = random.choice(LAST_NAMES)
+        username = "user%i" % i
+        permission = random.choice(USERACCOUNT_PERMISSIONS)
+        USERNAMES.append(username)
+        
+        # Create the actual user
+        u = User.objects.create_user(username, "%s@localhost" % (username,), PASSWORD)
+        
+        # Add the UserAccount fixture in the stack
+        FIXTURES.append(
+            Fixture(
+                UserAccount,
+                slug = username,
+                title = "%s %s" % (fn, ln),
+                description = "Sample user account %i for %s %s with %s permissions" % (i, fn, ln, permission),
+                permissions = permission,
+                user = u,
+                picture = Resource.objects.filter(slug = random.choice(PICTURES))
+            )
         )
-    )
-    
-# Create N_COMMUNITIES communities and add a status update on each of them
-print "Now creating %d communities" % N_COMMUNITIES
-for i in range(N_COMMUNITIES):
-    community_slug = "Community%s" % random.getrandbits(64)
-    COMMUNITIES.append(community_slug)
-    creator = random.choice(USERNAMES)
-    FIXTURES.append(
-        Fixture(
-            Community,
-            logged_account = creator,
-            slug = community_slug,
-            description = "Bulk community creation",
-            permissions = random.choice(Community.permission_templates.perm_dict.keys()),
+        
+    # Create n_communities communities and add a status update on each of them
+    print "Now creating %d communities" % n_communities
+    for i in range(n_communities):
+        community_slug = "Community%s" % random.getrandbits(64)
+        COMMUNITIES.append(community_slug)
+        creator = random.choice(USERNAMES)
+        FIXTURES.append(
+            Fixture(
+                Community,
+                logged_account = creator,
+                slug = community_slug,
+                description = "Bulk community creation",
+                permissions = random.choice(Community.permission_templates.perm_dict.keys()),
+            )
         )
-    )
-    FIXTURES.append(
-        Fixture(
-            StatusUpdate,
-            logged_account = creator,
-            slug = "SU%s" % community_slug,
-            text = random.choice(STATUS_UPDATES),
-            permissions = random.choice(StatusUpdate.permission_templates.perm_dict.keys()),
-        ),
-    )
-    for i in range(N_DOCUMENTS / N_COMMUNITIES):
         FIXTURES.append(
             Fixture(
-                Document,
+                StatusUpdate,
                 logged_account = creator,
-                slug = "DOC%s-%s" % (community_slug, i),
-                # publisher = random.choice([Account.objects.filter(slug = creator)]),
-                title = random.choice(STATUS_UPDATES)[:50],
-                description = random.choice(STATUS_UPDATES),
-                text = random.choice(DOCUMENTS),
-                permissions = random.choice(Document.permission_templates.perm_dict.keys()),
+                slug = "SU%s" % community_slug,
+                text = random.choice(STATUS_UPDATES),
+                permissions = random.choice(StatusUpdate.permission_templates.perm_dict.keys()),
             ),
         )
+        for i in range(n_documents / max(n_communities, 1)):
+            FIXTURES.append(
+                Fixture(
+                    Document,
+                    logged_account = creator,
+                    slug = "DOC%s-%s" % (community_slug, i),
+                    # publisher = random.choice([Account.objects.filter(slug = creator)]),
+                    title = random.choice(STATUS_UPDATES)[:50],
+                    description = random.choice(STATUS_UPDATES),
+                    text = random.choice(DOCUMENTS),
+                    permissions = random.choice(Document.permission_templates.perm_dict.keys()),
+                ),
+            )
 
-# Create a bunch of status updates on each person's wall.
-print "Generating %d status updates" % N_STATUS_UPDATES
-for i in range(N_STATUS_UPDATES):
-    slug = "status%s" % (random.getrandbits(64),)
-    FIXTURES.append(
-        Fixture(
-            StatusUpdate,
-            logged_account = random.choice(USERNAMES),
-            slug = slug,
-            text = random.choice(STATUS_UPDATES),
-            permissions = random.choice(StatusUpdate.permission_templates.perm_dict.keys()),
+    # Create a bunch of status updates on each person's wall.
+    print "Generating %d status updates" % n_status_updates
+    for i in range(n_status_updates):
+        slug = "status%s" % (random.getrandbits(64),)
+        FIXTURES.append(
+            Fixture(
+                StatusUpdate,
+                logged_account = random.choice(USERNAMES),
+                slug = slug,
+                text = random.choice(STATUS_UPDATES),
+                permissions = random.choice(StatusUpdate.permission_templates.perm_dict.keys()),
+            )
         )
-    )
-
-# Apply fixtures.
-__account__ = SystemAccount.objects.get()
-for obj in FIXTURES:    obj.apply()
 
-# Let users join communities. Each community can have 1-N_USERS/10 members
-print "importing back communities"
-for c in COMMUNITIES:
-    community = Community.objects.get(slug = c)
-    for n in range(random.randrange(0, N_USERS / 10)):
-        u = UserAccount.objects.get(slug = random.choice(USERNAMES))
-        # print "User %s joins %s" % (u, community)
-        community.join(u)
+    # Apply fixtures.
+    set_current_account(SystemAccount.objects.get())
+    stats = BulkLoader(FIXTURES).load()
+    print "Loaded %(created)d objects in %(seconds).1fs (%(rows_per_second).1f rows/s)" % stats
 
-# Admin should be friend with everybody
-print "Make admin friend with everybody"
-admin = UserAccount.objects.get(slug = "admin")
-for u in USERNAMES:
-    user = UserAccount.objects.get(slug = u)
-    user.follow(admin)
-    admin.follow(user)
+    # Let users join communities. Each community can have 1-n_users/10 members
+    print "importing back communities"
+    USERS = get_by_slugs(UserAccount, USERNAMES)
+    for community in get_by_slugs(Community, COMMUNITIES).values():
+        with transaction.commit_on_success():
+            for n in range(random.randrange(0, max(n_users / 10, 1))):
+                u = USERS[random.choice(USERNAMES)]
+                # print "User %s joins %s" % (u, community)
+                community.join(u)
 
+    # Admin should be friend with everybody
+    print "Make admin friend with everybody"
+    admin = UserAccount.objects.get(slug = "admin")
+    with transaction.commit_on_success():
+        for user in USERS.values():
+            user.follow(admin)
+            admin.follow(user)
+            
+    return {
+        "usernames": USERNAMES,
+        "communities": COMMUNITIES,
+    }
@@ -3,8 +3,6 @@ from twistranet.twistapp.models import *
 from twistranet.content_types.models import *
 from twistranet.twistapp.lib.python_fixture import Fixture
 
-__account__ = SystemAccount.get()
-
 FIXTURES = [
     Fixture(
         Document,
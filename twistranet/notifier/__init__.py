@@ -39,6 +39,7 @@ content_created.connect(
         recipient_arg = "target",
         text_template = "email/created_content.txt",
         html_template = "email/created_content.html",
+        digest = True,
     ),
     weak = False,
 )
@@ -51,6 +52,8 @@ join_community.connect(
         owner_arg = "client",
         publisher_arg = "community",
         message = _(u"""%(client)s joined %(community)s."""),
+        name = "join_community",
+        digest = True,
     ),
     weak = False,
 )
@@ -61,6 +64,7 @@ invite_community.connect(
         publisher_arg = "target",
         permissions = "private",
         message = _(u"""You are invited in %(community)s community"""),
+        name = "invite_community",
     ),
     weak = False,
 )
@@ -74,6 +78,8 @@ request_add_to_network.connect(
         publisher_arg = "target",
         message = _(u"""%(client)s wants to add you to his/her network."""),
         permissions = "private",
+        name = "request_add_to_network",
+        digest = True,
     ),
     weak = False,
 )
@@ -83,6 +89,7 @@ request_add_to_network.connect(
         recipient_arg = "target",
         text_template = "email/request_add_to_network.txt",
         html_template = "email/request_add_to_network.html",
+        digest = True,
     ),
     weak = False,
 )
@@ -92,6 +99,7 @@ accept_in_network.connect(
         owner_arg = "client",
         publisher_arg = "target",
         message = _(u"""%(client)s is now connected to %(target)s."""),
+        name = "accept_in_network",
     ),
     weak = False,
 )
@@ -0,0 +1,156 @@
+"""
+Notification digests.
+
+Users choose how often they get notified (UserAccount.notification_window, see
+NOTIFICATION_WINDOWS in twistapp.models.account): immediately, or in an hourly or daily digest.
+Communities (and other non-user accounts) all use the TWISTRANET_COMMUNITY_DIGEST_WINDOW setting.
+
+Handlers created with digest = True don't notify accounts having a digest window:
+they buffer a DigestEvent instead. flush() then collapses the events of each account
+whose window is over:
+- mail events into a single digest email ;
+- notification events into a single Notification per handler, listing all the
+  accounts or contents involved (eg. "A, B and 3 others joined C.").
+An account's window is over when its oldest buffered event is older than the window.
+
+flush() is called every minute by the notifier worker (./manage.py twistranet_notifier --loop),
+or each time ./manage.py twistranet_notifier runs (eg. from cron). As nothing else sends digests, they're
+only offered once TWISTRANET_NOTIFIER_DIGESTS is set: until then, everybody is notified immediately,
+whatever their notification_window.
+"""
+import datetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, Max
+
+from twistranet.twistapp.lib.log import log
+
+IMMEDIATE = "immediate"
+# Length of the digest windows, in seconds
+WINDOW_DURATIONS = {
+    "hourly": 60 * 60,
+    "daily": 60 * 60 * 24,
+}
+
+DEFAULT_TWISTRANET_COMMUNITY_DIGEST_WINDOW = IMMEDIATE
+DEFAULT_TWISTRANET_NOTIFIER_DIGESTS = False
+
+DIGEST_TEXT_TEMPLATE = "email/digest.txt"
+DIGEST_HTML_TEMPLATE = "email/digest.html"
+
+def is_enabled():
+    """
+    True if digests are sent, ie. the notifier worker is running.
+    """
+    return getattr(settings, "TWISTRANET_NOTIFIER_DIGESTS", DEFAULT_TWISTRANET_NOTIFIER_DIGESTS)
+
+def get_windows(account_ids):
+    """
+    Return an {account_id: window} dict.
+    """
+    from twistranet.twistapp.models import UserAccount
+    if not is_enabled():
+        return dict([ (id, IMMEDIATE) for id in account_ids ])
+    default = getattr(settings, "TWISTRANET_COMMUNITY_DIGEST_WINDOW", DEFAULT_TWISTRANET_COMMUNITY_DIGEST_WINDOW)
+    ret = dict([ (id, default) for id in account_ids ])
+    if account_ids:
+        ret.update(dict(UserAccount.objects.__booster__.filter(id__in = account_ids).values_list("id", "notification_window")))
+    return ret
+
+def buffer(handler, account_id, window, parameters):
+    """
+    Keep an event for the next digest of account_id. parameters are encoded with queue.encode_parameters().
+    """
+    from twistranet.notifier.models import DigestEvent
+    return DigestEvent.objects.create(
+        account_id = account_id,
+        window = window,
+        handler = handler.key,
+        parameters = parameters,
+    )
+
+def flush(now = None):
+    """
+    Send the digests of all accounts whose window is over. Return the number of events we've digested.
+    """
+    from twistranet.notifier.models import DigestEvent
+    now = now or datetime.datetime.now()
+    digested = 0
+    pending = DigestEvent.objects.order_by().values("account", "window").annotate(oldest = Min("created_at"), last_id = Max("id"))
+    for row in pending:
+        if row["oldest"] > now - datetime.timedelta(seconds = WINDOW_DURATIONS.get(row["window"], 0)):
+            continue
+        try:
+            with transaction.commit_on_success():
+                digested += flush_account(row["account"], row["window"], row["last_id"])
+        except:
+            log.exception("Unable to send the %s digest of account %s, will try again later." % (row["window"], row["account"], ))
+    return digested
+
+def flush_account(account_id, window, last_id):
+    """
+    Digest the events of an account, up to last_id. Return the number of events.
+    """
+    from twistranet.notifier.models import DigestEvent
+    from twistranet.twistapp.models import Twistable
+    from twistranet.notifier import queue, handlers
+    events = list(DigestEvent.objects.filter(account = account_id, window = window, id__lte = last_id))
+    mails = []
+    notifications = {}
+    for event in events:
+        handler = queue.get_handler(event.handler)
+        if handler is None:
+            log.warning("Dropping digest event %s: unknown handler '%s'" % (event.id, event.handler, ))
+            continue
+        try:
+            kwargs = queue.decode_parameters(event.parameters)
+        except Twistable.DoesNotExist:
+            continue            # Something has been deleted in the meantime, forget about it
+        if isinstance(handler, handlers.MailHandler):
+            mails.append((handler, kwargs, ))
+        else:
+            notifications.setdefault(handler.key, (handler, []))[1].append(kwargs)
+
+    # Notifications first, so that they're rolled back if the mail can't be sent
+    for handler, kwargs_list in notifications.values():
+        handler.handle_digest(kwargs_list)
+    if mails:
+        send_digest_mail(account_id, window, mails)
+    DigestEvent.objects.filter(id__in = [ event.id for event in events ]).delete()
+    return len(events)
+
+_digest_mail_handler = None
+
+def get_digest_mail_handler():
+    global _digest_mail_handler
+    from twistranet.notifier.handlers import MailHandler
+    if _digest_mail_handler is None:
+        _digest_mail_handler = MailHandler(
+            recipient_arg = "target",
+            text_template = DIGEST_TEXT_TEMPLATE,
+            html_template = DIGEST_HTML_TEMPLATE,
+        )
+    return _digest_mail_handler
+
+def send_digest_mail(account_id, window, mails):
+    """
+    Render each (handler, kwargs) mail summary and send them all in a single email.
+    """
+    from twistranet.twistapp.models import UserAccount
+    if not settings.EMAIL_HOST:
+        return
+    account = UserAccount.objects.__booster__.get(id = account_id)
+    if not account.email:
+        return
+    events = []
+    for handler, kwargs in mails:
+        subject, text_content, html_content = handler.render(kwargs)
+        events.append({"subject": subject, "text": text_content, })
+    digest_handler = get_digest_mail_handler()
+    failures = digest_handler.send_messages(digest_handler.get_messages([ account.email ], {
+        "target": account,
+        "window": window,
+        "events": events,
+    }))
+    if failures:
+        raise failures.values()[0]
@@ -6,6 +6,7 @@ We use classes instead of functions to allow inheritance between handlers.
 
 Don't forget to connect to your signals with 'weak = False' !!
 """
+import time
 import logging
 import traceback
 import re
@@ -13,38 +14,104 @@ from os import path
 from email.MIMEImage import MIMEImage
 from django.conf import settings
 from django.template import Context
-from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
 from django.core.cache import cache
 from django.template.loader import get_template
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 from django.db.models.query import QuerySet
+from django.utils.html import escape
 
 from twistranet.twistapp.lib.log import log
 from twistranet.twistapp.lib import utils
+from twistranet.twistapp.lib.account_context import as_account
+from twistranet.notifier import queue, digest
 
 DEFAULT_SEND_EMAIL_IMAGES_AS_ATTACHMENTS = True
+DEFAULT_TWISTRANET_MAIL_BATCH_SIZE = 100        # Messages sent over a single SMTP connection
+
+# Stands for the recipient email in rendered templates, see MailHandler.render()
+RECIPIENT_PLACEHOLDER = "twistranet-recipient-placeholder"
 
 SUBJECT_REGEX = re.compile(r"^[\s]*Subject:[ \t]?([^\n$]*)\n", re.IGNORECASE | re.DOTALL)
 EMPTY_LINE_REGEX = re.compile(r"\n\n+", re.DOTALL)
 
+# Compiled email templates, see get_compiled_template()
+_templates = {}
+
+def get_compiled_template(name):
+    """
+    get_template() reads and parses the template file on each call.
+    Email templates are compiled once per process instead (unless TEMPLATE_DEBUG is True).
+    """
+    if settings.TEMPLATE_DEBUG:
+        return get_template(name)
+    if not _templates.has_key(name):
+        _templates[name] = get_template(name)
+    return _templates[name]
+
 class NotifierHandler(object):
+    """
+    Base class for handlers.
+    When the notifier queue is enabled (TWISTRANET_NOTIFIER_QUEUE), calls are stored
+    and handled later by the notifier worker (see notifier/queue.py). Otherwise,
+    they're handled right away. Either way, handle() does the actual job.
+    
+    Handlers with split_recipients = True must implement get_recipients(kwargs):
+    the worker then queues each recipient separately, and handles queued recipients
+    of the same signal by batches with handle_queued(sender, recipients, **kwargs).
+    """
+    queued = True
+    split_recipients = False
+    
+    @property
+    def key(self,):
+        """
+        Identify this handler in the queue. It must be the same in all processes.
+        """
+        raise NotImplementedError("%s must define a queue key" % self.__class__.__name__)
+    
+    def register(self,):
+        """
+        Make this handler available to the notifier worker.
+        """
+        if self.queued:
+            queue.register_handler(self)
+    
     def __call__(self, sender, **kwargs):
         """
         This is where our handlers get called.
-        Always call your parent first to populate your class instance
-        and check various stuff on it.s
         """
+        if self.queued and queue.is_enabled():
+            if queue.enqueue(self, sender, kwargs) is not None:
+                return
+        return self.handle(sender, **kwargs)
+        
+    def handle(self, sender, **kwargs):
+        """
+        Override this in your handlers.
+        """
+        raise NotImplementedError
+        
+    def handle_queued(self, sender, recipients, **kwargs):
+        """
+        Called by the notifier worker. recipients is [ None ] unless split_recipients is True.
+        Return a {recipient: exception} dict of failures.
+        """
+        self.handle(sender, **kwargs)
+        return {}
 
 
 class LogHandler(NotifierHandler):
     '''
     Just prints a log message for what it's been called for.
     '''
+    queued = False
+    
     def __init__(self, level = logging.DEBUG):
         self.level = level
 
-    def __call__(self, sender, **kwargs):
+    def handle(self, sender, **kwargs):
         log.log(self.level, "%s %s" % (sender, kwargs))
 
 
@@ -55,26 +122,37 @@ class NotificationHandler(NotifierHandler):
 
     You can customize the displayed description upon class creation: the message
     will be _'ed with %(xxx)s values filled from the parameters dictionnary.
+    
+    With digest = True, notifications published on an account which has a digest window
+    are aggregated (see notifier/digest.py).
     """
-    def __init__(self, owner_arg, publisher_arg, message, permissions = "public"):
+    def __init__(self, owner_arg, publisher_arg, message, permissions = "public", name = None, digest = False):
         """
         Store the message for future use.
         owner_arg and publisher_arg will be used to create the underlying content.
         owner_arg defaults to SystemAccount
         publisher_arg defaults to owner arg's publisher.
+        name identifies the handler in the notifier queue. As message is translated,
+        you'd better give one.
         """
+        self.name = name or message
         self.owner_arg = owner_arg
         self.publisher_arg = publisher_arg
         self.message = message
         self.permissions = permissions
+        self.digest = digest
+        self.register()
 
-    def __call__(self, sender, **kwargs):
+    @property
+    def key(self,):
+        return "NotificationHandler:%s" % (self.name, )
+
+    def handle(self, sender, **kwargs):
         """
         We add the Notification object on behalf of SystemAccount.
         """
         from twistranet.twistapp.models import Twistable
         from twistranet.twistapp.models import SystemAccount
-        from twistranet.notifier.models import Notification
 
         # Prepare the message dict.
         # We use title_or_description on each Twistable argument to display it.
@@ -83,11 +161,54 @@ class NotificationHandler(NotifierHandler):
             if isinstance(value, Twistable):
                 message_dict[param] = value.id
 
-        # We force __account__ to fake user login.
+        # We fake SystemAccount login.
+        system = SystemAccount.get()
+        with as_account(system):
+            owner = kwargs.get(self.owner_arg, system)
+            publisher = kwargs.get(self.publisher_arg, owner.publisher)
+            if self.digest:
+                window = digest.get_windows([ publisher.id ])[publisher.id]
+                if window != digest.IMMEDIATE:
+                    try:
+                        digest.buffer(self, publisher.id, window, queue.encode_parameters(kwargs))
+                        return
+                    except TypeError:
+                        pass
+            self.create_notification(owner, publisher, message_dict)
+
+    def handle_digest(self, kwargs_list):
+        """
+        Create a single notification for several signals published on the same account.
+        Parameters which differ between signals are given to the notification as lists of ids.
+        """
+        from twistranet.twistapp.models import Twistable
+        from twistranet.twistapp.models import SystemAccount
+        ids = {}
+        for kwargs in kwargs_list:
+            for param, value in kwargs.items():
+                if isinstance(value, Twistable):
+                    ids.setdefault(param, [])
+                    if value.id not in ids[param]:
+                        ids[param].append(value.id)
+        message_dict = {}
+        for param, values in ids.items():
+            if len(values) == 1:
+                message_dict[param] = values[0]
+            else:
+                message_dict[param] = values
+
         system = SystemAccount.get()
-        __account__ = system
-        owner = kwargs.get(self.owner_arg, system)
-        publisher = kwargs.get(self.publisher_arg, owner.publisher)
+        with as_account(system):
+            owners = set([ kwargs.get(self.owner_arg, system).id for kwargs in kwargs_list ])
+            if len(owners) == 1:
+                owner = kwargs_list[0].get(self.owner_arg, system)
+            else:
+                owner = system
+            publisher = kwargs_list[0].get(self.publisher_arg, owner.publisher)
+            self.create_notification(owner, publisher, message_dict)
+
+    def create_notification(self, owner, publisher, message_dict):
+        from twistranet.notifier.models import Notification
         n = Notification(
             publisher = publisher,
             owner = owner,
@@ -118,152 +239,263 @@ class MailHandler(NotifierHandler):
     
     One last thing: a signal can overload the templates. Just pass 'text_template' and/or 'html_template' in
     the signal kw arguments to have the templates overloaded for that particular signal instance.
+    
+    With digest = True, recipients who chose a digest window get this mail's subject
+    in their next digest instead (see notifier/digest.py).
     """
-    def __init__(self, recipient_arg, text_template, subject = None, html_template = None, managers_only = False):
+    split_recipients = True
+    
+    def __init__(self, recipient_arg, text_template, subject = None, html_template = None, managers_only = False, digest = False):
+        self.digest = digest
         self.recipient_arg = recipient_arg
         self.subject = subject
         self.text_template = text_template
         self.html_template = html_template
         self.managers_only = managers_only
+        self.register()
         
-    def __call__(self, sender, **kwargs):
+    @property
+    def key(self,):
+        return "MailHandler:%s:%s" % (self.recipient_arg, self.text_template, )
+        
+    def handle(self, sender, **kwargs):
         """
-        Generate the message itself.
-        XXX TODO: Handle translation correctly (not from the request only)
+        Fake-Login with SystemAccount so that everybody can be notified,
+        even users this current user can't list.
         """
-        # Fake-Login with SystemAccount so that everybody can be notified,
-        # even users this current user can't list.
-        from twistranet.twistapp.models import SystemAccount, Account, UserAccount, Community, Twistable
-        __account__ = SystemAccount.get()
-        from_email = settings.SERVER_EMAIL
-        host = settings.EMAIL_HOST
-        cache_mimeimages = {}
-        if not host:
+        from twistranet.twistapp.models import SystemAccount
+        with as_account(SystemAccount.get()):
+            return self.send_mail(sender, **kwargs)
+            
+    def handle_queued(self, sender, recipients, **kwargs):
+        """
+        Send the mails over a single connection. Failures are returned, not raised,
+        so that the worker can retry them.
+        """
+        if not settings.EMAIL_HOST:
+            return {}
+        return self.send_messages(self.get_messages(recipients, kwargs))
+
+    def get_recipients(self, kwargs):
+        """
+        Return the list of recipient emails for these signal arguments.
+        If self.digest is True, recipients with a digest window are buffered for their digest instead.
+        """
+        from twistranet.twistapp.models import UserAccount, Community, Twistable, dereference_bulk
+        if not settings.EMAIL_HOST:
             # If host is disabled (EMAIL_HOST is None), skip that
-            return
-        
-        # Handle recipients emails
+            return []
         recipients = kwargs.get(self.recipient_arg, None)
         if not recipients:
             raise ValueError("Recipient must be provided as a '%s' parameter" % self.recipient_arg)
         to_list = []
         if not isinstance(recipients, (list, tuple, QuerySet, )):
             recipients = (recipients, )
+        recipients = [ r for r in recipients if not isinstance(r, Twistable) ] + \
+            dereference_bulk([ r for r in recipients if isinstance(r, Twistable) ])
+        
+        # Fetch all account emails (and notification windows) in a single query
+        accounts = []
+        account_ids = [ r.id for r in recipients if isinstance(r, UserAccount) ]
+        if account_ids:
+            found = dict([ (row[0], row) for row in UserAccount.objects.__booster__.filter(
+                id__in = account_ids,
+            ).values_list("id", "user__email", "notification_window") ])
+            for id in account_ids:
+                if not found.has_key(id):
+                    continue
+                if not found[id][1]:
+                    log.warning("Can't send email to account %s: no email registered." % (id, ))
+                    continue
+                accounts.append(found[id])
         for recipient in recipients:
-            if isinstance(recipient, Twistable):
-                recipient = recipient.object
             if isinstance(recipient, UserAccount):
-                to = recipient.email
-                if not to:
-                    log.warning("Can't send email for '%s': %s doesn't have an email registered." % (sender, recipient, ))
-                    return
-                to_list.append(to)
+                continue
             elif isinstance(recipient, Community):
+                # Same as Community.members / managers, but with UserAccounts only
+                lookup = {
+                    "targeted_network__target__id": recipient.id,
+                    "requesting_network__client__id": recipient.id,
+                }
                 if self.managers_only:
-                    members = recipient.managers
-                else:
-                    members = recipient.members
-                # XXX Suboptimal for very large communities
-                to_list.extend([ member.email for member in members if member.email ])
+                    lookup["targeted_network__is_manager"] = True
+                members = UserAccount.objects.__booster__.filter(**lookup)
+                accounts.extend([ row for row in members.values_list("id", "user__email", "notification_window") if row[1] ])
             elif type(recipient) in (str, unicode, ):
                 to_list.append(recipient)        # XXX Todo: check the '@'
             else:
                 raise ValueError("Invalid recipient: %s (%s)" % (recipient, type(recipient), ))
                 
+        # Put digest recipients aside
+        parameters = None
+        digests = self.digest and digest.is_enabled()
+        for id, email, window in accounts:
+            if digests and window != digest.IMMEDIATE:
+                try:
+                    parameters = parameters or queue.encode_parameters(kwargs)
+                    digest.buffer(self, id, window, parameters)
+                    continue
+                except TypeError:
+                    pass
+            to_list.append(email)
+        return to_list
+
+    def send_mail(self, sender, **kwargs):
+        """
+        Generate the messages and send them, by batches of TWISTRANET_MAIL_BATCH_SIZE.
+        """
+        to_list = self.get_recipients(kwargs)
+        batch_size = getattr(settings, "TWISTRANET_MAIL_BATCH_SIZE", DEFAULT_TWISTRANET_MAIL_BATCH_SIZE)
+        start = time.time()
+        sent = 0
+        for batch_start in range(0, len(to_list), batch_size):
+            batch = to_list[batch_start:batch_start + batch_size]
+            try:
+                failures = self.send_messages(self.get_messages(batch, kwargs))
+            except:
+                log.warning("Unable to send messages to %s" % ", ".join(batch))
+                log.exception("Here's what we've got as an error.")
+                continue
+            sent += len(batch) - len(failures)
+        if sent:
+            elapsed = time.time() - start
+            log.debug("Sent %d mails in %.2fs (%.1f mails/s)" % (sent, elapsed, sent / max(elapsed, 0.001), ))
+
+    def send_messages(self, messages):
+        """
+        Send messages over a single connection to the mail server.
+        Return a {recipient: exception} dict of the messages we couldn't send.
+        Failing to connect to the server raises.
+        """
+        failures = {}
+        if not messages:
+            return failures
+        connection = get_connection()
+        connection.open()
+        try:
+            for msg in messages:
+                msg.connection = connection
+                try:
+                    log.debug("Sending mail: '%s' from '%s' to '%s'" % (msg.subject, msg.from_email, msg.to[0]))
+                    msg.send()
+                except Exception, e:
+                    log.warning("Unable to send message to %s: %s" % (msg.to[0], e, ))
+                    failures[msg.to[0]] = e
+        finally:
+            connection.close()
+        return failures
+
+    def render(self, kwargs):
+        """
+        Render (subject, text_content, html_content) for these signal arguments.
+        Templates are rendered only once for all recipients: the 'recipient' context variable
+        is set to RECIPIENT_PLACEHOLDER, which get_messages() replaces by each recipient email.
+        """
         # Fetch templates
         text_template = kwargs.get('text_template', self.text_template)
         html_template = kwargs.get('html_template', self.html_template)
                 
-        # Now generate template and send mail for each recipient
-        # XXX TODO: See http://docs.djangoproject.com/en/1.2/topics/email/#sending-multiple-e-mails
-        # for the good approach to use.
-        for to in to_list:
-            # Append domain (and site info) to kwargs
-            d = kwargs.copy()
-            domain = cache.get("twistranet_site_domain")
-            d.update({
-                "domain":       domain,
-                "site_name":    utils.get_site_name(),
-                "baseline":     utils.get_baseline(),
-                "recipient":    to,     # A string
-            })
+        # Append domain (and site info) to kwargs
+        d = kwargs.copy()
+        d.update({
+            "domain":       cache.get("twistranet_site_domain"),
+            "site_name":    utils.get_site_name(),
+            "baseline":     utils.get_baseline(),
+            "recipient":    RECIPIENT_PLACEHOLDER,
+        })
+    
+        # Load both templates and render them with kwargs context
+        c = Context(d)
+        text_content = get_compiled_template(text_template).render(c).strip()
+        if html_template:
+            html_content = get_compiled_template(html_template).render(c)
+        else:
+            html_content = None
         
-            # Load both templates and render them with kwargs context
-            text_tpl = get_template(text_template)
-            c = Context(d)
-            text_content = text_tpl.render(c).strip()
-            if html_template:
-                html_tpl = get_template(html_template)
-                html_content = html_tpl.render(c)
-            else:
-                html_content = None
-            
-            # Fetch back subject from text template
-            subject = self.subject
-            if not subject:
-                match = SUBJECT_REGEX.search(text_content)
-                if match:
-                    subject = match.groups()[0]
-            if not subject:
-                raise ValueError("No subject provided nor 'Subject:' first line in your text template")
-            
-            # Remove empty lines and "Subject:" line from text templates
-            text_content = SUBJECT_REGEX.sub('', text_content)
-            text_content = EMPTY_LINE_REGEX.sub('\n', text_content)
+        # Fetch back subject from text template
+        subject = self.subject
+        if not subject:
+            match = SUBJECT_REGEX.search(text_content)
+            if match:
+                subject = match.groups()[0]
+        if not subject:
+            raise ValueError("No subject provided nor 'Subject:' first line in your text template")
         
-            # Prepare messages
-            msg = EmailMultiAlternatives(subject, text_content, from_email, [ to ], )
-            if html_content:
-                if getattr(settings, 'SEND_EMAIL_IMAGES_AS_ATTACHMENTS', DEFAULT_SEND_EMAIL_IMAGES_AS_ATTACHMENTS):
-                    # we replace img links by img Mime Images
-                    mimeimages = []
-                    def replace_img_url(match):
-                        """Change src url by mimeurl
-                           fill the mimeimages list
-                        """
-                        urlpath = str(match.group('urlpath'))
-                        attribute = str(match.group('attribute'))
+        # Remove empty lines and "Subject:" line from text templates
+        text_content = SUBJECT_REGEX.sub('', text_content)
+        text_content = EMPTY_LINE_REGEX.sub('\n', text_content)
+        return subject, text_content, html_content
 
-                        is_static = False
-                        pathSplit = urlpath.split('/')
-                        if 'static' in pathSplit:
-                            filename = urlpath.split('/static/')[-1]
-                            is_static = True
-                        else:
-                            # XXX TODO : need to be improved split with site path (for vhosts)
-                            filename = urlpath.split('/')[-1]
-                        nb = len(mimeimages)+1
-                        mimeimages.append((filename, 'img%i'%nb, is_static))
-                        mimeurl = "cid:img%i" %nb
-                        return '%s="%s"' % (attribute,mimeurl)
+    def get_images(self, html_content):
+        """
+        Replace image urls of html_content by references to MIME attachments.
+        Return (html_content, [ MIMEImage, ... ]). Images are read once, and shared
+        between all messages of a batch.
+        """
+        domain = cache.get("twistranet_site_domain")
+        mimeimages = []
+        def replace_img_url(match):
+            """Change src url by mimeurl
+               fill the mimeimages list
+            """
+            urlpath = str(match.group('urlpath'))
+            attribute = str(match.group('attribute'))
 
-                    img_url_expr = re.compile('(?P<attribute>src)\s*=\s*([\'\"])(%s)?(?P<urlpath>[^\"\']*)\\2' %domain, re.IGNORECASE)
-                    html_content = img_url_expr.sub(replace_img_url, html_content)
-                    msg.attach_alternative(html_content, "text/html")
-                    if mimeimages:
-                        msg.mixed_subtype = 'related'
-                        for fkey, name, is_static in mimeimages:
-                            if cache_mimeimages.has_key(fkey):
-                                msgImage = cache_mimeimages[fkey]
-                            else:
-                                if is_static:
-                                    f = open(path.join(settings.TWISTRANET_STATIC_PATH, fkey), 'rb')
-                                else:
-                                    f = open(path.join(settings.MEDIA_ROOT, fkey), 'rb')
-                                cache_mimeimages[fkey] = msgImage = MIMEImage(f.read())
-                                f.close()
-                            msgImage.add_header('Content-ID', '<%s>' % name)
-                            msgImage.add_header('Content-Disposition', 'inline')
-                            msg.attach(msgImage)
-                # just inline images
-                else:
-                    msg.attach_alternative(html_content, "text/html")
-            # Send safely
-            try:
-                log.debug("Sending mail: '%s' from '%s' to '%s'" % (subject, from_email, to))
-                msg.send()
-            except:
-                log.warning("Unable to send message to %s" % to)
-                log.exception("Here's what we've got as an error.")
+            is_static = False
+            pathSplit = urlpath.split('/')
+            if 'static' in pathSplit:
+                filename = urlpath.split('/static/')[-1]
+                is_static = True
+            else:
+                # XXX TODO : need to be improved split with site path (for vhosts)
+                filename = urlpath.split('/')[-1]
+            nb = len(mimeimages)+1
+            mimeimages.append((filename, 'img%i'%nb, is_static))
+            mimeurl = "cid:img%i" %nb
+            return '%s="%s"' % (attribute,mimeurl)
 
+        img_url_expr = re.compile('(?P<attribute>src)\s*=\s*([\'\"])(%s)?(?P<urlpath>[^\"\']*)\\2' %domain, re.IGNORECASE)
+        html_content = img_url_expr.sub(replace_img_url, html_content)
+        images = []
+        for fkey, name, is_static in mimeimages:
+            if is_static:
+                f = open(path.join(settings.TWISTRANET_STATIC_PATH, fkey), 'rb')
+            else:
+                f = open(path.join(settings.MEDIA_ROOT, fkey), 'rb')
+            try:
+                msgImage = MIMEImage(f.read())
+            finally:
+                f.close()
+            msgImage.add_header('Content-ID', '<%s>' % name)
+            msgImage.add_header('Content-Disposition', 'inline')
+            images.append(msgImage)
+        return html_content, images
 
+    def get_messages(self, to_list, kwargs):
+        """
+        Generate one message per email of to_list.
+        XXX TODO: Handle translation correctly (not from the request only)
+        """
+        from_email = settings.SERVER_EMAIL
+        subject, text_content, html_content = self.render(kwargs)
+        images = []
+        if html_content and getattr(settings, 'SEND_EMAIL_IMAGES_AS_ATTACHMENTS', DEFAULT_SEND_EMAIL_IMAGES_AS_ATTACHMENTS):
+            # we replace img links by img Mime Images
+            html_content, images = self.get_images(html_content)
+        
+        messages = []
+        for to in to_list:
+            msg = EmailMultiAlternatives(
+                subject.replace(RECIPIENT_PLACEHOLDER, to),
+                text_content.replace(RECIPIENT_PLACEHOLDER, to),
+                from_email,
+                [ to ],
+            )
+            if html_content:
+                msg.attach_alternative(html_content.replace(RECIPIENT_PLACEHOLDER, escape(to)), "text/html")
+                if images:
+                    msg.mixed_subtype = 'related'
+                    for msgImage in images:
+                        msg.attach(msgImage)
+            messages.append(msg)
+        return messages
@@ -2,13 +2,29 @@
 This is the content used as a notification.
 """
 import pickle
+import hashlib
+try:
+    # python 2.6
+    import json
+except:
+    # python 2.4 with simplejson
+    import simplejson as json
 
 from django.db import models
+from django.core.cache import cache
+from django.utils import translation
 from django.utils.translation import ugettext as _
 
-from twistranet.twistapp.models import Twistable, Content
+from twistranet.twistapp.models import Twistable, Content, Account
 from twistranet.twistapp.lib import permissions
 
+# Number of accounts / contents named in an aggregated notification
+MAX_LISTED_PARAMETERS = 3
+
+# Rendered messages cache
+MESSAGE_CACHE_PREFIX = "notification_message"
+MESSAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
 class Notification(Content):
     """
     ACCOUNT did WHAT [on ACCOUNT/CONTENT].
@@ -32,23 +48,25 @@ class Notification(Content):
 
     def get_parameters(self,):
         """
-        Unpickle parameters
+        Decode parameters. They used to be pickled, they're JSON-encoded now.
         """
-        if self._encoded_parameters:
-            p = self._encoded_parameters
-            if isinstance(p, unicode):
-                p = p.encode('ascii')
-            return pickle.loads(p)
-        else:
+        p = self._encoded_parameters
+        if not p:
             return {}
+        if p.startswith("{"):
+            return dict([ (str(k), v) for k, v in json.loads(p).items() ])
+        if isinstance(p, unicode):
+            p = p.encode('ascii')
+        return pickle.loads(p)
         
     def set_parameters(self, d):
         """
-        Pickle parameters
+        Encode parameters, a dict of ids or lists of ids.
         """
         if not isinstance(d, dict):
-            raise TypeError("parameters must be a dict of picklable values")
-        self._encoded_parameters = pickle.dumps(d)
+            raise TypeError("parameters must be a dict of ids")
+        self._encoded_parameters = json.dumps(d, separators = (',', ':'))
+        self.__dict__.pop("_c_message", None)
         
     parameters = property(get_parameters, set_parameters)
     
@@ -57,16 +75,140 @@ class Notification(Content):
         """
         Print message for this notification.
         We do that by de-referencing parameters and then mixing it to the message.
-        XXX HEAVILY CACHE THIS !!!
+        See prepare_summaries() to do this for a whole page of notifications at once.
+        """
+        if not hasattr(self, "_c_message"):
+            Notification.prepare_summaries([ self ])
+        return self._c_message
+        
+    @classmethod
+    def prepare_summaries(cls, notifications):
+        """
+        Compute the message of all these notifications with a single query for their parameters.
+        
+        Rendered messages are cached per notification and language. Cache keys include the
+        modification date of each parameter the current user can see, so that a message is
+        rendered again when an object is renamed, and never shows something the user can't see.
+        """
+        notifications = [ n for n in notifications if not hasattr(n, "_c_message") ]
+        if not notifications:
+            return
+        parameters = {}
+        ids = set()
+        for n in notifications:
+            parameters[n.id] = n.parameters
+            for v in parameters[n.id].values():
+                if isinstance(v, list):
+                    ids.update(v)
+                else:
+                    ids.add(v)
+        objects = {}
+        if ids:
+            objects = dict([ (obj.id, obj) for obj in Twistable.objects.filter(id__in = list(ids)) ])
+        
+        # Fetch what we can from the cache
+        language = translation.get_language()
+        keys = {}
+        for n in notifications:
+            signature = []
+            for k, v in sorted(parameters[n.id].items()):
+                for id in (isinstance(v, list) and v or [ v ]):
+                    obj = objects.get(id)
+                    signature.append("%s:%s" % (id, obj and obj.modified_at))
+            keys[n.id] = "%s#%d#%s#%s" % (
+                MESSAGE_CACHE_PREFIX, n.id, language, hashlib.md5(",".join(signature)).hexdigest(),
+            )
+        cached = cache.get_many(keys.values())
+        
+        # Render the others
+        for n in notifications:
+            if cached.has_key(keys[n.id]):
+                n._c_message = cached[keys[n.id]]
+                continue
+            n._c_message = n.render_message(parameters[n.id], objects)
+            cache.set(keys[n.id], n._c_message, MESSAGE_CACHE_TIMEOUT)
+
+    def render_message(self, parameters, objects):
+        """
+        Mix parameters to the message. objects is a {id: twistable} dict of what we can see.
+        Return None if a single parameter can't be seen.
         """
         n_dict = {}
-        try:
-            for k,v in self.parameters.items():
-                n_dict[k] = Twistable.objects.get(id = v).html_link
-        except Twistable.DoesNotExist:
-            return None
-            
+        for k,v in parameters.items():
+            if isinstance(v, list):
+                # Aggregated notification (see notifier/digest.py)
+                links = [ objects[id].html_link for id in v if objects.has_key(id) ]
+                if not links:
+                    return None
+                if len(links) > MAX_LISTED_PARAMETERS:
+                    n_dict[k] = _("%(names)s and %(count)d others") % {
+                        "names": ", ".join(links[:MAX_LISTED_PARAMETERS]),
+                        "count": len(links) - MAX_LISTED_PARAMETERS,
+                    }
+                else:
+                    n_dict[k] = ", ".join(links)
+            else:
+                if not objects.has_key(v):
+                    return None
+                n_dict[k] = objects[v].html_link
         return _(self.description) % n_dict
     
     class Meta:
         app_label = 'twistapp'
+
+
+class OutboxMessage(models.Model):
+    """
+    A notification waiting to be handled by the notifier worker (see notifier/queue.py).
+
+    handler is the key of the NotifierHandler to call, parameters the JSON-encoded signal arguments.
+    Mail handlers first get a single row for the whole signal; the worker then splits it
+    into one row per recipient email, so that each mail is retried on its own.
+    """
+    STATUS_PENDING = "pending"
+    STATUS_SENDING = "sending"
+    STATUS_DEAD = "dead"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_SENDING, "Sending"),
+        (STATUS_DEAD, "Dead"),
+    )
+    
+    handler = models.CharField(max_length = 255)
+    sender = models.CharField(max_length = 255, blank = True)
+    parameters = models.TextField()
+    recipient = models.CharField(max_length = 255, null = True, blank = True)
+    status = models.CharField(max_length = 8, choices = STATUS_CHOICES, default = STATUS_PENDING, db_index = True)
+    attempts = models.IntegerField(default = 0)
+    next_attempt_at = models.DateTimeField(db_index = True)
+    locked_at = models.DateTimeField(null = True, blank = True)
+    created_at = models.DateTimeField(auto_now_add = True)
+    last_error = models.TextField(blank = True)
+    
+    def __unicode__(self,):
+        return u"%s (%s, %s)" % (self.handler, self.recipient or "-", self.status, )
+    
+    class Meta:
+        app_label = 'twistapp'
+        ordering = ("id", )
+
+
+class DigestEvent(models.Model):
+    """
+    A notification buffered until the next digest of its account (see notifier/digest.py).
+
+    For mail handlers, account is the recipient. For notification handlers, it's the
+    publisher of the notification, so that events on a busy community are aggregated together.
+    """
+    account = models.ForeignKey(Account, related_name = "digest_events")
+    window = models.CharField(max_length = 10)
+    handler = models.CharField(max_length = 255)
+    parameters = models.TextField()
+    created_at = models.DateTimeField(auto_now_add = True, db_index = True)
+    
+    def __unicode__(self,):
+        return u"%s for %s (%s)" % (self.handler, self.account_id, self.window, )
+    
+    class Meta:
+        app_label = 'twistapp'
+        ordering = ("id", )
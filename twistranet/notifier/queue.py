@@ -0,0 +1,351 @@
+"""
+Persistent notification queue.
+
+When TWISTRANET_NOTIFIER_QUEUE is True, notifier handlers don't run in the
+request that sent the signal: the signal arguments are stored in an OutboxMessage
+row instead, and a worker (./manage.py twistranet_notifier) handles them later.
+
+Signal arguments are stored as JSON. Twistables (and lists or querysets of twistables)
+are stored as ids and fetched back by the worker, everything else must be JSON-serializable.
+Signals which can't be encoded are handled synchronously, as before.
+
+The worker:
+- splits mail rows into one row per recipient email, in a single transaction ;
+- handles due rows of the same signal together: mails are rendered once and
+  sent over a single connection (see MailHandler.handle_queued) ;
+- sends at most TWISTRANET_NOTIFIER_RATE messages per second ;
+- retries failed rows with an exponential delay (TWISTRANET_NOTIFIER_RETRY_DELAY * 2 ** attempts) ;
+- flags rows which failed TWISTRANET_NOTIFIER_MAX_ATTEMPTS times as 'dead'. They're kept
+  in the table for inspection and can be queued again with requeue_dead(), then deleted
+  after TWISTRANET_NOTIFIER_DEAD_RETENTION seconds (their parameters may hold private data,
+  such as password reset links).
+It also sends due notification digests every minute (see notifier/digest.py).
+Several workers can run at once: rows are claimed with a conditional UPDATE.
+"""
+import time
+import datetime
+import traceback
+try:
+    # python 2.6
+    import json
+except:
+    # python 2.4 with simplejson
+    import simplejson as json
+from django.conf import settings
+from django.db import transaction
+from django.db.models.query import QuerySet
+
+from twistranet.twistapp.lib.log import log
+
+DEFAULT_TWISTRANET_NOTIFIER_QUEUE = False
+DEFAULT_TWISTRANET_NOTIFIER_RATE = 10                   # Messages per second and per worker
+DEFAULT_TWISTRANET_NOTIFIER_MAX_ATTEMPTS = 5
+DEFAULT_TWISTRANET_NOTIFIER_RETRY_DELAY = 60            # Seconds before the first retry
+DEFAULT_TWISTRANET_NOTIFIER_LOCK_TIMEOUT = 60 * 10      # Seconds before a row claimed by a crashed worker is retried
+DEFAULT_TWISTRANET_NOTIFIER_DEAD_RETENTION = 60 * 60 * 24 * 7   # Seconds before dead rows are deleted
+DIGEST_INTERVAL = 60                                    # Seconds between two checks for due digests
+PURGE_INTERVAL = 60 * 60                                # Seconds between two purges of dead rows
+
+TWISTABLE_KEY = "__twistable__"
+TWISTABLE_LIST_KEY = "__twistables__"
+
+# Handlers, by key. Filled when handlers are instanciated, see NotifierHandler.
+_handlers = {}
+
+def register_handler(handler):
+    _handlers[handler.key] = handler
+
+def get_handler(key):
+    return _handlers.get(key)
+
+def is_enabled():
+    return getattr(settings, "TWISTRANET_NOTIFIER_QUEUE", DEFAULT_TWISTRANET_NOTIFIER_QUEUE)
+
+def _setting(name):
+    return getattr(settings, name, globals()["DEFAULT_%s" % name])
+
+#                                                       #
+#               Signal arguments encoding               #
+#                                                       #
+
+def encode_parameters(kwargs):
+    """
+    Return signal kwargs as a JSON string. Raise TypeError if a value can't be encoded.
+    """
+    from twistranet.twistapp.models import Twistable
+    encoded = {}
+    for k, v in kwargs.items():
+        if k == "signal":
+            continue                    # Django adds the signal itself to kwargs, we don't need it
+        if isinstance(v, Twistable):
+            v = {TWISTABLE_KEY: v.id}
+        elif isinstance(v, QuerySet) and issubclass(v.model, Twistable):
+            v = {TWISTABLE_LIST_KEY: list(v.values_list("id", flat = True))}
+        elif isinstance(v, (list, tuple, )) and v and isinstance(v[0], Twistable):
+            v = {TWISTABLE_LIST_KEY: [ obj.id for obj in v ]}
+        encoded[k] = v
+    return json.dumps(encoded)
+
+def decode_parameters(data):
+    """
+    Return signal kwargs from their JSON string, fetching twistables back with as few queries as possible.
+    Raise Twistable.DoesNotExist if a single twistable vanished. Vanished list items are dropped.
+    """
+    from twistranet.twistapp.models import Twistable, dereference_bulk
+    from twistranet.twistapp.models.twistable import DEREFERENCE_CHUNK_SIZE
+    kwargs = {}
+    for k, v in json.loads(data).items():
+        kwargs[str(k)] = v
+
+    ids = set()
+    for v in kwargs.values():
+        if isinstance(v, dict) and v.has_key(TWISTABLE_KEY):
+            ids.add(v[TWISTABLE_KEY])
+        elif isinstance(v, dict) and v.has_key(TWISTABLE_LIST_KEY):
+            ids.update(v[TWISTABLE_LIST_KEY])
+    ids = list(ids)
+    objects = []
+    for start in range(0, len(ids), DEREFERENCE_CHUNK_SIZE):
+        objects.extend(Twistable.objects.__booster__.filter(id__in = ids[start:start + DEREFERENCE_CHUNK_SIZE]))
+    objects = dict([ (obj.id, obj) for obj in dereference_bulk(objects) ])
+
+    for k, v in kwargs.items():
+        if isinstance(v, dict) and v.has_key(TWISTABLE_KEY):
+            if not objects.has_key(v[TWISTABLE_KEY]):
+                raise Twistable.DoesNotExist("Twistable %s doesn't exist anymore" % v[TWISTABLE_KEY])
+            kwargs[k] = objects[v[TWISTABLE_KEY]]
+        elif isinstance(v, dict) and v.has_key(TWISTABLE_LIST_KEY):
+            kwargs[k] = [ objects[id] for id in v[TWISTABLE_LIST_KEY] if objects.has_key(id) ]
+    return kwargs
+
+#                                                       #
+#                       Producer                        #
+#                                                       #
+
+def enqueue(handler, sender, kwargs):
+    """
+    Store a signal for later handling. Return the OutboxMessage, or None if kwargs can't be encoded
+    (the caller must then handle the signal by itself).
+    """
+    from twistranet.notifier.models import OutboxMessage
+    try:
+        parameters = encode_parameters(kwargs)
+    except TypeError:
+        log.warning("Can't queue '%s' signal from %s, handling it synchronously." % (handler.key, sender, ))
+        return None
+    return OutboxMessage.objects.create(
+        handler = handler.key,
+        sender = ("%s" % (sender, ))[:255],
+        parameters = parameters,
+        next_attempt_at = datetime.datetime.now(),
+    )
+
+#                                                       #
+#                       Worker                          #
+#                                                       #
+
+class Worker(object):
+    """
+    Handle queued notifications. Usage:
+        Worker().run()              # Until the queue is empty
+        Worker().run(loop = True)   # Forever
+    """
+    def __init__(self, rate = None, max_attempts = None, retry_delay = None, batch_size = 100):
+        self.rate = rate or _setting("TWISTRANET_NOTIFIER_RATE")
+        self.max_attempts = max_attempts or _setting("TWISTRANET_NOTIFIER_MAX_ATTEMPTS")
+        self.retry_delay = retry_delay or _setting("TWISTRANET_NOTIFIER_RETRY_DELAY")
+        self.batch_size = batch_size
+        self.stats = {"handled": 0, "split": 0, "retried": 0, "dead": 0, "digested": 0, "purged": 0, "seconds": 0.0, "per_second": 0.0, }
+        self._next_send = 0.0
+        self._next_digest = 0.0
+        self._next_purge = 0.0
+
+    def run(self, loop = False, poll_interval = 5):
+        """
+        Handle pending rows. Return stats, including the throughput (handled rows per second,
+        not counting the time spent waiting for an empty queue).
+        """
+        while True:
+            start = time.time()
+            handled = self.run_once()
+            if not handled:
+                if not loop:
+                    break
+                time.sleep(poll_interval)
+                continue
+            self.stats["seconds"] += time.time() - start
+            self.stats["per_second"] = self.stats["handled"] / max(self.stats["seconds"], 0.001)
+        return self.stats
+
+    def run_once(self,):
+        """
+        Handle one batch of due rows. Return the number of rows we've claimed.
+        """
+        from twistranet.notifier.models import OutboxMessage
+        from twistranet.twistapp.models import SystemAccount
+        from twistranet.twistapp.lib.account_context import as_account
+        from twistranet.notifier import digest
+        now = datetime.datetime.now()
+        
+        # Send due digests
+        if time.time() >= self._next_digest:
+            with as_account(SystemAccount.get()):
+                self.stats["digested"] += digest.flush()
+            self._next_digest = time.time() + DIGEST_INTERVAL
+
+        # Forget old dead rows
+        if time.time() >= self._next_purge:
+            self.stats["purged"] += purge_dead()
+            self._next_purge = time.time() + PURGE_INTERVAL
+
+        # Give back rows claimed by workers which died in the meantime
+        stale = now - datetime.timedelta(seconds = _setting("TWISTRANET_NOTIFIER_LOCK_TIMEOUT"))
+        with transaction.commit_on_success():
+            OutboxMessage.objects.filter(status = OutboxMessage.STATUS_SENDING, locked_at__lt = stale).update(
+                status = OutboxMessage.STATUS_PENDING,
+                locked_at = None,
+            )
+
+        ids = list(OutboxMessage.objects.filter(
+            status = OutboxMessage.STATUS_PENDING,
+            next_attempt_at__lte = now,
+        ).values_list("id", flat = True)[:self.batch_size])
+        claimed = []
+        for id in ids:
+            with transaction.commit_on_success():
+                ok = OutboxMessage.objects.filter(id = id, status = OutboxMessage.STATUS_PENDING).update(
+                    status = OutboxMessage.STATUS_SENDING,
+                    locked_at = datetime.datetime.now(),
+                )
+            if ok:
+                claimed.append(id)      # Otherwise, another worker was faster
+        
+        # Recipients of the same signal are handled together (eg. over a single SMTP connection)
+        groups = {}
+        keys = []
+        for message in OutboxMessage.objects.filter(id__in = claimed):
+            if message.recipient is None:
+                key = message.id
+            else:
+                key = (message.handler, message.parameters, )
+            if not groups.has_key(key):
+                groups[key] = []
+                keys.append(key)
+            groups[key].append(message)
+        with as_account(SystemAccount.get()):
+            for key in keys:
+                self.handle(groups[key])
+        return len(claimed)
+
+    def handle(self, messages):
+        """
+        Handle claimed rows sharing the same handler and parameters.
+        Delete them on success, schedule a retry or flag them as dead on failure.
+        """
+        from twistranet.notifier.models import OutboxMessage
+        message = messages[0]
+        try:
+            handler = get_handler(message.handler)
+            if handler is None:
+                raise LookupError("Unknown notifier handler: '%s'" % message.handler)
+            kwargs = decode_parameters(message.parameters)
+            if message.recipient is None and handler.split_recipients:
+                with transaction.commit_on_success():
+                    recipients = handler.get_recipients(kwargs)
+                    for recipient in recipients:
+                        OutboxMessage.objects.create(
+                            handler = message.handler,
+                            sender = message.sender,
+                            parameters = message.parameters,
+                            recipient = recipient,
+                            next_attempt_at = datetime.datetime.now(),
+                        )
+                    message.delete()
+                self.stats["split"] += len(recipients)
+                return
+            self.throttle(len(messages))
+            with transaction.commit_on_success():
+                failures = handler.handle_queued(message.sender, [ m.recipient for m in messages ], **kwargs)
+                OutboxMessage.objects.filter(id__in = [ m.id for m in messages if not failures.has_key(m.recipient) ]).delete()
+            self.stats["handled"] += len(messages) - len(failures)
+            for m in messages:
+                if failures.has_key(m.recipient):
+                    self.fail(m, failures[m.recipient], "%s: %s" % (failures[m.recipient].__class__.__name__, failures[m.recipient], ))
+        except Exception, e:
+            error = traceback.format_exc()
+            for m in messages:
+                self.fail(m, e, error)
+
+    def fail(self, message, exception, error):
+        """
+        Schedule a retry for this row, or flag it as dead.
+        """
+        from twistranet.notifier.models import OutboxMessage
+        from twistranet.twistapp.models import Twistable
+        message.attempts += 1
+        message.last_error = error
+        message.locked_at = None
+        if message.attempts >= self.max_attempts or isinstance(exception, (LookupError, Twistable.DoesNotExist, )):
+            message.status = OutboxMessage.STATUS_DEAD
+            self.stats["dead"] += 1
+            log.warning("Giving up notification %s after %d attempts: %s" % (message.id, message.attempts, exception, ))
+        else:
+            message.status = OutboxMessage.STATUS_PENDING
+            message.next_attempt_at = datetime.datetime.now() + \
+                datetime.timedelta(seconds = self.retry_delay * 2 ** (message.attempts - 1))
+            self.stats["retried"] += 1
+            log.info("Notification %s failed (attempt %d), will retry: %s" % (message.id, message.attempts, exception, ))
+        with transaction.commit_on_success():
+            message.save()
+
+    def throttle(self, count = 1):
+        """
+        Sleep as much as necessary to stay below self.rate messages per second,
+        count being the number of messages we're about to send.
+        """
+        now = time.time()
+        if self._next_send > now:
+            time.sleep(self._next_send - now)
+        self._next_send = max(now, self._next_send) + float(count) / self.rate
+
+def requeue_dead():
+    """
+    Give dead rows another chance. Return how many rows were queued again.
+    """
+    from twistranet.notifier.models import OutboxMessage
+    with transaction.commit_on_success():
+        return OutboxMessage.objects.filter(status = OutboxMessage.STATUS_DEAD).update(
+            status = OutboxMessage.STATUS_PENDING,
+            attempts = 0,
+            next_attempt_at = datetime.datetime.now(),
+        )
+
+def purge_dead(retention = None):
+    """
+    Delete dead rows older than retention seconds (default: TWISTRANET_NOTIFIER_DEAD_RETENTION).
+    Return how many rows were deleted.
+    """
+    from twistranet.notifier.models import OutboxMessage
+    if retention is None:
+        retention = _setting("TWISTRANET_NOTIFIER_DEAD_RETENTION")
+    before = datetime.datetime.now() - datetime.timedelta(seconds = retention)
+    with transaction.commit_on_success():
+        dead = OutboxMessage.objects.filter(status = OutboxMessage.STATUS_DEAD, created_at__lt = before)
+        count = dead.count()
+        dead.delete()
+    return count
+
+def get_status():
+    """
+    Number of rows per status, plus the age of the oldest pending row, in seconds.
+    """
+    from twistranet.notifier.models import OutboxMessage
+    ret = {}
+    for status, label in OutboxMessage.STATUS_CHOICES:
+        ret[status] = OutboxMessage.objects.filter(status = status).count()
+    ret["oldest_pending_seconds"] = 0
+    oldest = OutboxMessage.objects.filter(status = OutboxMessage.STATUS_PENDING).order_by("id")[:1]
+    if oldest:
+        age = datetime.datetime.now() - oldest[0].created_at
+        ret["oldest_pending_seconds"] = age.days * 86400 + age.seconds
+    return ret
@@ -10,6 +10,7 @@ from twistranet.content_types.models import *
 from twistranet.twistapp.lib.python_fixture import Fixture
 from twistranet.twistapp.lib.slugify import slugify
 from twistranet.twistapp.lib.log import *
+from twistranet.twistapp.lib.account_context import set_current_account
 from twistranet.tagging.models import *
 from django.contrib.auth.models import User
 from django.core.files import File as DjangoFile
@@ -42,7 +43,7 @@ def load_cogip():
     We didn't bother testing it with a pre-populated one as it doesn't make that much sense.
     """
     # Just to be sure, we log as system account
-    __account__ = SystemAccount.get()
+    set_current_account(SystemAccount.get())
 
     # Create tags
 
@@ -143,13 +144,13 @@ def load_cogip():
                     approved = True
                 log.debug("Put '%s' and '%s' in their network." % (username, friend))
                 current_account = UserAccount.objects.get(slug = username)
-                __account__ = UserAccount.objects.get(slug = username)
+                set_current_account(UserAccount.objects.get(slug = username))
                 friend_account = UserAccount.objects.get(slug = friend)
                 friend_account.add_to_my_network()
                 if approved:
-                    __account__ = UserAccount.objects.get(slug = friend)
+                    set_current_account(UserAccount.objects.get(slug = friend))
                     current_account.add_to_my_network()
-                __account__ = SystemAccount.objects.get()
+                set_current_account(SystemAccount.objects.get())
 
     # Create communities and join ppl from there
     f = open(os.path.join(HERE_COGIP, "communities.csv"), "rU")
@@ -183,7 +184,7 @@ def load_cogip():
     contents = csv.DictReader(f, delimiter = ';', fieldnames = ['type', 'owner', 'publisher', 'permissions', 'text', 'filename', 'tags', ])
     for content in contents:
         log.debug("Importing %s" % content)
-        __account__ = UserAccount.objects.get(slug = content['owner'])
+        set_current_account(UserAccount.objects.get(slug = content['owner']))
         if content['type'].lower() == "status":
             log.debug("Publisher: %s" % content['publisher'])
             status = StatusUpdate(
@@ -221,7 +222,7 @@ def load_cogip():
                 r.tags.add(tag)
         else:
             raise ValueError("Invalid content type: %s" % content['type'])
-        __account__ = SystemAccount.get()
+        set_current_account(SystemAccount.get())
 
     # Special stuff
     cogip_menu = MenuItem.objects.get(slug = "cogip_menu")
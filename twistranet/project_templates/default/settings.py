@@ -66,6 +66,12 @@ USE_L10N = True
 MEDIA_ROOT = os.path.join(HERE, 'www', )
 TWISTRANET_MEDIA_ROOT = os.path.join(HERE, 'var', 'upload')
 
+# Let the front server send uploaded files once twistranet has checked permissions.
+# None (files are streamed by twistranet), "x-sendfile" (Apache mod_xsendfile) or "x-accel-redirect" (nginx).
+# With nginx, TWISTRANET_SENDFILE_URL must be an 'internal' location aliasing TWISTRANET_MEDIA_ROOT.
+TWISTRANET_SENDFILE = None
+TWISTRANET_SENDFILE_URL = "/protected/"
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash if there is a path component (optional in other cases).
 # Examples: "http://media.lawrence.com", "http://example.com/media/"
@@ -97,11 +103,13 @@ _TEMPLATE_CONTEXT_PROCESSORS = (
 TEMPLATE_CONTEXT_PROCESSORS = [ a for a in _TEMPLATE_CONTEXT_PROCESSORS if a ]
 
 _MIDDLEWARE_CLASSES = (
+    'twistranet.core.middleware.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'twistranet.core.middleware.AccountContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'twistranet.core.middleware.RuntimePathsMiddleware',
@@ -133,9 +141,34 @@ TINYMCE_JS_URL = "/static/js/tiny_mce/tiny_mce.js"
 TINYMCE_JS_ROOT = "%s/static/tiny_mce" % HERE
 
 # Cache tuning
+# locmem is per-process. If your site runs several processes, use a shared backend (memcached or db):
+# network and admin membership caches are only enabled then, as their invalidation must reach all processes.
+# Set TWISTRANET_SHARED_CACHE = True if you use another shared backend.
 CACHE_BACKEND = "locmem:///"
 TWISTRANET_CACHE_USER = 60*5            # User-centric data stored for xx second
 
+# Set to True to count SQL queries and time per call site (see twistranet_profile command).
+# Needs a cache backend shared between processes to be useful.
+TWISTRANET_PROFILING = False
+
+# Set to True to queue notifications (emails...) and send them from a separate worker process,
+# so that posting to a large community doesn't wait for hundreds of emails.
+# You MUST run "./manage.py twistranet_notifier --loop" along with your server then, or nothing is sent.
+TWISTRANET_NOTIFIER_QUEUE = False
+TWISTRANET_NOTIFIER_RATE = 10           # Messages per second and per worker
+TWISTRANET_NOTIFIER_DEAD_RETENTION = 60*60*24*7         # Seconds failed notifications are kept for inspection
+
+# Users can choose to get their notifications immediately or in an hourly / daily digest.
+# Notifications about communities are grouped as well, according to this setting.
+# Digests are sent by the twistranet_notifier worker: only set TWISTRANET_NOTIFIER_DIGESTS to True
+# if "./manage.py twistranet_notifier --loop" is running (or "./manage.py twistranet_notifier" from cron).
+TWISTRANET_NOTIFIER_DIGESTS = False
+TWISTRANET_COMMUNITY_DIGEST_WINDOW = "immediate"        # "immediate", "hourly" or "daily"
+
+# Contents are ranked by a score computed by batch (likes, comments, publisher reach, age).
+# Run "./manage.py twistranet_score --loop" along with your server to keep it up to date.
+TWISTRANET_SCORE_HALF_LIFE = 60*60*48   # Scores halve every xx seconds
+
 # Twistranet default settings.
 
 # XXXXXXXXXXXX
@@ -151,6 +184,7 @@ TWISTRANET_DISPLAYED_COMMUNITY_MEMBERS = 9
 
 # Live Search behaviour
 LIVE_SEARCH_RESULTS_NUMBER = 7
+TWISTRANET_LIVE_SEARCH_CACHE = 30         # Seconds a live search response is cached for
 
 # The following lines are for default admin user created at bootstrap
 TWISTRANET_DEFAULT_ADMIN_USERNAME = "admin"
@@ -179,6 +213,9 @@ TINYMCE_DEFAULT_CONFIG = {
 THUMBNAIL_PREFIX = "cache/"
 THUMBNAIL_FORMAT = "PNG"
 THUMBNAIL_COLORSPACE = None
+# Thumbnails of new resources are rendered as they're saved. If you set this to True, they're rendered
+# out of the web server instead, and "./manage.py twistranet_thumbnails --loop" MUST be running.
+TWISTRANET_THUMBNAIL_QUEUE = False
 
 # Quickupload configuration
 QUICKUPLOAD_AUTO_UPLOAD = True
@@ -188,7 +225,8 @@ QUICKUPLOAD_SIM_UPLOAD_LIMIT = 1
 
 # Search engine (Haystack) configuration
 HAYSTACK_SITECONF = 'twistranet.search.search_sites'
-HAYSTACK_SEARCH_ENGINE = "twistranet.search.haystack_simplehack"
+HAYSTACK_SEARCH_ENGINE = "twistranet.search.fts"
+TWISTRANET_SEARCH_INDEX = os.path.join(HERE, 'var', 'search_index.sqlite')     # Rebuild it with ./manage.py twistranet_reindex
 HAYSTACK_SEARCH_RESULTS_PER_PAGE = 20
 
 # Model Translation registry module name
@@ -226,6 +264,7 @@ _INSTALLED_APPS = (
     'twistranet.twistorage',
     'twistranet.tagging',
     'twistranet.sharing',
+    'twistranet.timeline',
 
     # 3rd party modules - must be loaded AFTER TN
     'haystack',
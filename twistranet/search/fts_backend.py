@@ -0,0 +1,482 @@
+"""
+A local full-text search backend, based on SQLite's FTS5 extension.
+
+The index is an SQLite file of its own (TWISTRANET_SEARCH_INDEX), whatever your main database is:
+- 'documents' holds one row per indexed object, with its stored fields as JSON ;
+- 'fulltext' is the FTS5 table, sharing its rowids with 'documents'.
+
+Objects are indexed incrementally when they're saved or deleted (see search_indexes.py)
+and the twistranet_reindex management command rebuilds the whole index.
+Results are ranked with bm25, and only the requested page is fetched.
+
+Results can be sorted on static_score (eg. SearchQuerySet().order_by("-static_score")), which the
+scoring batch keeps up to date with update_scores().
+
+Each document also stores the security fields of its object (_access_network, _p_can_list and owner),
+so that results are filtered inside the index with the same rules as TwistableManager.get_query_set():
+hit counts and pages only include what the current account is allowed to list.
+
+A second, much smaller FTS5 table ('livesearch') only holds titles and slugs, with prefix indexes.
+It's used by live_search() for type-ahead, which returns the display data precomputed at indexing time.
+
+Use it with:
+    HAYSTACK_SEARCH_ENGINE = "twistranet.search.fts"
+    TWISTRANET_SEARCH_INDEX = "/path/to/search_index.sqlite"
+SQLite must have the FTS5 and JSON1 extensions: this is checked once, when the backend is loaded.
+"""
+import re
+import datetime
+import threading
+import sqlite3
+try:
+    # python 2.6
+    import json
+except:
+    # python 2.4 with simplejson
+    import simplejson as json
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from haystack.backends import BaseSearchBackend, BaseSearchQuery, SearchNode, log_query
+from haystack.models import SearchResult
+
+from twistranet.twistapp.lib.log import log
+
+BACKEND_NAME = 'twistranet_fts'
+
+DEFAULT_TWISTRANET_SEARCH_INDEX = ":memory:"
+
+# Bump this when changing the schema: an outdated index is dropped, and must be rebuilt with twistranet_reindex.
+SCHEMA_VERSION = 4
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        identifier TEXT NOT NULL UNIQUE,
+        django_ct TEXT NOT NULL,
+        django_id TEXT NOT NULL,
+        access_network INTEGER,
+        can_list INTEGER,
+        owner_id INTEGER,
+        static_score INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS documents_django_ct ON documents (django_ct)",
+    "CREATE INDEX IF NOT EXISTS documents_django_id ON documents (django_id)",
+    "CREATE INDEX IF NOT EXISTS documents_access_network ON documents (access_network, can_list)",
+    "CREATE INDEX IF NOT EXISTS documents_static_score ON documents (static_score)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS fulltext USING fts5(text, tokenize = 'unicode61 remove_diacritics 1')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS livesearch USING fts5(text, tokenize = 'unicode61 remove_diacritics 1', prefix = '2 3')",
+)
+
+# Indexed fields stored in their own columns (see search_indexes.TwistableIndex)
+SECURITY_FIELDS = ("access_network", "can_list", "owner_id", )
+
+# Indexed fields stored in their own columns which results can be sorted on
+SORT_FIELDS = ("static_score", )
+
+# Indexed field holding the live search text, and stored fields returned by live_search()
+LIVE_TEXT_FIELD = "live_text"
+LIVE_FIELDS = ("title", "description", "link", "thumb", "type", )
+
+WORD_REGEX = re.compile(r"\w+", re.UNICODE)
+MODELS_PREFIX = "django_ct:"
+
+_local = threading.local()
+
+def check_sqlite():
+    """
+    Raise ImproperlyConfigured if this SQLite library lacks the extensions we need.
+    """
+    connection = sqlite3.connect(":memory:")
+    try:
+        try:
+            connection.execute("CREATE VIRTUAL TABLE fulltext USING fts5(text)")
+            connection.execute("SELECT json('[]')")
+        except sqlite3.OperationalError, e:
+            raise ImproperlyConfigured(
+                "SQLite %s lacks the FTS5 or JSON1 extension needed by the twistranet search engine (%s). "
+                "Upgrade SQLite or change HAYSTACK_SEARCH_ENGINE." % (sqlite3.sqlite_version, e, )
+            )
+    finally:
+        connection.close()
+
+check_sqlite()
+
+def get_connection():
+    """
+    Return this thread's connection to the index, creating the index if necessary.
+    """
+    path = getattr(settings, "TWISTRANET_SEARCH_INDEX", DEFAULT_TWISTRANET_SEARCH_INDEX)
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    if not connections.has_key(path):
+        connection = sqlite3.connect(path, timeout = 10)
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                if connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'documents'").fetchone()[0]:
+                    log.warning("Search index %s is outdated, dropping it. Run ./manage.py twistranet_reindex to rebuild it." % (path, ))
+                    connection.execute("DROP TABLE IF EXISTS fulltext")
+                    connection.execute("DROP TABLE IF EXISTS livesearch")
+                    connection.execute("DROP TABLE IF EXISTS documents")
+                connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.execute("SELECT json('[]')")
+            connection.commit()
+        except sqlite3.OperationalError, e:
+            raise ImproperlyConfigured("Unable to create the search index in %s (SQLite needs the FTS5 and JSON1 extensions): %s" % (path, e, ))
+        connections[path] = connection
+    return connections[path]
+
+def get_content_type(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.module_name, )
+
+def get_security_filter():
+    """
+    Return an SQL condition on the documents table and its parameters,
+    restricting documents to what the current account can list.
+    This mirrors TwistableManager.get_query_set(), see twistapp/models/twistable.py.
+    """
+    from twistranet.twistapp.models import Twistable, Account, SystemAccount, Network
+    from twistranet.twistapp.lib import roles
+    account = Twistable.objects._getAuthenticatedAccount()
+    if account.id == SystemAccount.SYSTEMACCOUNT_ID:
+        return "1", []
+    if account.is_admin:
+        return "documents.can_list <= ?", [ roles.manager ]
+    if not account.is_anonymous:
+        access_network_ids = list(Network.objects.filter(target__id = account.id).values_list("client", flat = True))
+        return """(
+            (documents.owner_id = ? AND documents.can_list = ?)
+            OR (documents.access_network IN (SELECT value FROM json_each(?)) AND documents.can_list IN (?, ?))
+            OR (documents.access_network IS NULL AND documents.can_list = ?)
+        )""", [ account.id, roles.owner, json.dumps(access_network_ids), roles.network, roles.public, roles.public ]
+
+    # Anonymous: public stuff, either strictly anonymous or published by a public account.
+    # Access networks are always accounts, so we don't have to look at every public twistable.
+    free_access_network_ids = list(Account.objects.__booster__.filter(
+        _access_network__isnull = True,
+        _p_can_list = roles.public,
+    ).values_list("id", flat = True))
+    return """(
+        documents.can_list = ?
+        AND (documents.access_network IS NULL OR documents.access_network IN (SELECT value FROM json_each(?)))
+    )""", [ roles.public, json.dumps(free_access_network_ids) ]
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, )):
+        return value.isoformat()
+    if isinstance(value, (list, tuple, )):
+        return [ _json_value(v) for v in value ]
+    if value is None or isinstance(value, (bool, int, long, float, basestring, )):
+        return value
+    return unicode(value)
+
+
+class SearchBackend(BaseSearchBackend):
+
+    def get_indexed_model(self, obj_or_model):
+        """
+        Return the registered model obj_or_model is an instance (or a subclass) of, or None.
+        Twistables are indexed with the registered class, eg. a UserAccount is indexed as an Account.
+        """
+        cls = isinstance(obj_or_model, type) and obj_or_model or obj_or_model.__class__
+        indexed = self.site.get_indexed_models()
+        if cls in indexed:
+            return cls
+        for model in indexed:
+            if issubclass(cls, model):
+                return model
+        return None
+
+    def update(self, index, iterable, commit = True):
+        connection = get_connection()
+        django_ct = get_content_type(index.model)
+        content_field = None
+        for name, field in index.fields.items():
+            if field.document:
+                content_field = name
+
+        for obj in iterable:
+            try:
+                data = index.prepare(obj)
+            except:
+                log.exception("Unable to index %s" % (obj, ))
+                continue
+            text = data.pop(content_field, u"") or u""
+            if not isinstance(text, unicode):
+                text = unicode(text, errors = "ignore")
+            security = [ data.pop(k, None) for k in SECURITY_FIELDS ]
+            static_score = data.pop("static_score", 0) or 0
+            live_text = data.pop(LIVE_TEXT_FIELD, u"") or u""
+            stored = {}
+            for k, v in data.items():
+                if k in ("id", "django_ct", "django_id", ):
+                    continue
+                stored[k] = _json_value(v)
+            identifier = "%s.%s" % (django_ct, obj.pk, )
+
+            row = connection.execute("SELECT id FROM documents WHERE identifier = ?", (identifier, )).fetchone()
+            if row:
+                connection.execute(
+                    "UPDATE documents SET access_network = ?, can_list = ?, owner_id = ?, static_score = ?, data = ? WHERE id = ?",
+                    security + [ static_score, json.dumps(stored), row[0] ],
+                )
+                connection.execute("DELETE FROM fulltext WHERE rowid = ?", (row[0], ))
+                connection.execute("DELETE FROM livesearch WHERE rowid = ?", (row[0], ))
+                rowid = row[0]
+            else:
+                rowid = connection.execute(
+                    "INSERT INTO documents (identifier, django_ct, django_id, access_network, can_list, owner_id, static_score, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [ identifier, django_ct, unicode(obj.pk) ] + security + [ static_score, json.dumps(stored) ],
+                ).lastrowid
+            connection.execute("INSERT INTO fulltext (rowid, text) VALUES (?, ?)", (rowid, text, ))
+            if live_text:
+                connection.execute("INSERT INTO livesearch (rowid, text) VALUES (?, ?)", (rowid, unicode(live_text), ))
+        if commit:
+            connection.commit()
+
+    def rollback(self):
+        """
+        Forget the uncommitted changes of this thread's connection, after an error.
+        """
+        path = getattr(settings, "TWISTRANET_SEARCH_INDEX", DEFAULT_TWISTRANET_SEARCH_INDEX)
+        connection = getattr(_local, "connections", {}).get(path)
+        if connection is not None:
+            connection.rollback()
+
+    def get_security(self, obj):
+        """
+        Return the indexed (access_network, can_list) of an object, or None if it's not indexed.
+        """
+        model = self.get_indexed_model(obj)
+        if model is None:
+            return None
+        return get_connection().execute(
+            "SELECT access_network, can_list FROM documents WHERE identifier = ?",
+            ("%s.%s" % (get_content_type(model), obj.pk, ), ),
+        ).fetchone()
+
+    def update_security(self, rows, commit = True):
+        """
+        Update the security fields of already indexed objects, from (id, _access_network_id, _p_can_list) rows.
+        Used when an account's access network is propagated to its dependant objects without saving them.
+        """
+        connection = get_connection()
+        connection.executemany(
+            "UPDATE documents SET access_network = ?, can_list = ? WHERE django_id = ?",
+            [ (access_network, can_list, unicode(id)) for id, access_network, can_list in rows ],
+        )
+        if commit:
+            connection.commit()
+
+    def update_scores(self, rows, commit = True):
+        """
+        Update the static_score of already indexed objects, from (id, static_score) rows.
+        Used by the scoring batch, which doesn't save objects.
+        """
+        connection = get_connection()
+        connection.executemany(
+            "UPDATE documents SET static_score = ? WHERE django_id = ?",
+            [ (score, unicode(id)) for id, score in rows ],
+        )
+        if commit:
+            connection.commit()
+
+    def remove(self, obj_or_string, commit = True):
+        connection = get_connection()
+        if isinstance(obj_or_string, basestring):
+            identifier = obj_or_string
+        else:
+            model = self.get_indexed_model(obj_or_string)
+            if model is None:
+                return
+            identifier = "%s.%s" % (get_content_type(model), obj_or_string.pk, )
+        row = connection.execute("SELECT id FROM documents WHERE identifier = ?", (identifier, )).fetchone()
+        if row:
+            connection.execute("DELETE FROM fulltext WHERE rowid = ?", (row[0], ))
+            connection.execute("DELETE FROM livesearch WHERE rowid = ?", (row[0], ))
+            connection.execute("DELETE FROM documents WHERE id = ?", (row[0], ))
+        if commit:
+            connection.commit()
+
+    def clear(self, models = [], commit = True):
+        connection = get_connection()
+        if not models:
+            connection.execute("DELETE FROM fulltext")
+            connection.execute("DELETE FROM livesearch")
+            connection.execute("DELETE FROM documents")
+        else:
+            for model in models:
+                django_ct = get_content_type(model)
+                connection.execute("DELETE FROM fulltext WHERE rowid IN (SELECT id FROM documents WHERE django_ct = ?)", (django_ct, ))
+                connection.execute("DELETE FROM livesearch WHERE rowid IN (SELECT id FROM documents WHERE django_ct = ?)", (django_ct, ))
+                connection.execute("DELETE FROM documents WHERE django_ct = ?", (django_ct, ))
+        if commit:
+            connection.commit()
+
+    def parse_query(self, query_string):
+        """
+        Turn a query string built by SearchQuery into an FTS5 MATCH expression (or None to match everything)
+        and a list of content types (or None for all of them).
+        """
+        words = []
+        excluded = []
+        content_types = []
+        for token in query_string.split():
+            if token.startswith(MODELS_PREFIX):
+                content_types.extend(token[len(MODELS_PREFIX):].split(","))
+            elif token.startswith("-"):
+                excluded.extend(WORD_REGEX.findall(token))
+            else:
+                words.extend(WORD_REGEX.findall(token))
+        match = None
+        if words:
+            # Every word must match, as a prefix so that live search finds partial words
+            match = " AND ".join([ '"%s"*' % word for word in words ])
+            if excluded:
+                match = "(%s) NOT (%s)" % (match, " OR ".join([ '"%s"' % word for word in excluded ]), )
+        return match, content_types or None
+
+    @log_query
+    def search(self, query_string, sort_by = None, start_offset = 0, end_offset = None,
+               fields = '', highlight = False, facets = None, date_facets = None, query_facets = None,
+               narrow_queries = None, spelling_query = None,
+               limit_to_registered_models = None, **kwargs):
+        if not query_string:
+            return {'results': [], 'hits': 0, }
+        connection = get_connection()
+        match, content_types = self.parse_query(query_string)
+        if content_types is None:
+            content_types = [ get_content_type(model) for model in self.site.get_indexed_models() ]
+        if not content_types:
+            return {'results': [], 'hits': 0, }
+
+        # Build the query. Results are ranked by relevance (or by id if there's no word to look for).
+        security, security_params = get_security_filter()
+        where = [
+            "documents.django_ct IN (%s)" % ", ".join([ "?" for ct in content_types ]),
+            security,
+        ]
+        params = list(content_types) + security_params
+        if match:
+            tables = "fulltext JOIN documents ON documents.id = fulltext.rowid"
+            where.insert(0, "fulltext MATCH ?")
+            params.insert(0, match)
+            score = "-bm25(fulltext)"
+        else:
+            tables = "documents"
+            score = "0"
+        where = " AND ".join(where)
+        order_by = []
+        for field in sort_by or []:
+            if field.lstrip("-") in SORT_FIELDS:
+                order_by.append("documents.%s %s" % (field.lstrip("-"), field.startswith("-") and "DESC" or "ASC", ))
+            else:
+                log.debug("Can't sort search results on '%s'" % (field, ))
+        order_by.extend([ "score DESC", "documents.id DESC", ])
+        try:
+            hits = connection.execute("SELECT COUNT(*) FROM %s WHERE %s" % (tables, where, ), params).fetchone()[0]
+            limit = end_offset is not None and end_offset - start_offset or -1
+            rows = connection.execute(
+                "SELECT documents.django_ct, documents.django_id, documents.data, %s AS score FROM %s WHERE %s "
+                "ORDER BY %s LIMIT ? OFFSET ?" % (score, tables, where, ", ".join(order_by), ),
+                params + [ limit, start_offset ],
+            ).fetchall()
+        except sqlite3.OperationalError, e:
+            # Most probably an FTS syntax error
+            log.warning("Search failed for '%s': %s" % (query_string, e, ))
+            return {'results': [], 'hits': 0, }
+
+        results = []
+        for django_ct, django_id, data, score in rows:
+            app_label, model_name = django_ct.split(".")
+            stored = dict([ (str(k), v) for k, v in json.loads(data).items() ])
+            pk = django_id.isdigit() and int(django_id) or django_id
+            results.append(SearchResult(app_label, model_name, pk, score, **stored))
+        return {
+            'results': results,
+            'hits': hits,
+        }
+
+    def live_search(self, query_string, limit, max_hits = 100):
+        """
+        Type-ahead search on titles and slugs, for the current account.
+        Return (results, hits, more): a list of dicts with the LIVE_FIELDS keys, the number of hits,
+        and True if there are more than max_hits hits (counting stops there).
+        """
+        words = WORD_REGEX.findall(query_string)
+        if not words:
+            return [], 0, False
+        connection = get_connection()
+        security, security_params = get_security_filter()
+        tables = "livesearch JOIN documents ON documents.id = livesearch.rowid"
+        where = "livesearch MATCH ? AND %s" % security
+        params = [ " AND ".join([ '"%s"*' % word for word in words ]) ] + security_params
+        try:
+            rows = connection.execute(
+                "SELECT documents.data FROM %s WHERE %s ORDER BY livesearch.rank LIMIT ?" % (tables, where, ),
+                params + [ limit ],
+            ).fetchall()
+            if len(rows) < limit:
+                hits = len(rows)
+            else:
+                hits = connection.execute(
+                    "SELECT COUNT(*) FROM (SELECT 1 FROM %s WHERE %s LIMIT ?)" % (tables, where, ),
+                    params + [ max_hits + 1 ],
+                ).fetchone()[0]
+        except sqlite3.OperationalError, e:
+            log.warning("Live search failed for '%s': %s" % (query_string, e, ))
+            return [], 0, False
+
+        results = []
+        for (data, ) in rows:
+            data = json.loads(data)
+            results.append(dict([ (k, data.get("live_%s" % k, u"")) for k in LIVE_FIELDS ]))
+        return results, min(hits, max_hits), hits > max_hits
+
+    def prep_value(self, db_field, value):
+        return value
+
+    def more_like_this(self, model_instance, additional_query_string = None,
+                       start_offset = 0, end_offset = None,
+                       limit_to_registered_models = None, **kwargs):
+        return {
+            'results': [],
+            'hits': 0
+        }
+
+
+class SearchQuery(BaseSearchQuery):
+    """
+    Turn haystack's query tree into a flat query string for SearchBackend.parse_query:
+    words, -excluded words and a django_ct:app.model,... restriction.
+    """
+    def __init__(self, site = None, backend = None):
+        super(SearchQuery, self).__init__(backend = backend)
+
+        if backend is not None:
+            self.backend = backend
+        else:
+            self.backend = SearchBackend(site = site)
+
+    def build_query(self):
+        if not self.query_filter:
+            terms = [ '*' ]
+        else:
+            terms = self._build_sub_query(self.query_filter)
+        if self.models:
+            terms.append("%s%s" % (MODELS_PREFIX, ",".join([ get_content_type(model) for model in self.models ]), ))
+        return ' '.join(terms)
+
+    def _build_sub_query(self, search_node, negated = False):
+        terms = []
+        negated = negated != search_node.negated
+        for child in search_node.children:
+            if isinstance(child, SearchNode):
+                terms.extend(self._build_sub_query(child, negated))
+            else:
+                for word in unicode(child[1]).split():
+                    terms.append(negated and u"-%s" % word or word)
+        return terms
@@ -1,27 +1,141 @@
 import datetime
+from django.db.models import Q
+from django.db.models.signals import post_delete
 from haystack.indexes import *
 from haystack import site
 from twistranet.twistapp.models import *
+from twistranet.twistapp.signals import twistable_post_save
+from twistranet.twistapp.lib.utils import truncate
+from twistranet.twistapp.lib.log import log
 from twistranet.content_types.models import *
 
+LIVE_SEARCH_THUMBS_SIZE = u'50x50'
 
-class StatusUpdateIndex(SearchIndex):
+def get_thumb_url(picture):
+    """
+    Return the live search thumbnail url of a picture resource (or '').
+    """
+    if picture is None:
+        return u''
+    from sorl.thumbnail import default
+    # generate the thumb or just get it
+    try:
+        return default.backend.get_thumbnail(picture.image, LIVE_SEARCH_THUMBS_SIZE, crop = 'center top', ).url
+    except:
+        return picture.get_absolute_url()
+
+class TwistableIndex(SearchIndex):
+    """
+    Keep the index up to date as twistables are saved or deleted.
+    We listen to twistable_post_save rather than post_save, as it's sent once the access network is computed,
+    and we catch subclasses as well (a Comment is indexed as a StatusUpdate, a UserAccount as an Account).
+    
+    Security fields are indexed as well, so that the search backend only returns what the current account can list.
+    Live search results are computed here too (thumbnails included), so that type-ahead doesn't load any object.
+    """
+    access_network = IntegerField(model_attr = '_access_network_id', null = True)
+    can_list = IntegerField(model_attr = '_p_can_list')
+    owner_id = IntegerField(model_attr = 'owner_id')
+    static_score = IntegerField(model_attr = 'static_score')
+
+    live_text = CharField()
+    live_title = CharField(indexed = False)
+    live_description = CharField(indexed = False)
+    live_link = CharField(indexed = False)
+    live_thumb = CharField(indexed = False)
+    live_type = CharField(indexed = False)
+
+    def get_live_object(self, obj):
+        """
+        The object a live search result is displayed as: status updates are shown as their publisher.
+        """
+        if obj.model_name in ('Comment', 'StatusUpdate', ):
+            return obj.publisher
+        return obj
+
+    def prepare_live_text(self, obj):
+        # Titles and slugs, or the beginning of the text for title-less contents
+        return u" ".join([ obj.title or truncate(obj.description, 140), obj.slug or u"", ])
+
+    def prepare_live_title(self, obj):
+        return getattr(self.get_live_object(obj), 'title', u'')
+
+    def prepare_live_description(self, obj):
+        return truncate(obj.description, 140)
+
+    def prepare_live_link(self, obj):
+        return self.get_live_object(obj).get_absolute_url()
+
+    def prepare_live_thumb(self, obj):
+        return get_thumb_url(self.get_live_object(obj).forced_picture)
+
+    def prepare_live_type(self, obj):
+        return obj.model_name
+
+    def index_queryset(self):
+        # Index everything, whatever the current user is allowed to see
+        return self.model.objects.__booster__.all()
+
+    def _setup_save(self, model):
+        twistable_post_save.connect(self._twistable_saved, weak = False)
+
+    def _setup_delete(self, model):
+        post_delete.connect(self._twistable_deleted, weak = False)
+
+    def _twistable_saved(self, sender, instance, **kwargs):
+        if not isinstance(instance, self.model):
+            return
+        # The index must never prevent an object from being saved (eg. when it's locked by another process).
+        # twistranet_reindex repairs it.
+        try:
+            # Saving an account changes the access network of its dependant objects only if its own security changed.
+            # A new account doesn't have any dependant object yet.
+            propagate = False
+            if isinstance(instance, Account) and not kwargs.get("created") and hasattr(self.backend, "update_security"):
+                propagate = self.backend.get_security(instance) != (instance._access_network_id, instance._p_can_list, )
+            self.update_object(instance)
+            if propagate:
+                self.backend.update_security(Twistable.objects.__booster__.filter(
+                    Q(_access_network__id = instance.id) | Q(publisher = instance.id),
+                ).exclude(id = instance.id).values_list("id", "_access_network", "_p_can_list"))
+        except:
+            log.exception("Unable to index %s, run ./manage.py twistranet_reindex to repair the search index." % (instance, ))
+            self._rollback()
+
+    def _twistable_deleted(self, sender, instance, **kwargs):
+        if not isinstance(instance, self.model):
+            return
+        try:
+            self.remove_object(instance)
+        except:
+            log.exception("Unable to remove %s from the search index, run ./manage.py twistranet_reindex to repair it." % (instance, ))
+            self._rollback()
+
+    def _rollback(self):
+        if hasattr(self.backend, "rollback"):
+            try:
+                self.backend.rollback()
+            except:
+                log.exception("Unable to roll back the search index")
+
+
+class StatusUpdateIndex(TwistableIndex):
     searchable_text = CharField(document = True, use_template = True)
-    author = CharField(model_attr = 'author')
+    owner = CharField(model_attr = 'owner')
     created_at = DateTimeField(model_attr = 'created_at')
 
+    def index_queryset(self):
+        return super(StatusUpdateIndex, self).index_queryset().select_related("publisher")
+
 site.register(StatusUpdate, StatusUpdateIndex)
 
-class AccountIndex(SearchIndex):
+class AccountIndex(TwistableIndex):
     searchable_text = CharField(document = True, use_template = True)
 
 site.register(Account, AccountIndex)
 
 
-class DocumentIndex(SearchIndex):
+class DocumentIndex(TwistableIndex):
     searchable_text = CharField(document = True, use_template = True)
 
 site.register(Document, DocumentIndex)
-
-
-
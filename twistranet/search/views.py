@@ -2,7 +2,9 @@
 The magnifiscent TN searching stuff.
 Uses haystack.
 """
+import hashlib
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext as _
 from haystack.views import SearchView
 from django.http import HttpResponse, HttpResponseRedirect
@@ -11,6 +13,7 @@ from django.http import Http404
 from django.core.paginator import Paginator, InvalidPage
 from twistranet.core.views import BaseView, MustRedirect
 from twistranet.twistapp.lib.utils import truncate
+from twistranet.search.search_indexes import get_thumb_url
 
 try:
     #python 2.6
@@ -21,7 +24,11 @@ except:
 
 RESULTS_PER_PAGE = settings.HAYSTACK_SEARCH_RESULTS_PER_PAGE
 LIVE_SEARCH_RESULTS_NUMBER = settings.LIVE_SEARCH_RESULTS_NUMBER
-LIVE_SEARCH_THUMBS_SIZE = u'50x50'
+LIVE_SEARCH_MAX_HITS = 100              # We stop counting live search results here
+
+# Live search responses are cached for this number of seconds (per account),
+# so that typing back and forth doesn't search again.
+DEFAULT_TWISTRANET_LIVE_SEARCH_CACHE = 30
 
 
 class TwistraNetSearchView(BaseView):
@@ -104,9 +111,38 @@ class TwistraNetJSONSearchView(BaseView):
         must overload the standard
         twistranet render_view
         """
-        data = self.basic_search(self.request)
-        return HttpResponse( json.dumps(data),
-                             mimetype='text/plain')
+        query = self.request.GET.get('q', u'').strip()
+        cache_time = getattr(settings, "TWISTRANET_LIVE_SEARCH_CACHE", DEFAULT_TWISTRANET_LIVE_SEARCH_CACHE)
+        cache_key = "live_search#%s#%s" % (self.auth.id, hashlib.md5(query.encode('utf-8')).hexdigest(), )
+        data = cache.get(cache_key)
+        if data is None:
+            data = self.live_search(query)
+            cache.set(cache_key, data, cache_time)
+        response = HttpResponse(json.dumps(data), mimetype='text/plain')
+        response['Cache-Control'] = 'private, max-age=%d' % cache_time
+        return response
+
+    def live_search(self, query):
+        """
+        Use the search backend's type-ahead index if it has one, and fall back to a regular search otherwise.
+        The query is sent back so that the client can ignore late responses.
+        """
+        from haystack import backend
+        search_backend = backend.SearchBackend()
+        if not query:
+            return {'results': [], 'query': query, }
+        if not hasattr(search_backend, 'live_search'):
+            data = self.basic_search(self.request)
+            data['query'] = query
+            return data
+
+        results, nb_results, estimated = search_backend.live_search(query, LIVE_SEARCH_RESULTS_NUMBER, LIVE_SEARCH_MAX_HITS)
+        complete_data = {'results': results, 'has_more_results': False, 'query': query, }
+        if nb_results > LIVE_SEARCH_RESULTS_NUMBER:
+            complete_data['has_more_results'] = True
+            complete_data['all_results_url'] = '/search?q=%s' % query
+            complete_data['all_results_text'] = _(u'All results') + ' (%s%i)' % (estimated and '+' or '', nb_results, )
+        return complete_data
     
     def basic_search(self, request, load_all=True, form_class=ModelSearchForm, searchqueryset=None, ):
         """
@@ -128,7 +164,6 @@ class TwistraNetJSONSearchView(BaseView):
         else:
             return {'results' : [] }
         
-        nb_results = len(results)
         data = []
         for res in results[:LIVE_SEARCH_RESULTS_NUMBER]:
             o = {}
@@ -148,19 +183,11 @@ class TwistraNetJSONSearchView(BaseView):
                     o['title'] = getattr(res_obj, 'title', u'')
                     o['link'] = res_obj.get_absolute_url()
                     picture = res_obj.forced_picture
-
-                if picture is not None:
-                    from sorl.thumbnail import default
-                    # generate the thumb or just get it
-                    try:
-                        thumb = default.backend.get_thumbnail( picture.image, LIVE_SEARCH_THUMBS_SIZE, crop='center top', )
-                        o['thumb'] = thumb.url 
-                    except:
-                        o['thumb'] = picture.get_absolute_url()
-                else:
-                    o['thumb'] = ''  
+                o['thumb'] = get_thumb_url(picture)
                 data.append(o)
                 
+        # Results are sliced first, so that the hit count comes with the page
+        nb_results = len(results)
         complete_data = {'results' : data, 'has_more_results' : False }
         if nb_results > LIVE_SEARCH_RESULTS_NUMBER:
             complete_data['has_more_results'] = True
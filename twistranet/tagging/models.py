@@ -1,20 +1,39 @@
 """
 Models for the 'tag' object used by twistranet.
+
+Tags are looked up through an index kept up to date by signals:
+- TagWord holds the normalized words of each tag title, for prefix lookups (autocomplete) ;
+- TagUsage counts how many twistables bear each tag (popular tags, autocomplete ordering) ;
+- TagExpert holds the expert score of each user account on each tag (see Tag.get_experts).
+Rebuild them with ./manage.py twistranet_tags.
 """
+import unicodedata
 from django.db import models
-from django.db.models import Avg, Max, Min, Count
+from django.db.models import Avg, Max, Min, Count, F
+from django.db.models.signals import m2m_changed, pre_delete
 
 from twistranet.twistapp.models import Twistable
+from twistranet.twistapp.signals import twistable_post_save
 from twistranet.twistapp.lib import permissions   
 from twistranet.twistapp.models import fields
 
 
 # Default tagging settings.
 # XXX TODO: Move this somewhere else
-DEFAULT_EXPERTS_COUNT = 18              # Max experts fetched by default. The greater, the slower.
+DEFAULT_EXPERTS_COUNT = 18              # Max experts fetched by default.
 USERACCOUNT_TAG_EXPERT_FACTOR = 5       # Users bearing a tag are scored USER_TAG_EXPERT_FACTOR-times more (float).
 CONTRIBUTOR_TAG_EXPERT_FACTOR = 0.5     # Users contributing to existing content are scored CONTRIBUTOR_TAG_EXPERT_FACTOR-times more (or less).
                                         # Default tag factor is the contributor status: everytime a user contributes a content, it scores 1.
+DEFAULT_POPULAR_TAGS_COUNT = 20
+TAG_WORD_MAX_LENGTH = 64
+
+def normalize(text):
+    """
+    Return the list of normalized words of text: lower case, without accents.
+    """
+    text = unicodedata.normalize("NFKD", unicode(text)).lower()
+    text = u"".join([ c for c in text if not unicodedata.combining(c) ])
+    return [ word[:TAG_WORD_MAX_LENGTH] for word in text.split() ]
 
 class Tag(Twistable):
     """
@@ -53,43 +72,280 @@ class Tag(Twistable):
         Return experts on the given tag (as a LIST of no more than max_count users on the specified field).
         The first item in the returned list scores MORE than the second, and so on.
         Score is returned as the 'score' property of each underlying object.
-        XXX TODO: Have this carefuly cached!
+        
+        Scores are precomputed in the TagExpert table: users bearing the tag score USERACCOUNT_TAG_EXPERT_FACTOR,
+        each content they own with this tag scores 1 and each content they own in an account bearing this tag
+        scores CONTRIBUTOR_TAG_EXPERT_FACTOR.
         """
         from twistranet.twistapp.models import UserAccount
-        
-        # Ppl who set it as their own tag
-        # XXX TODO: Find a clever sorting key. Most active? Last activity?
-        user_experts = UserAccount.objects.filter(tags__id = self.id).\
-            extra(select = {"by__count": 1})[:max_count]
-        
-        # Ppl who contributed on it
-        content_experts = UserAccount.objects.filter(by__tags__id = self.id).\
-            annotate(Count('by')).order_by("-by__count")[:max_count]
-        
-        # Ppl who contributed to communities bearing this tag
-        contributor_experts = UserAccount.objects.filter(by__publisher__tags = self.id).\
-            annotate(Count('by')).order_by("-by__count")[:max_count]
-        
-        # Now let's aggregate all this...
-        ret_dict = {}
-        for lst, score_attr, factor in [
-            (user_experts, "by__count", USERACCOUNT_TAG_EXPERT_FACTOR),
-            (content_experts, "by__count", 1),
-            (contributor_experts, "by__count", CONTRIBUTOR_TAG_EXPERT_FACTOR),
-            ]:
-            for useraccount in lst:
-                uid = useraccount.id
-                if not ret_dict.has_key(uid):
-                    ret_dict[uid] = [0, useraccount, ]
-                ret_dict[uid][0] += getattr(useraccount, score_attr) * factor
-            
-        # ...and return a pretty list.
-        dictitems = ret_dict.items()
-        dictitems.sort(lambda x,y: cmp(y[1], x[1]))
+        cache = getattr(self, "_experts_cache", None)
+        if cache is None:
+            cache = self._experts_cache = {}
+        if not cache.has_key(max_count):
+            scores = list(TagExpert.objects.filter(tag = self.id, score__gt = 0).order_by("-score").values_list("account", "score")[:max_count])
+            accounts = UserAccount.objects.in_bulk([ account_id for account_id, score in scores ])
+            ret = []
+            for account_id, score in scores:
+                if accounts.has_key(account_id):
+                    u = accounts[account_id]
+                    u.score = score
+                    ret.append(u)
+            cache[max_count] = ret
+        return cache[max_count]
+
+    @classmethod
+    def search(cls, search_string, max_count = 20):
+        """
+        Return tags which have a word starting with each word of search_string, most used first.
+        Lookups are index range scans on TagWord, whatever the number of tags.
+        """
+        words = normalize(search_string)
+        if not words:
+            return cls.objects.none()
+        qs = cls.objects.all()
+        for word in words:
+            qs = qs.filter(words__word__gte = word, words__word__lt = word + u"\uffff")
+        if len(words) > 1:
+            qs = qs.distinct()
+        return qs.order_by("-usage__count", "title")[:max_count]
+
+    @classmethod
+    def get_popular(cls, max_count = DEFAULT_POPULAR_TAGS_COUNT):
+        """
+        Return the most used tags, as a list. Each tag gets its usage as the 'count' property.
+        """
         ret = []
-        for i in dictitems:
-            u = i[1][1]
-            u.score = i[1][0]
-            ret.append(u)
+        for usage in TagUsage.objects.filter(count__gt = 0).select_related("tag").order_by("-count")[:max_count]:
+            usage.tag.count = usage.count
+            ret.append(usage.tag)
         return ret
 
+
+class TagWord(models.Model):
+    """
+    A normalized word of a tag title.
+    """
+    tag = models.ForeignKey(Tag, related_name = "words")
+    word = models.CharField(max_length = TAG_WORD_MAX_LENGTH, db_index = True)
+
+    class Meta:
+        app_label = 'twistapp'
+        unique_together = ("tag", "word", )
+
+
+class TagUsage(models.Model):
+    """
+    Number of twistables bearing a tag.
+    """
+    tag = models.OneToOneField(Tag, primary_key = True, related_name = "usage")
+    count = models.PositiveIntegerField(default = 0, db_index = True)
+
+    class Meta:
+        app_label = 'twistapp'
+
+
+class TagExpert(models.Model):
+    """
+    Expert score of a user account on a tag.
+    """
+    tag = models.ForeignKey(Tag, related_name = "expert_scores")
+    account = models.ForeignKey("UserAccount", related_name = "tag_expert_scores")
+    score = models.FloatField(default = 0)
+
+    class Meta:
+        app_label = 'twistapp'
+        unique_together = ("tag", "account", )
+
+
+#                                                   #
+#               Tag index maintenance               #
+#                                                   #
+
+def index_tag(tag):
+    """
+    (Re)build the words of a tag, and make sure it has a usage counter.
+    """
+    words = set(normalize(tag.title))
+    existing = set(TagWord.objects.filter(tag = tag).values_list("word", flat = True))
+    TagWord.objects.filter(tag = tag, word__in = existing - words).delete()
+    for word in words - existing:
+        TagWord.objects.create(tag = tag, word = word)
+    if not TagUsage.objects.filter(tag = tag).exists():
+        TagUsage.objects.create(tag = tag, count = Twistable.tags.through.objects.filter(tag = tag).count())
+
+def count_tags(tag_ids = None):
+    """
+    Recompute usage counters of the given tags (or all of them) from the tags relation.
+    """
+    links = Twistable.tags.through.objects.all()
+    if tag_ids is None:
+        tag_ids = Tag.objects.values_list("id", flat = True)
+    else:
+        links = links.filter(tag__in = tag_ids)
+    counts = dict(links.values_list("tag").annotate(Count("id")).order_by())
+    for tag_id in tag_ids:
+        if not TagUsage.objects.filter(tag = tag_id).update(count = counts.get(tag_id, 0)):
+            TagUsage.objects.create(tag_id = tag_id, count = counts.get(tag_id, 0))
+
+def increment_tags(deltas):
+    """
+    Apply a {tag_id: delta} dict to usage counters.
+    """
+    for tag_id, delta in deltas.items():
+        if not delta:
+            continue
+        if not TagUsage.objects.filter(tag = tag_id).update(count = F("count") + delta):
+            count_tags([ tag_id ])
+
+def compute_experts(tag_ids = None):
+    """
+    Recompute expert scores of the given tags (or all of them) from scratch. Return the number of scores.
+    Each kind of contribution is counted with a single aggregate query for all tags.
+    """
+    from twistranet.twistapp.models import UserAccount
+    through = Twistable.tags.through
+    bearers = through.objects.all()
+    contents = Twistable.objects.__booster__.filter(tags__isnull = False)
+    contributions = Twistable.objects.__booster__.filter(publisher__tags__isnull = False)
+    if tag_ids is not None:
+        bearers = bearers.filter(tag__in = tag_ids)
+        contents = contents.filter(tags__in = tag_ids)
+        contributions = contributions.filter(publisher__tags__in = tag_ids)
+
+    scores = {}
+    for tag_id, twistable_id in bearers.values_list("tag", "twistable"):
+        scores[(tag_id, twistable_id)] = scores.get((tag_id, twistable_id), 0) + USERACCOUNT_TAG_EXPERT_FACTOR
+    for lst, factor in [
+        (contents.values_list("tags", "owner").annotate(Count("id")).order_by(), 1),
+        (contributions.values_list("publisher__tags", "owner").annotate(Count("id")).order_by(), CONTRIBUTOR_TAG_EXPERT_FACTOR),
+        ]:
+        for tag_id, account_id, count in lst:
+            scores[(tag_id, account_id)] = scores.get((tag_id, account_id), 0) + count * factor
+
+    # Only user accounts can be experts. Bearers which aren't accounts get filtered out here as well.
+    user_ids = set(UserAccount.objects.__booster__.values_list("id", flat = True))
+    experts = TagExpert.objects.all()
+    if tag_ids is not None:
+        experts = experts.filter(tag__in = tag_ids)
+    experts.delete()
+    n_scores = 0
+    for (tag_id, account_id), score in scores.items():
+        if account_id in user_ids and score > 0:
+            TagExpert.objects.create(tag_id = tag_id, account_id = account_id, score = score)
+            n_scores += 1
+    return n_scores
+
+def get_expert_deltas(links, sign):
+    """
+    Return the {(tag_id, account_id): score delta} dict of adding (sign = 1) or removing (sign = -1)
+    the given (twistable_id, tag_id) links.
+    """
+    from twistranet.twistapp.models import Account, UserAccount
+    twistable_ids = set([ twistable_id for twistable_id, tag_id in links ])
+    owners = dict(Twistable.objects.__booster__.filter(id__in = twistable_ids).values_list("id", "owner"))
+    account_ids = set(Account.objects.__booster__.filter(id__in = twistable_ids).values_list("id", flat = True))
+    user_ids = set(UserAccount.objects.__booster__.filter(id__in = account_ids).values_list("id", flat = True))
+    deltas = {}
+    def add(key, delta):
+        deltas[key] = deltas.get(key, 0) + sign * delta
+    for twistable_id, tag_id in links:
+        if twistable_id in user_ids:
+            add((tag_id, twistable_id), USERACCOUNT_TAG_EXPERT_FACTOR)
+        elif owners.has_key(twistable_id):
+            add((tag_id, owners[twistable_id]), 1)
+        if twistable_id in account_ids:
+            # Everybody who contributed to this account becomes a (small) expert
+            contributors = Twistable.objects.__booster__.filter(publisher = twistable_id).exclude(id = twistable_id)
+            for owner_id, count in contributors.values_list("owner").annotate(Count("id")).order_by():
+                add((tag_id, owner_id), count * CONTRIBUTOR_TAG_EXPERT_FACTOR)
+    return deltas
+
+def increment_experts(deltas):
+    """
+    Apply a {(tag_id, account_id): delta} dict to expert scores. Accounts which aren't user accounts are ignored.
+    """
+    from twistranet.twistapp.models import UserAccount
+    deltas = dict([ (k, v) for k, v in deltas.items() if v ])
+    if not deltas:
+        return
+    user_ids = set(UserAccount.objects.__booster__.filter(
+        id__in = set([ account_id for tag_id, account_id in deltas.keys() ]),
+    ).values_list("id", flat = True))
+    for (tag_id, account_id), delta in deltas.items():
+        if account_id not in user_ids:
+            continue
+        if not TagExpert.objects.filter(tag = tag_id, account = account_id).update(score = F("score") + delta):
+            if delta > 0:
+                TagExpert.objects.create(tag_id = tag_id, account_id = account_id, score = delta)
+
+def get_contribution_deltas(twistable, sign):
+    """
+    Score deltas of creating (sign = 1) or deleting (sign = -1) a twistable in its publisher.
+    """
+    if not twistable.publisher_id or twistable.publisher_id == twistable.id:
+        return {}
+    return dict([
+        ((tag_id, twistable.owner_id), sign * CONTRIBUTOR_TAG_EXPERT_FACTOR)
+        for tag_id in Twistable.tags.through.objects.filter(twistable = twistable.publisher_id).values_list("tag", flat = True)
+    ])
+
+def tag_saved(sender, instance, created = False, **kwargs):
+    if isinstance(instance, Tag):
+        index_tag(instance)
+    elif created:
+        increment_experts(get_contribution_deltas(instance, 1))
+
+def tags_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Maintain usage counters and expert scores as tags are added to / removed from twistables, from either side of the relation.
+    Only links which actually exist are counted when removing (Django sends the requested pk_set).
+    """
+    through = Twistable.tags.through
+    if reverse:
+        # instance is a Tag, pk_set are twistable ids
+        links = through.objects.filter(tag = instance.id)
+        side = "twistable__in"
+    else:
+        links = through.objects.filter(twistable = instance.id)
+        side = "tag__in"
+
+    if action == "pre_remove":
+        instance._removed_tag_links = list(links.filter(**{side: pk_set}).values_list("twistable", "tag"))
+        return
+    elif action == "pre_clear":
+        instance._removed_tag_links = list(links.values_list("twistable", "tag"))
+        return
+    elif action in ("post_remove", "post_clear", ):
+        changed = getattr(instance, "_removed_tag_links", [])
+        instance._removed_tag_links = []
+        sign = -1
+    elif action == "post_add":
+        # pk_set only holds new links here
+        if reverse:
+            changed = [ (twistable_id, instance.id) for twistable_id in pk_set ]
+        else:
+            changed = [ (instance.id, tag_id) for tag_id in pk_set ]
+        sign = 1
+    else:
+        return
+
+    usage = {}
+    for twistable_id, tag_id in changed:
+        usage[tag_id] = usage.get(tag_id, 0) + sign
+    increment_tags(usage)
+    increment_experts(get_expert_deltas(changed, sign))
+
+def twistable_deleted(sender, instance, **kwargs):
+    """
+    Deleting a twistable deletes its tag links without sending m2m_changed.
+    """
+    links = [ (instance.id, tag_id) for tag_id in Twistable.tags.through.objects.filter(twistable = instance.id).values_list("tag", flat = True) ]
+    increment_tags(dict([ (tag_id, -1) for twistable_id, tag_id in links ]))
+    deltas = get_expert_deltas(links, -1)
+    for key, delta in get_contribution_deltas(instance, -1).items():
+        deltas[key] = deltas.get(key, 0) + delta
+    increment_experts(deltas)
+
+twistable_post_save.connect(tag_saved, weak = False)
+m2m_changed.connect(tags_changed, sender = Twistable.tags.through, weak = False)
+pre_delete.connect(twistable_deleted, sender = Twistable, weak = False)
@@ -38,15 +38,8 @@ class SearchTagsJSON(BaseView):
         """
         Prepare JSON rendering.
         """
-        # Inefficient search method
-        search_string = self.request.GET['tag'].strip()
-        if not search_string:
-            q = Tag.objects.empty()
-        else:
-            q = Tag.objects.filter(title__icontains = search_string)
-        
-        # Format message
-        q = q.order_by("title")[:self.search_limit].values("title", "id")
+        # Prefix lookup in the tag index, most used tags first
+        q = Tag.search(self.request.GET['tag'], self.search_limit).values("title", "id")
         msg = [ { "caption": flat['title'], "value": str(flat["id"]) } for flat in q ]
         
         # Return response
@@ -63,12 +56,14 @@ class TagView(BaseIndividualView):
     context_boxes = [
         "tags/tag.box.html",
         "tags/experts.box.html",
+        "tags/popular.box.html",
     ]
     template = "tags/view.html"
     template_variables = BaseIndividualView.template_variables + [
         "tag",
         "page",
         "paginator",
+        "popular_tags",
     ]
     model_lookup = Tag
     name = "tag_by_id"
@@ -97,7 +92,9 @@ class TagView(BaseIndividualView):
             page = paginator.page(int(self.request.GET.get('page', 1)))
         except InvalidPage:
             raise Http404("No such page of results!")
+        page.object_list = page.object_list.as_concrete()
         self.page = page
-        self.paginator = paginator  
+        self.paginator = paginator
+        self.popular_tags = Tag.get_popular()  
 
 
@@ -10,6 +10,7 @@ var defaultDialogMessage = '';
 var curr_url = window.location.href;
 // live searchbox disparition effect
 var ls_hide_effect_speed = 300;
+var liveSearchTerm = '';
 var reset_reload_timeout = 0;
 
 // helpers
@@ -126,10 +127,13 @@ liveSearch = function(searchTerm) {
     livesearchurl = home_url + 'search/json' ;
     var liveResults = jq('#search-live-results');
     var nores_text = jq('#no-results-text').val();
+    liveSearchTerm = searchTerm;
     if (searchTerm) {
-      jq.get(livesearchurl+'?q='+searchTerm, 
+      jq.get(livesearchurl, {q: searchTerm},
           function(data) {
               jsondata = eval( "(" + data + ")" );
+              // ignore responses to previous keystrokes
+              if (jsondata.query != jq.trim(liveSearchTerm)) return;
               results = jsondata.results;
               liveResults.hide();
               liveResults.html('');
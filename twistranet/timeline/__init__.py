@@ -0,0 +1,8 @@
+"""
+Home timeline store.
+
+Instead of computing the followed content of an account on each homepage view,
+we push the id of each new content into a bounded inbox of every account following its publisher
+('fan-out on write'). Publishers with too many followers are read at display time instead
+('fan-out on read').
+"""
@@ -0,0 +1,163 @@
+"""
+Timeline inbox models and the signal handlers that maintain them.
+
+TimelineEntry is the per-account inbox. It is NOT secured: it only lists candidate content,
+visibility is checked again with the secured Content manager when a page is read.
+"""
+from django.db import models, connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
+
+from twistranet.twistapp.models import Twistable, Account, UserAccount, Content, Network
+from twistranet.twistapp.signals import twistable_post_save
+from twistranet.twistapp.lib.log import log
+
+# Default timeline settings. Override them in your settings.py.
+DEFAULT_TWISTRANET_TIMELINE_SIZE = 1000             # Max. entries kept in each inbox.
+DEFAULT_TWISTRANET_TIMELINE_FANOUT_LIMIT = 2000     # Publishers with more followers than that are read on display instead.
+DEFAULT_TWISTRANET_TIMELINE_BACKFILL = 50           # Content of a publisher pushed to an account when it starts following it.
+
+def _setting(name):
+    return getattr(settings, name, globals()["DEFAULT_%s" % name])
+
+class TimelineEntry(models.Model):
+    """
+    'content' appears on the timeline of 'account'.
+    """
+    account = models.ForeignKey(Account, related_name = "+", db_index = True, )
+    content = models.ForeignKey(Content, related_name = "+", db_index = True, )
+
+    class Meta:
+        app_label = 'twistapp'
+        unique_together = ("account", "content", )
+
+class FanOutOnReadPublisher(models.Model):
+    """
+    Publishers whose content is not pushed to inboxes but merged when the timeline is read.
+    """
+    publisher = models.OneToOneField(Account, related_name = "+", )
+
+    class Meta:
+        app_label = 'twistapp'
+
+
+#                                                                               #
+#                                   Reading                                     #
+#                                                                               #
+
+def get_timeline(account):
+    """
+    Return the secured Content queryset of the given account's timeline.
+    Order it yourself.
+    """
+    inbox = TimelineEntry.objects.filter(account__id = account.id).values_list("content", flat = True)
+    broadcasters = FanOutOnReadPublisher.objects.filter(
+        publisher__requesting_network__client__id = account.id,
+    ).values_list("publisher", flat = True)
+    return Content.objects.filter(
+        Q(id__in = inbox) | Q(publisher__in = broadcasters)
+    ).exclude(model_name = "Comment")
+
+def trim(account_id, size = None):
+    """
+    Keep only the 'size' most recent entries of the given inbox.
+    This is a write, so it's not done when timelines are read: run './manage.py twistranet_timeline trim' periodically.
+    """
+    if size is None:
+        size = _setting("TWISTRANET_TIMELINE_SIZE")
+    oldest = TimelineEntry.objects.filter(account__id = account_id).order_by("-content").values_list("content", flat = True)[size:size + 1]
+    if oldest:
+        TimelineEntry.objects.filter(account__id = account_id, content__id__lte = oldest[0]).delete()
+
+
+#                                                                               #
+#                                   Writing                                     #
+#                                                                               #
+
+def _insert_entries(rows):
+    """
+    Insert (account_id, content_id) rows in a single executemany() call.
+    """
+    if not rows:
+        return
+    cursor = connection.cursor()
+    cursor.executemany(
+        "INSERT INTO %s (account_id, content_id) VALUES (%%s, %%s)" % TimelineEntry._meta.db_table,
+        rows,
+    )
+    transaction.commit_unless_managed()
+
+def fan_out(content):
+    """
+    Push the given content to the inbox of every UserAccount following its publisher.
+    This is a single INSERT ... SELECT statement, whatever the number of followers.
+    """
+    publisher_id = content.publisher_id
+    if not publisher_id:
+        return
+    if Network.objects.filter(target__id = publisher_id).count() > _setting("TWISTRANET_TIMELINE_FANOUT_LIMIT"):
+        FanOutOnReadPublisher.objects.get_or_create(publisher = Account.objects.__booster__.get(id = publisher_id))
+        return
+    cursor = connection.cursor()
+    cursor.execute(
+        "INSERT INTO %(entry)s (account_id, content_id) "
+        "SELECT n.client_id, %%s FROM %(network)s n INNER JOIN %(twistable)s t ON t.id = n.client_id "
+        "WHERE n.target_id = %%s AND t.model_name = %%s" % {
+            "entry":        TimelineEntry._meta.db_table,
+            "network":      Network._meta.db_table,
+            "twistable":    Twistable._meta.db_table,
+        },
+        [content.id, publisher_id, UserAccount._meta.object_name, ],
+    )
+    transaction.commit_unless_managed()
+
+def backfill(account_id, publisher_ids = None, size = None):
+    """
+    Push the latest followed content into the given inbox.
+    If publisher_ids is None, all publishers the account follows are used.
+    Already present entries are kept.
+    """
+    if size is None:
+        size = _setting("TWISTRANET_TIMELINE_SIZE")
+    flt = Content.objects.__booster__.exclude(model_name = "Comment")
+    if publisher_ids is None:
+        flt = flt.filter(Q(publisher__requesting_network__client__id = account_id) | Q(publisher__id = account_id))
+    else:
+        flt = flt.filter(publisher__id__in = publisher_ids)
+    content_ids = list(flt.order_by("-id").values_list("id", flat = True).distinct()[:size])
+    existing = set(TimelineEntry.objects.filter(account__id = account_id, content__id__in = content_ids).values_list("content", flat = True))
+    _insert_entries([ (account_id, content_id) for content_id in content_ids if content_id not in existing ])
+
+
+#                                                                               #
+#                               Signal handlers                                 #
+#                                                                               #
+
+def content_saved(sender, instance, created, **kw):
+    """
+    Fan out newly created content
+    """
+    if not created or not issubclass(sender, Content) or instance.model_name == "Comment":
+        return
+    fan_out(instance)
+
+def network_saved(sender, instance, created, **kw):
+    """
+    The client now follows the target: push the target's latest content to the client.
+    """
+    if created and UserAccount.objects.__booster__.filter(id = instance.client_id).exists():
+        backfill(instance.client_id, [ instance.target_id ], _setting("TWISTRANET_TIMELINE_BACKFILL"))
+
+def network_deleted(sender, instance, **kw):
+    """
+    The client doesn't follow the target anymore: remove the target's content from the client's inbox.
+    """
+    TimelineEntry.objects.filter(
+        account__id = instance.client_id,
+        content__publisher__id = instance.target_id,
+    ).delete()
+
+twistable_post_save.connect(content_saved, weak = False)
+post_save.connect(network_saved, sender = Network, weak = False)
+post_delete.connect(network_deleted, sender = Network, weak = False)
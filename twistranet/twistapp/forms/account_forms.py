@@ -33,14 +33,23 @@ class UserAccountForm(BaseForm):
         required = False,
         queryset = Tag.objects.all(),
     )
-
+    
     class Meta:
         model = UserAccount
-        fields = ('title', 'description', 'tags', 'picture', )
+        fields = ('title', 'description', 'tags', 'picture', 'notification_window', )
         widgets = {
             "picture":          ResourceWidget(),
         }
 
+    def __init__(self, *args, **kw):
+        """
+        Digests are only offered if they're actually sent (see twistranet.notifier.digest).
+        """
+        super(UserAccountForm, self).__init__(*args, **kw)
+        from twistranet.notifier import digest
+        if not digest.is_enabled():
+            del self.fields['notification_window']
+
 class UserAccountCreationForm(forms.Form):
     """
     User Creation form.
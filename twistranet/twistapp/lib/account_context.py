@@ -0,0 +1,99 @@
+"""
+Request-scoped "current account" context.
+
+This is where the security model reads the authenticated account from.
+The AccountContextMiddleware binds the current request here, and code that needs
+to act on behalf of another account (usually SystemAccount) pushes it with as_account():
+
+    with as_account(SystemAccount.get()):
+        glob.save()
+
+Storage is thread-local. Only the functions below should touch it, so that
+the storage backend can be swapped later without changing call sites.
+"""
+import threading
+from contextlib import contextmanager
+
+__all__ = [
+    "get_current_account", "set_current_account", "as_account",
+    "get_current_request", "set_current_request", "clear",
+    "get_request_cache", "invalidate_request_caches",
+]
+
+_context = threading.local()
+
+def _stack():
+    stack = getattr(_context, 'accounts', None)
+    if stack is None:
+        stack = _context.accounts = []
+    return stack
+
+def get_current_account():
+    """
+    Return the account explicitly pushed on the context, or None.
+    """
+    stack = _stack()
+    if stack:
+        return stack[-1]
+    return None
+
+def set_current_account(account):
+    """
+    Replace the innermost account of the context.
+    Passing None removes it (so that the request account, if any, applies again).
+    """
+    stack = _stack()
+    if stack:
+        stack.pop()
+    if account is not None:
+        stack.append(account)
+
+@contextmanager
+def as_account(account):
+    """
+    Act as the given account inside the 'with' block.
+    The previous account is restored on exit, even if an exception is raised.
+    """
+    stack = _stack()
+    stack.append(account)
+    try:
+        yield account
+    finally:
+        stack.pop()
+
+def get_current_request():
+    return getattr(_context, 'request', None)
+
+def set_current_request(request):
+    _context.request = request
+
+def get_request_cache(name):
+    """
+    Return a dict which lives as long as the current request, or None outside a request.
+    Use it to memoize values which are stable for the duration of a request
+    (permission checks, for example). Outside a request (scripts, fixtures, tests),
+    nothing tells us when to forget the values, so we don't cache at all.
+    """
+    if getattr(_context, 'request', None) is None:
+        return None
+    caches = getattr(_context, 'caches', None)
+    if caches is None:
+        caches = _context.caches = {}
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches[name] = {}
+    return cache
+
+def invalidate_request_caches():
+    """
+    Forget every request-scoped cached value. Call this when security-related data changes.
+    """
+    _context.caches = {}
+
+def clear():
+    """
+    Reset the whole context. Called at the end of each request.
+    """
+    _context.accounts = []
+    _context.request = None
+    _context.caches = {}
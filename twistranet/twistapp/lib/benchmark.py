@@ -0,0 +1,137 @@
+"""
+Load-test benchmarks for the main twistranet views.
+
+Each benchmark is a function which gets a Runner and a BenchmarkContext.
+It requests one or several urls through run(name, url), the runner takes care of
+timing, SQL query and row counting. Register new benchmarks with @benchmark:
+
+    @benchmark
+    def my_view(run, context):
+        run("my_view", reverse("my_view", args = (context.account.id, )))
+
+See the twistranet_benchmark management command to seed a dataset and run them all.
+"""
+import time
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from twistranet.twistapp.lib.profiling import QueryCounter
+
+# Registered benchmark functions, in registration order
+BENCHMARKS = []
+
+def benchmark(func):
+    """
+    Decorator registering a benchmark function.
+    """
+    BENCHMARKS.append(func)
+    return func
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of values (pct between 0 and 100).
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+class BenchmarkContext(object):
+    """
+    What benchmarks need to build their urls: the account we're logged in as,
+    and a community, a resource and a search term to look at.
+    """
+    def __init__(self, account, community = None, resource = None, search_term = "lorem"):
+        self.account = account
+        self.community = community
+        self.resource = resource
+        self.search_term = search_term
+
+class Runner(object):
+    """
+    Request urls through the django test client and record their performance.
+    """
+    def __init__(self, client = None, iterations = 20, warmup = 1):
+        self.client = client or Client()
+        self.iterations = iterations
+        self.warmup = warmup
+        self.results = []
+
+    def __call__(self, name, url, data = None):
+        """
+        Request url (warmup + iterations) times and store the result.
+        """
+        data = data or {}
+        for i in range(self.warmup):
+            self.client.get(url, data)
+        durations = []
+        queries = []
+        rows = []
+        status = None
+        for i in range(self.iterations):
+            with QueryCounter() as counter:
+                start = time.time()
+                response = self.client.get(url, data)
+                durations.append((time.time() - start) * 1000.0)
+            queries.append(counter.queries)
+            rows.append(counter.rows)
+            status = response.status_code
+        result = {
+            "name": name,
+            "url": url,
+            "status": status,
+            "iterations": self.iterations,
+            "p50_ms": percentile(durations, 50),
+            "p95_ms": percentile(durations, 95),
+            "mean_ms": sum(durations) / len(durations),
+            "queries": percentile(queries, 50),
+            "max_queries": max(queries),
+            "rows": percentile(rows, 50),
+        }
+        self.results.append(result)
+        return result
+
+    def run(self, context, names = None):
+        """
+        Run all registered benchmarks (or only the given names). Return the results list.
+        Benchmarks which fail are recorded with an 'error' key instead of stopping the run.
+        """
+        for func in BENCHMARKS:
+            if names and func.__name__ not in names:
+                continue
+            try:
+                func(self, context)
+            except Exception, e:
+                self.results.append({"name": func.__name__, "error": "%s: %s" % (e.__class__.__name__, e, )})
+        return self.results
+
+
+#                                                   #
+#               Default benchmarks                  #
+#                                                   #
+
+@benchmark
+def homepage(run, context):
+    run("homepage", reverse("twistranet_home"))
+
+@benchmark
+def account(run, context):
+    run("account", reverse("account_by_id", args = (context.account.id, )))
+
+@benchmark
+def community(run, context):
+    if context.community is not None:
+        run("community", reverse("community_by_id", args = (context.community.id, )))
+
+@benchmark
+def tags_live_search(run, context):
+    run("tags_live_search", reverse("tags_live_search"), {"tag": context.search_term[:2]})
+
+@benchmark
+def live_search(run, context):
+    run("live_search", reverse("haystack_live_search"), {"q": context.search_term})
+
+@benchmark
+def resource(run, context):
+    if context.resource is not None:
+        run("resource", reverse("resource_by_id", args = (context.resource.id, )))
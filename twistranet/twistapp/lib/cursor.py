@@ -0,0 +1,49 @@
+"""
+Keyset (cursor) pagination for walls and timelines.
+
+Instead of OFFSET math, each page starts right after the (created_at, id) position
+of the last item of the previous page. That position is handed to the browser as an
+opaque token. Deep pages cost the same as the first one, and we don't need any COUNT(*):
+we fetch limit + 1 rows to know if there's a next page.
+"""
+import base64
+import datetime
+from django.db.models import Q
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def encode_cursor(created_at, id):
+    """
+    Return the opaque token pointing right after the given position
+    """
+    return base64.urlsafe_b64encode("%s|%d" % (created_at.strftime(DATETIME_FORMAT), id, ))
+
+def decode_cursor(token):
+    """
+    Return a (created_at, id) tuple, or None if the token is empty or invalid.
+    """
+    if not token:
+        return None
+    try:
+        created_at, id = base64.urlsafe_b64decode(str(token)).split("|")
+        return datetime.datetime.strptime(created_at, DATETIME_FORMAT), int(id)
+    except (TypeError, ValueError, UnicodeEncodeError, ):
+        return None
+
+def keyset_page(queryset, token, limit):
+    """
+    Return (ids, next_token) for the page of 'queryset' starting after 'token',
+    most recent first. next_token is None if there's no more items.
+    """
+    position = decode_cursor(token)
+    if position:
+        created_at, id = position
+        queryset = queryset.filter(
+            Q(created_at__lt = created_at) | Q(created_at = created_at, id__lt = id)
+        )
+    rows = list(queryset.order_by("-created_at", "-id").values_list("id", "created_at")[:limit + 1])
+    next_token = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_token = encode_cursor(rows[-1][1], rows[-1][0])
+    return [ row[0] for row in rows ], next_token
@@ -0,0 +1,274 @@
+"""
+Per-request profiling: SQL queries, fetched rows and time, grouped by call site.
+
+The ProfilingMiddleware (see core/middleware.py) starts a profile for each request.
+Code then declares its call sites either with a decorator or a 'with' block:
+
+    @profiled("has_permission")
+    def has_permission(self, permission, obj):
+        ...
+
+    with section("%s.prepare_view" % view.__class__.__name__):
+        view.prepare_view()
+
+Sections are inclusive: queries made in a nested section count for its parents as well.
+When no profile is running (the middleware is disabled, or we're outside a request),
+both forms cost one thread-local lookup.
+
+At the end of each request, registered hooks are called with (request, response, profile).
+The default hook feeds a rolling, per-minute aggregate stored in the cache,
+which the twistranet_profile management command dumps. Use a cache backend shared
+between processes (memcached, database...) for the command to see the server's data.
+"""
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from django.db import connection
+from django.core.cache import cache
+
+DEFAULT_TWISTRANET_PROFILING_WINDOW = 60        # Minutes of data kept in the rolling aggregate
+CACHE_KEY_PREFIX = "twistranet_profiling"
+
+_local = threading.local()
+_hooks = []
+
+#                                                       #
+#                   SQL counting                        #
+#                                                       #
+
+class _CountingCursor(object):
+    """
+    Wrap a DB-API cursor to count executed queries and fetched rows.
+    """
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params = ()):
+        self.counter.queries += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kw):
+        rows = self.cursor.fetchmany(*args, **kw)
+        self.counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.counter.rows += 1
+            yield row
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+class QueryCounter(object):
+    """
+    Count SQL queries and fetched rows on the default connection:
+
+        with QueryCounter() as counter:
+            ...
+        print counter.queries, counter.rows
+
+    This works whatever the DEBUG setting is. Counters can be nested.
+    """
+    def __enter__(self):
+        self.queries = 0
+        self.rows = 0
+        self._previous = connection.__dict__.get("cursor", None)
+        cursor = connection.cursor
+        connection.cursor = lambda: _CountingCursor(cursor(), self)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._previous is None:
+            del connection.cursor
+        else:
+            connection.cursor = self._previous
+        return False
+
+#                                                       #
+#                   Profiles                            #
+#                                                       #
+
+class Profile(object):
+    """
+    What happened during a request.
+    sections is a {name: [calls, queries, rows, seconds]} dict.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.view = None
+        self.sections = {}
+        self.queries = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self._start = time.time()
+        self._counter = QueryCounter().__enter__()
+
+    def add(self, name, queries, rows, seconds):
+        counters = self.sections.get(name)
+        if counters is None:
+            counters = self.sections[name] = [0, 0, 0, 0.0]
+        counters[0] += 1
+        counters[1] += queries
+        counters[2] += rows
+        counters[3] += seconds
+
+    def close(self):
+        self._counter.__exit__(None, None, None)
+        self.queries = self._counter.queries
+        self.rows = self._counter.rows
+        self.seconds = time.time() - self._start
+
+    def as_header(self, max_sections = 10):
+        """
+        A compact summary, suitable for an HTTP header:
+        total=12q/230r/45.1ms; HomepageView.prepare_view=8q/200r/30.2ms; ...
+        """
+        parts = ["total=%dq/%dr/%.1fms" % (self.queries, self.rows, self.seconds * 1000, )]
+        by_time = sorted(self.sections.items(), key = lambda item: -item[1][3])
+        for name, (calls, queries, rows, seconds) in by_time[:max_sections]:
+            parts.append("%s=%dx/%dq/%dr/%.1fms" % (name, calls, queries, rows, seconds * 1000, ))
+        return "; ".join(parts)
+
+def get_current_profile():
+    return getattr(_local, 'profile', None)
+
+def start(path):
+    """
+    Start profiling the current request. Return the new Profile.
+    """
+    stop()
+    _local.profile = Profile(path)
+    return _local.profile
+
+def stop():
+    """
+    Stop profiling the current request. Return the closed Profile, or None if there wasn't any.
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        _local.profile = None
+        profile.close()
+    return profile
+
+@contextmanager
+def section(name):
+    """
+    Count queries, rows and time spent inside the 'with' block under the given name.
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        yield
+        return
+    start_time = time.time()
+    counter = QueryCounter().__enter__()
+    try:
+        yield
+    finally:
+        counter.__exit__(None, None, None)
+        profile.add(name, counter.queries, counter.rows, time.time() - start_time)
+
+def profiled(name):
+    """
+    Decorator version of section().
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kw):
+            if getattr(_local, 'profile', None) is None:
+                return func(*args, **kw)
+            with section(name):
+                return func(*args, **kw)
+        return wrapper
+    return decorator
+
+#                                                       #
+#                   Hooks & aggregate                   #
+#                                                       #
+
+def register_hook(hook):
+    """
+    Register a hook(request, response, profile) callable, called at the end of each profiled request.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+def unregister_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def run_hooks(request, response, profile):
+    for hook in _hooks:
+        hook(request, response, profile)
+
+def _bucket_key(minute):
+    return "%s#%d" % (CACHE_KEY_PREFIX, minute, )
+
+def _window():
+    from django.conf import settings
+    return getattr(settings, "TWISTRANET_PROFILING_WINDOW", DEFAULT_TWISTRANET_PROFILING_WINDOW)
+
+def record(request, response, profile):
+    """
+    Default hook: add the profile to the current minute's aggregate.
+    Concurrent requests may overwrite each other's contribution: this is statistics, not accounting.
+    """
+    key = _bucket_key(int(time.time() / 60))
+    bucket = cache.get(key) or {"requests": 0, "queries": 0, "rows": 0, "seconds": 0.0, "views": {}, "sections": {}, }
+    bucket["requests"] += 1
+    bucket["queries"] += profile.queries
+    bucket["rows"] += profile.rows
+    bucket["seconds"] += profile.seconds
+    view = profile.view or profile.path
+    views = bucket["views"].setdefault(view, [0, 0, 0, 0.0])
+    for i, v in enumerate((1, profile.queries, profile.rows, profile.seconds, )):
+        views[i] += v
+    for name, counters in profile.sections.items():
+        totals = bucket["sections"].setdefault(name, [0, 0, 0, 0.0])
+        for i, v in enumerate(counters):
+            totals[i] += v
+    cache.set(key, bucket, (_window() + 1) * 60)
+
+register_hook(record)
+
+def get_aggregate(minutes = None):
+    """
+    Merge the per-minute buckets of the last 'minutes' minutes (default: the whole window).
+    """
+    minutes = minutes or _window()
+    now = int(time.time() / 60)
+    keys = [ _bucket_key(minute) for minute in range(now - minutes + 1, now + 1) ]
+    ret = {"minutes": minutes, "requests": 0, "queries": 0, "rows": 0, "seconds": 0.0, "views": {}, "sections": {}, }
+    for bucket in cache.get_many(keys).values():
+        for k in ("requests", "queries", "rows", "seconds", ):
+            ret[k] += bucket[k]
+        for k in ("views", "sections", ):
+            for name, counters in bucket[k].items():
+                totals = ret[k].setdefault(name, [0, 0, 0, 0.0])
+                for i, v in enumerate(counters):
+                    totals[i] += v
+    return ret
+
+def reset():
+    """
+    Forget the rolling aggregate.
+    """
+    now = int(time.time() / 60)
+    cache.delete_many([ _bucket_key(minute) for minute in range(now - _window(), now + 1) ])
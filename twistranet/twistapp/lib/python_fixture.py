@@ -1,12 +1,34 @@
+import time
+from django.db import transaction
 from django.db.models.query import QuerySet
 from twistranet.twistapp.models import Twistable
 from  twistranet.twistapp.lib.log import log
+from twistranet.twistapp.lib.account_context import as_account
+from twistranet.twistapp.signals import content_created
+
+# Number of fixtures applied in a single transaction by the BulkLoader
+DEFAULT_BATCH_SIZE = 500
+
+# Max number of slugs in a single slug__in query
+SLUG_CHUNK_SIZE = 500
+
+def get_by_slugs(model, slugs):
+    """
+    Return a {slug: object} dict of the given model objects, with as few queries as possible.
+    Security is NOT checked, this is meant to be used by fixtures only.
+    """
+    slugs = list(set(slugs))
+    ret = {}
+    for start in range(0, len(slugs), SLUG_CHUNK_SIZE):
+        for obj in model.objects.__booster__.filter(slug__in = slugs[start:start + SLUG_CHUNK_SIZE]):
+            ret[obj.slug] = obj
+    return ret
 
 class Fixture(object):
     """
     Used to import initial data
     """
-    
+
     def __init__(self, model, logged_account = None, force_update = False, **kw):
         """
         logged_account is a slug
@@ -15,24 +37,30 @@ class Fixture(object):
         self.force_update = force_update
         self.dict = kw
         self.logged_account = logged_account
-        
+
     def apply(self,):
         """
         Create / update model. Use the 'slug' attribute to define unicity of the content.
         """
         from twistranet.twistapp.models import Account
-        slug = self.dict.get('slug', None)
-        obj = None
-        log.debug("Trying to import %s" % slug)
-        
         # Check if slug is given. Mandatory.
         if not self.dict.has_key('slug'):
             raise ValueError("You can't apply this fixture without a slug attribute. This is so to avoid duplicates.")
-        
+
         # Set auth if necessary
         if self.logged_account:
-            __account__ = Account.objects.get(slug = self.logged_account)
-        
+            with as_account(Account.objects.get(slug = self.logged_account)):
+                return self._apply()
+        return self._apply()
+
+    def _apply(self,):
+        """
+        Actually create / update model with the current account.
+        """
+        slug = self.dict.get('slug', None)
+        obj = None
+        log.debug("Trying to import %s" % slug)
+
         # Create/get object
         if slug:
             obj_q = Twistable.objects.__booster__.filter(slug = slug)
@@ -43,17 +71,130 @@ class Fixture(object):
                     return obj
         if not obj:
             obj = self.model()
-            
+
         # Set properties & save
+        self._set_attributes(obj)
+        try:
+            obj.save()
+        except:
+            log.debug("Exception while attempting to generate %s" % self.dict)
+            raise
+
+        return obj
+
+    def _set_attributes(self, obj, resolve = None):
+        """
+        Set fixture values on obj. QuerySet values are resolved with resolve(qs) if given.
+        """
         for k, v in self.dict.items():
             # print self.model, k, v
             if isinstance(v, QuerySet):
-                v = v.get()
+                if resolve:
+                    v = resolve(v)
+                else:
+                    v = v.get()
             setattr(obj, k, v)
+
+
+class BulkLoader(object):
+    """
+    Apply a large list of fixtures, as fast as we can.
+
+    Compared to calling Fixture.apply() on each fixture:
+    - existing slugs and logged accounts are resolved beforehand, with a few queries ;
+    - identical QuerySet values (eg. a default picture) are resolved only once ;
+    - fixtures are applied by batches, each batch in its own transaction ;
+    - new objects skip the slug-collision loop and the unicity checks,
+      and compute their _p_* permissions and access network in memory ;
+    - twistable signals are deferred until all objects are created, and
+      notifications are not sent at all unless notify is True.
+
+    Fixtures are applied in order, as a fixture may refer to an object created by a previous one.
+    Fixtures with force_update on an existing object fall back to the regular Fixture.apply().
+
+    Usage:
+        BulkLoader(FIXTURES).load()
+    """
+    def __init__(self, fixtures, batch_size = DEFAULT_BATCH_SIZE, notify = False):
+        self.fixtures = fixtures
+        self.batch_size = batch_size
+        self.notify = notify
+        self._deferred = []
+        self._resolved = {}
+
+    def defer(self, signal, **kwargs):
+        """
+        Called by Twistable._send_signal() for objects we're saving.
+        """
+        if signal is content_created and not self.notify:
+            return
+        self._deferred.append((signal, kwargs, ))
+
+    def _resolve(self, qs):
+        key = (qs.model, str(qs.query), )
+        if not self._resolved.has_key(key):
+            self._resolved[key] = qs.get()
+        return self._resolved[key]
+
+    def load(self,):
+        """
+        Apply fixtures. Return a dict of counters (created, skipped, updated, signals, seconds, rows_per_second).
+        """
+        from twistranet.twistapp.models import Account
+        start = time.time()
+        fixtures = list(self.fixtures)
+        for fixture in fixtures:
+            if not fixture.dict.has_key('slug'):
+                raise ValueError("You can't apply this fixture without a slug attribute. This is so to avoid duplicates.")
+
+        # Pre-resolve what already exists and who we're going to log as
+        existing = set(get_by_slugs(Twistable, [ f.dict['slug'] for f in fixtures if f.dict['slug'] ]).keys())
+        accounts = get_by_slugs(Account, [ f.logged_account for f in fixtures if f.logged_account ])
+
+        stats = {"created": 0, "skipped": 0, "updated": 0, "signals": 0, }
+        for batch_start in range(0, len(fixtures), self.batch_size):
+            with transaction.commit_on_success():
+                for fixture in fixtures[batch_start:batch_start + self.batch_size]:
+                    slug = fixture.dict['slug']
+                    if slug in existing:
+                        if fixture.force_update:
+                            fixture.apply()
+                            stats["updated"] += 1
+                        else:
+                            stats["skipped"] += 1
+                        continue
+                    if fixture.logged_account:
+                        with as_account(accounts[fixture.logged_account]):
+                            self._create(fixture)
+                    else:
+                        self._create(fixture)
+                    if slug:
+                        existing.add(slug)
+                    stats["created"] += 1
+            log.info("Bulk-loaded %d/%d fixtures" % (min(batch_start + self.batch_size, len(fixtures)), len(fixtures), ))
+
+        # Now that everything is in the database, send the deferred signals
+        deferred, self._deferred = self._deferred, []
+        for batch_start in range(0, len(deferred), self.batch_size):
+            with transaction.commit_on_success():
+                for signal, kwargs in deferred[batch_start:batch_start + self.batch_size]:
+                    signal.send(**kwargs)
+        stats["signals"] = len(deferred)
+
+        stats["seconds"] = time.time() - start
+        stats["rows_per_second"] = stats["created"] / max(stats["seconds"], 0.001)
+        log.info("Bulk load done: %(created)d created, %(updated)d updated, %(skipped)d skipped, %(signals)d signals in %(seconds).1fs (%(rows_per_second).1f rows/s)" % stats)
+        return stats
+
+    def _create(self, fixture):
+        obj = fixture.model()
+        fixture._set_attributes(obj, self._resolve)
+        obj._bulk_loader = self
         try:
             obj.save()
         except:
-            log.debug("Exception while attempting to generate %s" % self.dict)
+            log.debug("Exception while attempting to generate %s" % fixture.dict)
             raise
-        
+        finally:
+            del obj._bulk_loader
         return obj
@@ -0,0 +1,140 @@
+"""
+Batch computation of Twistable.static_score.
+
+static_score ranks contents without any per-request computation: search results can be sorted on it
+(see search/fts_backend.py). It's computed from:
+- likes (sharing.Like) and comments (Comment.root_content) on the content ;
+- the reach of its publisher, ie. the number of accounts following it ;
+- its age: the score halves every TWISTRANET_SCORE_HALF_LIFE seconds.
+
+    score = SCORE_SCALE * (1 + LIKE_WEIGHT * likes + COMMENT_WEIGHT * comments + REACH_WEIGHT * log(1 + reach)) * 0.5 ** (age / half_life)
+
+Contents are scored by chunks of ids, with one aggregate query per factor and per chunk,
+and only the scores which changed are written back, with one UPDATE per chunk.
+Contents older than TWISTRANET_SCORE_WINDOW are left alone once their score has dropped to 0.
+
+Run it with ./manage.py twistranet_score (--loop to keep it running).
+"""
+import math
+import time
+import datetime
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Count
+
+from twistranet.twistapp.lib.log import log
+
+DEFAULT_TWISTRANET_SCORE_HALF_LIFE = 60 * 60 * 48           # Seconds
+DEFAULT_TWISTRANET_SCORE_WINDOW = 60 * 60 * 24 * 30         # Seconds
+DEFAULT_TWISTRANET_SCORE_INTERVAL = 60 * 60                 # Seconds between two runs of the worker
+
+SCORE_SCALE = 100
+LIKE_WEIGHT = 1.0
+COMMENT_WEIGHT = 2.0
+REACH_WEIGHT = 0.5
+
+CHUNK_SIZE = 1000
+
+def _setting(name):
+    return getattr(settings, name, globals()["DEFAULT_%s" % name])
+
+def compute_score(likes, comments, reach, age, half_life):
+    """
+    Return the score of a single content. age and half_life are in seconds.
+    """
+    score = 1 + LIKE_WEIGHT * likes + COMMENT_WEIGHT * comments + REACH_WEIGHT * math.log(1 + reach)
+    return int(round(SCORE_SCALE * score * 0.5 ** (max(age, 0) / float(half_life))))
+
+def _count_by(qs, field):
+    """
+    Return a {field value: number of rows} dict, with a single aggregate query.
+    """
+    return dict(qs.values_list(field).annotate(Count("id")).order_by())
+
+def write_scores(scores):
+    """
+    Write a list of (id, score) tuples, with one UPDATE ... CASE statement per chunk.
+    """
+    from twistranet.twistapp.models import Twistable
+    cursor = connection.cursor()
+    for start in range(0, len(scores), CHUNK_SIZE):
+        chunk = scores[start:start + CHUNK_SIZE]
+        params = []
+        for id, score in chunk:
+            params.extend([ id, score, ])
+        params.extend([ id for id, score in chunk ])
+        cursor.execute(
+            "UPDATE %(twistable)s SET static_score = CASE id %(cases)s ELSE static_score END WHERE id IN (%(ids)s)" % {
+                "twistable":    Twistable._meta.db_table,
+                "cases":        " ".join([ "WHEN %s THEN %s" for s in chunk ]),
+                "ids":          ", ".join([ "%s" for s in chunk ]),
+            },
+            params,
+        )
+    transaction.commit_unless_managed()
+
+def update_scores(full = False, now = None, chunk_size = CHUNK_SIZE):
+    """
+    Compute the score of recent contents (or all of them if full is True) and write the changed ones.
+    Return stats as a dict.
+    """
+    from twistranet.twistapp.models import Content, Network
+    from twistranet.content_types.models import Comment
+    from twistranet.sharing.models import Like
+    now = now or datetime.datetime.now()
+    half_life = _setting("TWISTRANET_SCORE_HALF_LIFE")
+    start_time = time.time()
+    stats = {"scored": 0, "updated": 0, }
+
+    contents = Content.objects.__booster__.exclude(model_name = "Comment")
+    if not full:
+        since = now - datetime.timedelta(seconds = _setting("TWISTRANET_SCORE_WINDOW"))
+        contents = contents.filter(Q(created_at__gte = since) | Q(static_score__gt = 0))
+
+    last_id = 0
+    changed = []
+    while True:
+        chunk = list(contents.filter(id__gt = last_id).order_by("id").values_list("id", "publisher", "created_at", "static_score")[:chunk_size])
+        if not chunk:
+            break
+        last_id = chunk[-1][0]
+        ids = [ row[0] for row in chunk ]
+        likes = _count_by(Like.objects.filter(what__in = ids), "what")
+        comments = _count_by(Comment.objects.__booster__.filter(root_content__in = ids), "root_content")
+        reach = _count_by(Network.objects.filter(target__in = set([ row[1] for row in chunk ])), "target")
+        for id, publisher_id, created_at, old_score in chunk:
+            age = now - created_at
+            score = compute_score(
+                likes.get(id, 0), comments.get(id, 0), reach.get(publisher_id, 0),
+                age.days * 86400 + age.seconds, half_life,
+            )
+            if score != old_score:
+                changed.append((id, score, ))
+        stats["scored"] += len(chunk)
+
+    write_scores(changed)
+    _update_search_index(changed)
+    stats["updated"] = len(changed)
+    stats["seconds"] = time.time() - start_time
+    return stats
+
+def _update_search_index(scores):
+    """
+    Push new scores to the search index, if its backend stores them.
+    """
+    from haystack import backend
+    search_backend = backend.SearchBackend()
+    if scores and hasattr(search_backend, "update_scores"):
+        search_backend.update_scores(scores)
+
+def run(loop = False, interval = None):
+    """
+    Update scores, and keep doing it every interval seconds if loop is True. Return the stats of the last run.
+    """
+    interval = interval or _setting("TWISTRANET_SCORE_INTERVAL")
+    while True:
+        stats = update_scores()
+        log.info("%(scored)d contents scored, %(updated)d scores updated in %(seconds).1fs" % stats)
+        if not loop:
+            return stats
+        time.sleep(interval)
@@ -0,0 +1,264 @@
+"""
+Eager thumbnails for resources.
+
+The standard sizes (see THUMBNAIL_SIZES) are rendered as soon as a resource is saved, synchronously.
+With TWISTRANET_THUMBNAIL_QUEUE = True, saving a resource only marks it as pending instead, and the thumbnails
+are rendered out of the web server by ./manage.py twistranet_thumbnails --loop, which must be running then.
+Rendered sizes are recorded in a per-resource manifest (see ThumbnailManifest), cached in Django's cache:
+image resources without a manifest are the pending ones.
+
+Resource.thumbnails returns LazyThumbnail objects, whose url / width / height are read from the manifest:
+rendering a page never opens nor decodes an image. Until a size has been rendered, the original file
+is used as a placeholder.
+
+Resources saved before this was set up can be rendered with ./manage.py twistranet_thumbnails as well.
+
+Default pictures and mimetype icons (the resources created by the bootstrap from twistranet/fixtures/resources)
+are loaded once per process in a registry, which is refreshed when one of them is saved or deleted,
+so that picture-less objects and non-image resources don't cost any query.
+"""
+import os
+import time
+try:
+    # python 2.6
+    import json
+except:
+    # python 2.4 with simplejson
+    import simplejson as json
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from twistranet.twistapp.lib.log import log
+
+DEFAULT_TWISTRANET_THUMBNAIL_QUEUE = False
+DEFAULT_TWISTRANET_THUMBNAIL_INTERVAL = 5          # Seconds between two runs of the worker
+
+# Name, geometry and sorl options of the standard thumbnails.
+# Preview: Max = 500x500; Used when a large version should be available.
+# Summary: Max = 100x100;
+# Summary Preview: Max = Min = 100x100;
+# Medium:  Max = Min = 50x50;
+# Icon:    Max = Min = 16x16;
+THUMBNAIL_SIZES = (
+    ("preview",         "500x500",  {"crop": "", "upscale": False, }),
+    ("summary",         "100x100",  {"crop": "", "upscale": False, }),
+    ("summary_preview", "100x100",  {"crop": "center top", "upscale": True, }),
+    ("medium",          "50x50",    {"crop": "center top", "upscale": True, }),
+    ("big_icon",        "32x32",    {"upscale": False, }),
+    ("icon",            "16x16",    {"crop": "center top", "upscale": True, }),
+)
+
+CACHE_KEY = "thumbnails#%d"
+
+class LazyThumbnail(object):
+    """
+    A thumbnail of a resource, resolved from the resource's manifest on first access.
+    Quacks like sorl's ImageFile as far as templates are concerned.
+    """
+    def __init__(self, resource, size):
+        self.resource = resource
+        self.size_name = size
+        self._entry = None
+
+    def _resolve(self,):
+        if self._entry is None:
+            entry = get_manifest(self.resource)["sizes"].get(self.size_name)
+            if not entry:
+                # Placeholders aren't memoized: default pictures' thumbnails live as long as the process
+                return (self.resource.get_absolute_url(), None, None, )
+            from sorl.thumbnail import default
+            self._entry = (default.storage.url(entry[0]), entry[1], entry[2], )
+        return self._entry
+
+    @property
+    def is_placeholder(self,):
+        return self._resolve()[1] is None
+
+    @property
+    def url(self,):
+        return self._resolve()[0]
+    src = url
+
+    @property
+    def width(self,):
+        return self._resolve()[1]
+    x = width
+
+    @property
+    def height(self,):
+        return self._resolve()[2]
+    y = height
+
+    def __unicode__(self,):
+        return self.url
+
+def get_thumbnails(resource):
+    """
+    Return the {size name: LazyThumbnail} dict of a resource. Nothing is loaded until a thumbnail is used.
+    """
+    return dict([ (size, LazyThumbnail(resource, size)) for size, geometry, options in THUMBNAIL_SIZES ])
+
+#                                                       #
+#                       Manifests                       #
+#                                                       #
+
+def get_manifest(resource):
+    """
+    Return the manifest of a resource: {"source": file name, "sizes": {size name: [thumbnail name, width, height]}}.
+    Sizes rendered from another file than the current one are ignored.
+    The manifest is memoized on the resource object once it's been rendered.
+    """
+    manifest = getattr(resource, "_thumbnail_manifest", None)
+    if manifest is None:
+        from twistranet.twistapp.models.resource import ThumbnailManifest
+        key = CACHE_KEY % resource.id
+        manifest = cache.get(key)
+        if manifest is None:
+            try:
+                manifest = json.loads(ThumbnailManifest.objects.get(resource_id = resource.id).sizes)
+                cache.set(key, manifest)
+            except ThumbnailManifest.DoesNotExist:
+                return {"source": None, "sizes": {}, }
+        if manifest["source"] != resource.resource_file.name:
+            return {"source": None, "sizes": {}, }
+        resource._thumbnail_manifest = manifest
+    return manifest
+
+def save_manifest(resource_id, manifest):
+    from twistranet.twistapp.models.resource import ThumbnailManifest
+    ThumbnailManifest(resource_id = resource_id, sizes = json.dumps(manifest)).save()
+    cache.set(CACHE_KEY % resource_id, manifest)
+
+def delete_manifest(resource_id):
+    from twistranet.twistapp.models.resource import ThumbnailManifest
+    ThumbnailManifest.objects.filter(resource_id = resource_id).delete()
+    cache.delete(CACHE_KEY % resource_id)
+
+#                                                       #
+#                       Rendering                       #
+#                                                       #
+
+def render(resource_id, source_name):
+    """
+    Render the standard sizes of a resource file and save its manifest. Return the manifest.
+    This acts as the SystemAccount, as it may run in the worker (permissions were checked when the resource was saved).
+    """
+    from sorl.thumbnail import default
+    from sorl.thumbnail.images import ImageFile
+    from twistranet.twistapp.models import SystemAccount
+    from twistranet.twistapp.lib.account_context import as_account
+    from twistranet.twistorage.storage import Twistorage
+    manifest = {"source": source_name, "sizes": {}, }
+    with as_account(SystemAccount.get()):
+        source = ImageFile(source_name, Twistorage())
+        for size, geometry, options in THUMBNAIL_SIZES:
+            try:
+                thumbnail = default.backend.get_thumbnail(source, geometry, **options)
+                manifest["sizes"][size] = [ thumbnail.name, thumbnail.width, thumbnail.height, ]
+            except:
+                # In rare situations (CMJK + PNG mode), sorl thumbnail raises an error. The original is used then.
+                log.exception("Can't render the '%s' thumbnail of resource %s" % (size, resource_id, ))
+        save_manifest(resource_id, manifest)
+    return manifest
+
+def enqueue(resource):
+    """
+    Render the standard thumbnails of an image resource, unless its manifest is up to date.
+    With TWISTRANET_THUMBNAIL_QUEUE, its outdated manifest is just dropped: the worker will render it.
+    """
+    if not resource.resource_file or not resource.is_image:
+        return
+    if get_manifest(resource)["source"] == resource.resource_file.name:
+        return
+    resource._thumbnail_manifest = None
+    if getattr(settings, "TWISTRANET_THUMBNAIL_QUEUE", DEFAULT_TWISTRANET_THUMBNAIL_QUEUE):
+        delete_manifest(resource.id)
+        return
+    render(resource.id, resource.resource_file.name)
+
+def render_pending(all = False):
+    """
+    Render the image resources which have no manifest (or all of them). Return the number of rendered resources.
+    """
+    from twistranet.twistapp.models import Resource
+    from twistranet.twistapp.models.resource import ThumbnailManifest
+    resources = Resource.objects.__booster__.filter(mimetype__startswith = "image/").exclude(resource_file = "")
+    if not all:
+        resources = resources.exclude(id__in = ThumbnailManifest.objects.values_list("resource_id", flat = True))
+    count = 0
+    for id, name in list(resources.order_by("id").values_list("id", "resource_file")):
+        try:
+            with transaction.commit_on_success():
+                render(id, name)
+            count += 1
+        except:
+            log.exception("Unable to render the thumbnails of resource %s" % id)
+    return count
+
+def run(loop = False, interval = None):
+    """
+    Render pending thumbnails, and keep doing it every interval seconds if loop is True.
+    Return the number of resources rendered by the last run.
+    """
+    interval = interval or getattr(settings, "TWISTRANET_THUMBNAIL_INTERVAL", DEFAULT_TWISTRANET_THUMBNAIL_INTERVAL)
+    while True:
+        # Commit, so that each run sees the resources saved in the meantime
+        with transaction.commit_on_success():
+            count = render_pending()
+        if count:
+            log.info("Thumbnails of %d resources rendered" % count)
+        if not loop:
+            return count
+        time.sleep(interval)
+
+#                                                       #
+#                   Default pictures                    #
+#                                                       #
+
+_default_slugs = None
+_default_pictures = None
+_default_thumbnails = {}
+
+def get_default_slugs():
+    """
+    Slugs of the resources created by the bootstrap (see core.bootstrap).
+    """
+    global _default_slugs
+    if _default_slugs is None:
+        import twistranet
+        from twistranet.twistapp.lib.slugify import slugify
+        resources_dir = os.path.join(os.path.split(twistranet.__file__)[0], 'fixtures', 'resources')
+        _default_slugs = frozenset([ slugify(os.path.splitext(fname)[0]) for fname in os.listdir(resources_dir) ])
+    return _default_slugs
+
+def get_default_picture(slug):
+    """
+    Return the default resource (default picture or mimetype icon) with this slug, or None.
+    They're all loaded at once on first call, then kept until reset_default_pictures() is called.
+    """
+    global _default_pictures
+    pictures = _default_pictures
+    if pictures is None:
+        from twistranet.twistapp.models import Resource
+        pictures = dict([ (r.slug, r) for r in Resource.objects.__booster__.filter(slug__in = list(get_default_slugs())) ])
+        _default_pictures = pictures
+    return pictures.get(slug)
+
+def get_default_thumbnails(slug):
+    """
+    Return the standard thumbnails of a default picture, or {} if there's no such picture.
+    Shared by all picture-less objects of a class, so they're resolved once per process.
+    """
+    thumbnails = _default_thumbnails.get(slug)
+    if thumbnails is None:
+        picture = get_default_picture(slug)
+        if picture is None:
+            return {}
+        thumbnails = _default_thumbnails[slug] = picture.thumbnails
+    return thumbnails
+
+def reset_default_pictures():
+    global _default_pictures, _default_thumbnails
+    _default_pictures = None
+    _default_thumbnails = {}
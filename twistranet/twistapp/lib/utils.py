@@ -1,6 +1,7 @@
 from django.core.cache import cache
 from django.conf import settings
 from django.utils.html import *
+from twistranet.twistapp.lib.account_context import as_account
 
 
 def _get_site_name_or_baseline(return_baseline = False):
@@ -13,13 +14,10 @@ def _get_site_name_or_baseline(return_baseline = False):
     baseline = d.get("baseline", None)
     if site_name is None or baseline is None:
         from twistranet.twistapp.models import SystemAccount, GlobalCommunity
-        __account__ = SystemAccount.get()
-        try:
+        with as_account(SystemAccount.get()):
             glob = GlobalCommunity.get()
             site_name = glob.site_name
             baseline = glob.baseline
-        finally:
-            del __account__
         cache.set('twistranet_site_name', site_name)
         cache.set("twistranet_baseline", baseline)
     if return_baseline:
@@ -0,0 +1,138 @@
+"""
+Measure the main views performance on a heavy_load dataset.
+"""
+import sys
+import time
+import random
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+class Command(BaseCommand):
+    args = '[benchmark_name ...]'
+    help = 'Seed a heavy_load dataset and report p50/p95 latency, SQL queries and rows fetched for the main views, as JSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--test-db', action = 'store_true', dest = 'test_db', default = False,
+            help = 'Run on a throwaway test database (in-memory with SQLite) instead of the configured one.'),
+        make_option('--no-seed', action = 'store_false', dest = 'seed', default = True,
+            help = "Don't generate data, benchmark the existing database."),
+        make_option('--users', type = 'int', dest = 'users', default = 100),
+        make_option('--communities', type = 'int', dest = 'communities', default = 20),
+        make_option('--documents', type = 'int', dest = 'documents', default = 200),
+        make_option('--status-updates', type = 'int', dest = 'status_updates', default = 500),
+        make_option('--iterations', type = 'int', dest = 'iterations', default = 20),
+        make_option('--username', dest = 'username', default = None,
+            help = 'Log in as this user (mandatory with --no-seed).'),
+        make_option('--password', dest = 'password', default = None),
+        make_option('--output', dest = 'output', default = None,
+            help = 'Write JSON results to this file instead of stdout.'),
+        make_option('--compare', dest = 'compare', default = None,
+            help = 'A previous JSON result file to compare p95 and query counts with.'),
+    )
+
+    def handle(self, *args, **options):
+        from django.db import connection
+        old_name = None
+        if options['test_db']:
+            old_name = settings.DATABASES['default']['NAME']
+            connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+        try:
+            report = self.benchmark(args, options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity = 0)
+        self.output(report, options)
+
+    def benchmark(self, names, options):
+        from twistranet.twistapp.models import UserAccount, SystemAccount, Community, Resource
+        from twistranet.twistapp.lib.account_context import as_account
+        from twistranet.twistapp.lib import benchmark
+        from twistranet.core import bootstrap
+
+        dataset = {}
+        username, password = options['username'], options['password']
+        if options['seed']:
+            from twistranet.fixtures import heavy_load
+            backup_EMAIL_BACKEND = settings.EMAIL_BACKEND
+            settings.EMAIL_BACKEND = 'django.core.mail.backends.dummy.EmailBackend'
+            try:
+                if options['test_db']:
+                    settings.TWISTRANET_IMPORT_SAMPLE_DATA = True
+                    settings.TWISTRANET_IMPORT_COGIP = False
+                    bootstrap.bootstrap()
+                start = time.time()
+                created = heavy_load.load(
+                    n_users = options['users'],
+                    n_communities = options['communities'],
+                    n_documents = options['documents'],
+                    n_status_updates = options['status_updates'],
+                )
+            finally:
+                settings.EMAIL_BACKEND = backup_EMAIL_BACKEND
+            dataset = {
+                "users": options['users'],
+                "communities": options['communities'],
+                "documents": options['documents'],
+                "status_updates": options['status_updates'],
+                "seed_seconds": time.time() - start,
+            }
+            username = username or random.choice(created["usernames"])
+            password = password or heavy_load.PASSWORD
+        if not username:
+            raise CommandError("You must give --username (and --password) when using --no-seed.")
+
+        # Pick what we're going to look at, as the benchmarked user would see it
+        with as_account(SystemAccount.get()):
+            account = UserAccount.objects.get(slug = username)
+        with as_account(account):
+            communities = Community.objects.filter(model_name = "Community").order_by("-id")[:1]
+            resources = Resource.objects.order_by("-id")[:1]
+            context = benchmark.BenchmarkContext(
+                account = account,
+                community = communities and communities[0] or None,
+                resource = resources and resources[0] or None,
+            )
+
+        runner = benchmark.Runner(iterations = options['iterations'])
+        if not runner.client.login(username = username, password = password):
+            raise CommandError("Unable to log in as %s" % username)
+        runner.run(context, names)
+        return {
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "database": settings.DATABASES['default']['ENGINE'],
+            "dataset": dataset,
+            "results": runner.results,
+        }
+
+    def output(self, report, options):
+        from django.utils import simplejson as json
+        previous = {}
+        if options['compare']:
+            f = open(options['compare'], "r")
+            try:
+                previous = dict([ (r["name"], r) for r in json.load(f)["results"] if not r.has_key("error") ])
+            finally:
+                f.close()
+
+        # Human-readable summary on stderr, so that stdout stays valid JSON
+        for result in report["results"]:
+            if result.has_key("error"):
+                sys.stderr.write("%-20s ERROR %s\n" % (result["name"], result["error"], ))
+                continue
+            line = "%-20s p50=%7.1fms p95=%7.1fms queries=%4d rows=%6d" % (
+                result["name"], result["p50_ms"], result["p95_ms"], result["queries"], result["rows"],
+            )
+            if previous.has_key(result["name"]):
+                before = previous[result["name"]]
+                line += "  (p95 %+.1fms, queries %+d)" % (result["p95_ms"] - before["p95_ms"], result["queries"] - before["queries"], )
+            sys.stderr.write(line + "\n")
+
+        data = json.dumps(report, indent = 2)
+        if options['output']:
+            f = open(options['output'], "w")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        else:
+            print data
@@ -0,0 +1,46 @@
+"""
+Run the notifier worker, which handles notifications queued when TWISTRANET_NOTIFIER_QUEUE is True
+and sends notification digests.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Send queued notifications (emails, notification contents). See twistranet.notifier.queue.'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action = 'store_true', dest = 'loop', default = False,
+            help = 'Keep running and poll the queue instead of exiting when it is empty.'),
+        make_option('--poll-interval', type = 'int', dest = 'poll_interval', default = 5,
+            help = 'Seconds to wait between two polls of an empty queue (with --loop).'),
+        make_option('--rate', type = 'float', dest = 'rate', default = None,
+            help = 'Max messages per second (default: TWISTRANET_NOTIFIER_RATE).'),
+        make_option('--batch-size', type = 'int', dest = 'batch_size', default = 100,
+            help = 'Number of rows claimed at once.'),
+        make_option('--status', action = 'store_true', dest = 'status', default = False,
+            help = 'Only print the queue status.'),
+        make_option('--requeue-dead', action = 'store_true', dest = 'requeue_dead', default = False,
+            help = 'Queue dead rows again before running.'),
+        make_option('--purge-dead', type = 'int', dest = 'purge_dead', default = None, metavar = 'SECONDS',
+            help = 'Only delete dead rows older than SECONDS (0 for all of them).'),
+    )
+
+    def handle(self, *args, **options):
+        # Importing the notifier registers its handlers
+        from twistranet import notifier
+        from twistranet.notifier import queue
+        if options['status']:
+            status = queue.get_status()
+            print "%(pending)d pending, %(sending)d sending, %(dead)d dead. Oldest pending row: %(oldest_pending_seconds)ds." % status
+            return
+        if options['purge_dead'] is not None:
+            print "%d dead rows deleted." % queue.purge_dead(options['purge_dead'])
+            return
+        if options['requeue_dead']:
+            print "%d dead rows queued again." % queue.requeue_dead()
+        worker = queue.Worker(rate = options['rate'], batch_size = options['batch_size'])
+        try:
+            stats = worker.run(loop = options['loop'], poll_interval = options['poll_interval'])
+        except KeyboardInterrupt:
+            stats = worker.stats
+        print "%(handled)d handled, %(split)d recipients split, %(retried)d to retry, %(dead)d dead (%(per_second).1f/s), %(digested)d events digested, %(purged)d dead rows purged." % stats
@@ -0,0 +1,39 @@
+"""
+Dump the rolling profiling aggregate collected by the ProfilingMiddleware.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Dump SQL queries / time per view and per call site, as collected by the ProfilingMiddleware (TWISTRANET_PROFILING = True).'
+    option_list = BaseCommand.option_list + (
+        make_option('--minutes', type = 'int', dest = 'minutes', default = None,
+            help = 'Only dump the last N minutes (default: the whole profiling window).'),
+        make_option('--json', action = 'store_true', dest = 'json', default = False,
+            help = 'Dump raw JSON data.'),
+        make_option('--reset', action = 'store_true', dest = 'reset', default = False,
+            help = 'Forget collected data after dumping it.'),
+    )
+
+    def handle(self, *args, **options):
+        from django.utils import simplejson as json
+        from twistranet.twistapp.lib import profiling
+        data = profiling.get_aggregate(options['minutes'])
+        if options['json']:
+            print json.dumps(data, indent = 2)
+        elif not data["requests"]:
+            print "No profiling data for the last %d minutes." % data["minutes"]
+        else:
+            requests = data["requests"]
+            print "%d requests in the last %d minutes: %.1f queries, %.1f rows, %.1fms per request" % (
+                requests, data["minutes"],
+                float(data["queries"]) / requests, float(data["rows"]) / requests, data["seconds"] * 1000 / requests,
+            )
+            for title, k in (("Views", "views"), ("Call sites", "sections"), ):
+                print
+                print "%-50s %8s %10s %10s %10s" % (title, "calls", "queries", "rows", "ms", )
+                for name, (calls, queries, rows, seconds) in sorted(data[k].items(), key = lambda item: -item[1][3]):
+                    print "%-50s %8d %10d %10d %10.1f" % (name[:50], calls, queries, rows, seconds * 1000, )
+        if options['reset']:
+            profiling.reset()
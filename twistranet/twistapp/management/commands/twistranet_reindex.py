@@ -0,0 +1,28 @@
+"""
+Rebuild the search index from scratch.
+Objects are indexed as they're saved, so you only need this after an upgrade or when the index is lost.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Clear the search index and index all searchable objects again.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type = 'int', dest = 'batch_size', default = 500,
+            help = 'Number of objects loaded and indexed at once.'),
+    )
+
+    def handle(self, *args, **options):
+        from haystack import site
+        batch_size = options['batch_size']
+        for model in site.get_indexed_models():
+            start = time.time()
+            index = site.get_index(model)
+            index.backend.clear(models = [ model ])
+            ids = list(index.index_queryset().order_by("id").values_list("id", flat = True))
+            for offset in range(0, len(ids), batch_size):
+                index.backend.update(index, index.index_queryset().filter(id__in = ids[offset:offset + batch_size]))
+            elapsed = max(time.time() - start, 0.001)
+            print "%s: %d objects indexed (%.1f/s)" % (model._meta.object_name, len(ids), len(ids) / elapsed, )
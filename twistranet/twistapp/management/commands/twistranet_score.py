@@ -0,0 +1,28 @@
+"""
+Compute contents' static_score, see twistranet.twistapp.lib.scoring.
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Compute the static score of recent contents (used to rank timelines and search results).'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action = 'store_true', dest = 'loop', default = False,
+            help = 'Keep running and update scores every --interval seconds.'),
+        make_option('--interval', type = 'int', dest = 'interval', default = None,
+            help = 'Seconds between two runs (with --loop, default: TWISTRANET_SCORE_INTERVAL).'),
+        make_option('--full', action = 'store_true', dest = 'full', default = False,
+            help = 'Score all contents, not only recent ones.'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.lib import scoring
+        if options['full']:
+            stats = scoring.update_scores(full = True)
+        else:
+            try:
+                stats = scoring.run(loop = options['loop'], interval = options['interval'])
+            except KeyboardInterrupt:
+                return
+        print "%(scored)d contents scored, %(updated)d scores updated in %(seconds).1fs." % stats
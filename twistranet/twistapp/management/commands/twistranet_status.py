@@ -5,6 +5,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db.models import Max
 from django.conf import settings
 import os
+from twistranet.twistapp.lib.account_context import set_current_account
 
 class Command(BaseCommand):
     args = ''
@@ -16,7 +17,7 @@ class Command(BaseCommand):
         """
         from twistranet.twistapp import UserAccount, Content, SystemAccount
         from django.contrib.auth.models import User
-        __account__ = SystemAccount.get()
+        set_current_account(SystemAccount.get())
         here = os.path.split(settings.HERE)[1]
         stat_dict = {
             "here":             here,
@@ -0,0 +1,28 @@
+"""
+Rebuild the tag index (words, usage counters and expert scores, see twistranet.tagging.models).
+It's maintained as tags are saved and used, so you only need this after an upgrade,
+or from time to time to fix expert scores which drifted (eg. after accounts have been deleted).
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rebuild the tag autocomplete index, tag usage counters and tag expert scores.'
+    option_list = BaseCommand.option_list + (
+        make_option('--experts', action = 'store_true', dest = 'experts', default = False,
+            help = 'Only compute expert scores again.'),
+    )
+
+    def handle(self, *args, **options):
+        from django.db import transaction
+        from twistranet.tagging.models import Tag, index_tag, count_tags, compute_experts
+        with transaction.commit_on_success():
+            if not options['experts']:
+                n_tags = 0
+                for tag in Tag.objects.all().iterator():
+                    index_tag(tag)
+                    n_tags += 1
+                count_tags()
+                print "%d tags indexed." % n_tags
+            print "%d expert scores computed." % compute_experts()
@@ -0,0 +1,32 @@
+"""
+Render the standard thumbnails of resources, see twistranet.twistapp.lib.thumbnails.
+Keep it running with --loop if TWISTRANET_THUMBNAIL_QUEUE is set. Otherwise, new resources are rendered as they're saved,
+so you only need this after an upgrade or when the thumbnails cache is lost.
+"""
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Render the standard thumbnails of image resources which have none yet.'
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action = 'store_true', dest = 'all', default = False,
+            help = 'Render thumbnails of all image resources again.'),
+        make_option('--loop', action = 'store_true', dest = 'loop', default = False,
+            help = 'Keep running and render new resources every --interval seconds.'),
+        make_option('--interval', type = 'int', dest = 'interval', default = None,
+            help = 'Seconds between two runs (with --loop, default: TWISTRANET_THUMBNAIL_INTERVAL).'),
+    )
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.lib import thumbnails
+        start = time.time()
+        if options['all']:
+            count = thumbnails.render_pending(all = True)
+        else:
+            try:
+                count = thumbnails.run(loop = options['loop'], interval = options['interval'])
+            except KeyboardInterrupt:
+                return
+        print "%d resources rendered in %.1fs" % (count, time.time() - start, )
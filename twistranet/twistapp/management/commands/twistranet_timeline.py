@@ -0,0 +1,26 @@
+"""
+Maintain the home timeline inboxes.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    args = 'backfill|trim [account_slug ...]'
+    help = 'Rebuild (backfill) or trim the home timeline inboxes. Use it after installing the timeline, or periodically to trim inboxes.'
+
+    def handle(self, *args, **options):
+        from twistranet.twistapp.models import UserAccount, SystemAccount
+        from twistranet.twistapp.lib.account_context import as_account
+        from twistranet.timeline import models as timeline
+        if not args or args[0] not in ("backfill", "trim", ):
+            raise CommandError("Usage: twistranet_timeline %s" % self.args)
+        action, slugs = args[0], args[1:]
+        with as_account(SystemAccount.get()):
+            accounts = UserAccount.objects.all()
+            if slugs:
+                accounts = accounts.filter(slug__in = slugs)
+            account_ids = list(accounts.values_list("id", flat = True))
+        for account_id in account_ids:
+            if action == "backfill":
+                timeline.backfill(account_id)
+            timeline.trim(account_id)
+        print "%s: %d inboxes processed" % (action, len(account_ids), )
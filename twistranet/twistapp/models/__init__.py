@@ -1,11 +1,11 @@
 # Importing all models from submodules
 
 # Low-level stuff
-from twistable import Twistable
+from twistable import Twistable, TwistableQuerySet, dereference_bulk
 from account import Account, AnonymousAccount
 from content import Content
 from community import Community
-from resource import Resource
+from resource import Resource, ThumbnailManifest
 
 # Higher level stuff
 from account import UserAccount, SystemAccount
@@ -4,15 +4,27 @@ from django.core.cache import cache
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, ValidationError, PermissionDenied, SuspiciousOperation
 from django.conf import settings
+from django.utils.translation import ugettext_lazy
 
 import twistable
 from resource import Resource
 from twistranet.twistapp.lib import permissions, roles, languages, slugify
+from twistranet.twistapp.lib import account_context
+from twistranet.twistapp.lib.account_context import as_account
 from twistranet.twistapp.signals import request_add_to_network, accept_in_network
+from twistranet.core.caches import AccountCache
+from twistranet.twistapp.lib.profiling import profiled
 from  twistranet.twistapp.lib.log import log
 
 from fields import ResourceField
 
+# How often a user wants to get notified, see twistranet.notifier.digest
+NOTIFICATION_WINDOWS = (
+    ("immediate", ugettext_lazy("Immediately")),
+    ("hourly", ugettext_lazy("Hourly digest")),
+    ("daily", ugettext_lazy("Daily digest")),
+)
+
 # Create your models here.
 class Account(twistable.Twistable):
     """
@@ -113,6 +125,22 @@ class Account(twistable.Twistable):
         if callable(role):
             role = role(obj)
 
+        # Results are memoized for the duration of the request
+        cache = account_context.get_request_cache("roles")
+        if cache is None or not obj.id:
+            return self._has_role(role, obj)
+        key = (self.id, obj.id, role, )
+        ret = cache.get(key)
+        if ret is None:
+            ret = cache[key] = self._has_role(role, obj)
+        return ret
+
+    def _has_role(self, role, obj):
+        """
+        Actually compute has_role(). role must already be resolved.
+        """
+        auth = self
+
         # System Account is allowed to do anything.
         if isinstance(auth, SystemAccount):
             return True
@@ -156,9 +184,43 @@ class Account(twistable.Twistable):
         raise RuntimeError("Unexpected role (%s) asked for object '%s' (%s)" % (role, obj and obj.__class__.__name__, obj and obj.id))
 
 
+    @profiled("has_permission")
     def has_permission(self, permission, obj):
         """
         Return true if authenticated user has been granted the given permission on obj.
+        Results are memoized for the duration of the request.
+        """
+        cache = account_context.get_request_cache("permissions")
+        if cache is None or not obj.id:
+            return self._has_permission(permission, obj)
+        key = (self.id, obj.id, permission, )
+        ret = cache.get(key)
+        if ret is None:
+            ret = cache[key] = self._has_permission(permission, obj)
+        return ret
+        
+    def has_permissions_bulk(self, objects, perms):
+        """
+        Check several permissions on several objects at once.
+        Return a {obj.id: {permission: bool}} dict.
+        
+        Network and admin status are resolved once for the whole batch,
+        so that rendering a wall doesn't cost a few queries per content.
+        """
+        objects = list(objects)
+        ret = {}
+        if not objects:
+            return ret
+        if not isinstance(self, SystemAccount):
+            self.network_ids                # Resolved once, then cached on self
+            self.is_admin
+        for obj in objects:
+            ret[obj.id] = dict([ (perm, self.has_permission(perm, obj)) for perm in perms ])
+        return ret
+
+    def _has_permission(self, permission, obj):
+        """
+        Actually compute has_permission().
         """
         # Check roles, strongest first to optimize caching.
         try:
@@ -184,13 +246,19 @@ class Account(twistable.Twistable):
         v = getattr(self, '_is_admin', None)
         if v is not None:
             return v
+        if self.id:
+            self._is_admin = AccountCache(self).get_flag("is_admin", self._get_is_admin)
+        else:
+            self._is_admin = self._get_is_admin()
+        return self._is_admin
+        
+    def _get_is_admin(self):
         import community
         try:
-            self._is_admin = community.AdminCommunity.objects.__booster__.get().is_member
+            return community.AdminCommunity.objects.__booster__.get().isMember(self)
         except community.AdminCommunity.DoesNotExist:
             # No admin community? Strange but possible at boostrap-time.
-            self._is_admin = False
-        return self._is_admin
+            return False
 
 
     #                                           #
@@ -211,7 +279,7 @@ class Account(twistable.Twistable):
     def network_ids(self,):
         """
         Return networks available for queries AAAND myself.
-        XXX TODO: Cache this!
+        Shared across requests with AccountCache.
         """
         if hasattr(self, "_c_network_ids"):
             return self._c_network_ids
@@ -219,6 +287,8 @@ class Account(twistable.Twistable):
         ids = Account.objects.__booster__.filter(
             Q(targeted_network__target__id = self.id) | Q(id = self.id)
             ).values_list("id", flat = True)
+        if self.id:
+            ids = AccountCache(self).get_ids("network_ids", lambda: ids)
         self._c_network_ids = ids
         return ids
 
@@ -254,7 +324,18 @@ class Account(twistable.Twistable):
         
     @property
     def community_ids(self,):
-        return self.communities.values_list("id", flat = True)
+        """
+        Ids of the communities this user is a member of, shared across requests with AccountCache.
+        Unlike the 'communities' property, this is not filtered by what the current user can list.
+        """
+        from community import Community
+        ids = Community.objects.__booster__.filter(
+            targeted_network__target__id = self.id,
+            requesting_network__client__id = self.id,
+        ).values_list("id", flat = True)
+        if not self.id:
+            return ids
+        return AccountCache(self).get_ids("community_ids", lambda: ids)
 
     @property
     def communities_for_display(self,):
@@ -300,6 +381,13 @@ class UserAccount(Account):
     A user account has languages defined so that it primarily 'sees' his favorite languages.
     """
     user = models.OneToOneField(User, unique=True, related_name = "useraccount")
+    notification_window = models.CharField(
+        max_length = 10,
+        choices = NOTIFICATION_WINDOWS,
+        default = "immediate",
+        verbose_name = ugettext_lazy("Notifications"),
+        help_text = ugettext_lazy("Get notified of what happens in your network as it happens, or grouped in a single digest."),
+    )
     is_anonymous = False
 
     # Actual user shortcuts.
@@ -335,10 +423,9 @@ class UserAccount(Account):
         # XXX Maybe this has to be done BEFORE calling super() ?
         if creation:
             glob = community.GlobalCommunity.objects.get()
-            __account__ = SystemAccount.objects.get()
-            glob.join(self)
-            self.follow(self)
-            del __account__
+            with as_account(SystemAccount.objects.get()):
+                glob.join(self)
+                self.follow(self)
             
         log.debug("Saved %s (title = %s)" % (self, self.title, ))
         return ret
@@ -569,15 +656,14 @@ def create_profile(sender, instance, created, *args, **kw):
             return
             
         # We consider we're the SystemAccount now.
-        __account__ = SystemAccount.get()
-        
-        # Actually create profile
-        log.info("Automatic creation of a UserAccount for %s" % instance)
-        profile = UserAccount(
-            user = instance,
-            slug = slugify.slugify(instance.username),
-        )
-        profile.save()
+        with as_account(SystemAccount.get()):
+            # Actually create profile
+            log.info("Automatic creation of a UserAccount for %s" % instance)
+            profile = UserAccount(
+                user = instance,
+                slug = slugify.slugify(instance.username),
+            )
+            profile.save()
     
 post_save.connect(create_profile, sender = User)
         
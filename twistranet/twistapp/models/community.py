@@ -8,6 +8,7 @@ from django.conf import settings
 
 from twistranet.twistapp.lib import permissions
 from twistranet.twistapp.signals import join_community, invite_community, request_join_community
+from twistranet.core.caches import AccountCache
 
 from account import Account, SystemAccount
 from twistable import Twistable
@@ -48,7 +49,17 @@ class Community(Account):
         
     @property
     def member_ids(self):
-        return self.members.values_list("id", flat = True)
+        """
+        Ids of the community members, shared across requests with AccountCache.
+        Unlike the 'members' property, this is not filtered by what the current user can list.
+        """
+        ids = Account.objects.__booster__.filter(
+            targeted_network__target__id = self.id,
+            requesting_network__client__id = self.id,
+        ).values_list("id", flat = True)
+        if not self.id:
+            return ids
+        return AccountCache(self).get_ids("member_ids", lambda: ids)
         
     @property
     def members_for_display(self):
@@ -284,6 +295,8 @@ class Community(Account):
         if not self.can_edit:
             raise PermissionDenied("You can't name somebody as a community manager")
         Network.objects.filter(client__id = account.id, target__id = self.id).update(is_manager = True)
+        AccountCache(account).invalidate()
+        AccountCache(self).invalidate()
 
     def unset_as_manager(self, account):
         """
@@ -295,6 +308,8 @@ class Community(Account):
         if auth.id == account.id:
             raise PermissionDenied("You can't ban yourself from the community managers")
         Network.objects.filter(client__id = account.id, target__id = self.id).update(is_manager = False)
+        AccountCache(account).invalidate()
+        AccountCache(self).invalidate()
 
 
 class GlobalCommunity(Community):
@@ -165,14 +165,19 @@ class Content(_AbstractContent):
         #       - be a member of the publisher ;    (ie. content published on a community)
         #   The comments have one more rule : all the parents that are not in this list are notified
         #   (but this is treated in the Comment class).
+        # Bulk imports don't notify anybody, unless the loader is told to.
+        bulk_loader = getattr(self, "_bulk_loader", None)
+        if bulk_loader and not bulk_loader.notify:
+            return ret
         if creation:
             if self.model_class.type_text_template_creation:
                 listeners = self.listeners
                 if listeners:
-                    content_created.send(
+                    self._send_signal(
+                        content_created,
                         sender = self.__class__, 
                         instance = self, 
-                        target = self.listeners,
+                        target = listeners,
                         text_template = self.model_class.type_text_template_creation,
                         html_template = self.model_class.type_html_template_creation,
                     )
@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
+from twistranet.twistapp.lib import account_context
+from twistranet.core.caches import AccountCache
 from twistranet.twistapp.models import Content
 from twistranet.twistapp.models import Account
 
@@ -74,4 +77,14 @@ class Network(models.Model):
         unique_together = ("client", "target", )
 
 
+def network_changed(sender, instance, **kwargs):
+    """
+    Relations drive roles: forget permissions computed during this request,
+    and the cached network / membership information of both ends.
+    """
+    account_context.invalidate_request_caches()
+    AccountCache(instance.client_id).invalidate()
+    AccountCache(instance.target_id).invalidate()
 
+post_save.connect(network_changed, sender = Network)
+post_delete.connect(network_changed, sender = Network)
@@ -2,10 +2,11 @@ import os
 import mimetypes
 from django.db import models
 from django.db.models import Q, FileField
+from django.db.models.signals import post_save, post_delete
 from django.core.exceptions import ObjectDoesNotExist, ValidationError, PermissionDenied, SuspiciousOperation
 
 from twistranet.twistorage.storage import Twistorage
-from twistranet.twistapp.lib import languages, permissions
+from twistranet.twistapp.lib import languages, permissions, thumbnails
 from  twistranet.twistapp.lib.log import *
 import twistable
 
@@ -75,7 +76,9 @@ class Resource(twistable.Twistable):
             if self.resource_file:
                 self.title = self._pretty_title(self.resource_file.name)
         self.mimetype = self.content_type
-        return super(Resource, self).save(*args, **kw)
+        ret = super(Resource, self).save(*args, **kw)
+        thumbnails.enqueue(self)
+        return ret
         
     def _pretty_title(self, raw_filename):
         """XXX TODO: transform raw filename into a pretty title
@@ -112,13 +115,26 @@ class Resource(twistable.Twistable):
             return self.mimetype_icon
 
     @property
-    def mimetype_icon(self):
+    def thumbnails(self,):
+        """
+        Return the standard thumbnails, as lazy objects. See twistapp.lib.thumbnails.
+        Non-image resources are shown with their mimetype icon.
+        """
+        if not self.resource_file or not self.is_image:
+            return self.mimetype_icon_resource.thumbnails
+        return thumbnails.get_thumbnails(self)
+
+    @property
+    def mimetype_icon_resource(self):
+        """
+        The icon resource for this mimetype, or the default resource picture. Doesn't cost any query.
+        """
         mimetype_slug = self.mimetype.replace('/','_').replace('.','_')
-        try:
-            src = Resource.objects.get(slug = mimetype_slug)
-        except:
-            src = Resource.objects.get(slug = self.default_picture_resource_slug)
-        return src.image
+        return thumbnails.get_default_picture(mimetype_slug) or thumbnails.get_default_picture(self.default_picture_resource_slug)
+
+    @property
+    def mimetype_icon(self):
+        return self.mimetype_icon_resource.image
 
     @property
     def content_type(self,):
@@ -134,6 +150,30 @@ class Resource(twistable.Twistable):
         return ct
 
 
+class ThumbnailManifest(models.Model):
+    """
+    The standard thumbnails rendered for a resource, as JSON. See twistapp.lib.thumbnails.
+    Image resources without a manifest are the ones the thumbnails worker still has to render.
+    resource_id is a plain integer, so that manifests are read and written without loading the resource.
+    """
+    resource_id = models.IntegerField(primary_key = True)
+    sizes = models.TextField()
+
+    class Meta:
+        app_label = 'twistapp'
+
+def resource_saved(sender, instance, **kwargs):
+    if instance.slug in thumbnails.get_default_slugs():
+        thumbnails.reset_default_pictures()
+
+def resource_deleted(sender, instance, **kwargs):
+    thumbnails.delete_manifest(instance.id)
+    resource_saved(sender, instance)
+
+post_save.connect(resource_saved, sender = Resource)
+post_delete.connect(resource_deleted, sender = Resource)
+
+
 # class ImageResource(Resource):
 #     """
 #     An ImageResource if a File with dedicated Image features.
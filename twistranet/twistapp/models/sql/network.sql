@@ -0,0 +1,3 @@
+-- Covering index for the secured listings (see TwistableManager.get_query_set):
+-- "SELECT client_id FROM twistapp_network WHERE target_id = %s" is answered from the index only.
+CREATE INDEX twistapp_network_target_client ON twistapp_network (target_id, client_id);
@@ -0,0 +1,2 @@
+-- The notifier worker polls "WHERE status = 'pending' AND next_attempt_at <= now ORDER BY id".
+CREATE INDEX twistapp_outboxmessage_status_next ON twistapp_outboxmessage (status, next_attempt_at);
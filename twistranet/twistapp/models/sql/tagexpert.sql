@@ -0,0 +1,2 @@
+-- Tag.get_experts() reads "WHERE tag_id = x ORDER BY score DESC LIMIT n".
+CREATE INDEX twistapp_tagexpert_tag_score ON twistapp_tagexpert (tag_id, score);
@@ -0,0 +1,3 @@
+-- Index used by the keyset pagination of walls and timelines (see twistapp/lib/cursor.py):
+-- ORDER BY created_at DESC, id DESC with a (created_at, id) < (%s, %s) condition.
+CREATE INDEX twistapp_twistable_created_at_id ON twistapp_twistable (created_at, id);
@@ -16,17 +16,77 @@ import logging
 import traceback
 from django.db import models
 from django.db.models import Q, loading
+from django.db.models.query import QuerySet
 from django.db.utils import DatabaseError
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, PermissionDenied, ObjectDoesNotExist
 from django.utils.safestring import mark_safe
+from django.conf import settings
 
 from  twistranet.twistapp.lib.log import log
-from twistranet.twistapp.lib import roles, permissions
+from twistranet.twistapp.lib import roles, permissions, account_context
+from twistranet.twistapp.lib.profiling import profiled
 from twistranet.twistapp.lib.slugify import slugify
 from twistranet.twistapp.signals import twistable_post_save
 from fields import ResourceField, PermissionField, TwistableSlugField
 
+# Set TWISTRANET_ACCOUNT_STACK_FALLBACK to True in your settings to find the account by digging the stack
+# when no account context is set. This is slow and is meant for debugging / migration purposes only.
+DEFAULT_TWISTRANET_ACCOUNT_STACK_FALLBACK = False
+_stack_fallback_call_sites = set()
+
+# Max number of ids in a single id__in query when dereferencing objects
+DEREFERENCE_CHUNK_SIZE = 500
+
+def dereference_bulk(objects, select_related = ()):
+    """
+    Return the concrete subclass of each of the given twistables, in the same order.
+    This is the bulk version of Twistable.object: instead of one query per object,
+    it issues one id__in query per (app_label, model_name).
+    Objects which are already concrete are returned as is.
+    Objects which vanished in the meantime are dropped.
+    
+    Like Twistable.object, this doesn't check security again: objects must come from a secured query.
+    """
+    objects = list(objects)
+    ids_by_model = {}
+    fetched_ids = set()
+    for obj in objects:
+        if obj.id is None:
+            raise RuntimeError("You can't get subclass until your object is saved in database.")
+        model = loading.get_model(obj.app_label, obj.model_name)
+        if not isinstance(obj, model):
+            ids_by_model.setdefault(model, []).append(obj.id)
+            fetched_ids.add(obj.id)
+    
+    concrete = {}
+    for model, ids in ids_by_model.items():
+        for start in range(0, len(ids), DEREFERENCE_CHUNK_SIZE):
+            qs = model.objects.__booster__.filter(id__in = ids[start:start + DEREFERENCE_CHUNK_SIZE])
+            if select_related:
+                qs = qs.select_related(*select_related)
+            for obj in qs:
+                concrete[obj.id] = obj
+                
+    ret = []
+    for obj in objects:
+        if obj.id in concrete:
+            ret.append(concrete[obj.id])
+        elif obj.id not in fetched_ids:
+            ret.append(obj)
+    return ret
+
+class TwistableQuerySet(QuerySet):
+    """
+    QuerySet used by all twistable managers.
+    """
+    def as_concrete(self, *select_related):
+        """
+        Evaluate the queryset and return a list of concrete subclasses instead of base objects.
+        See dereference_bulk().
+        """
+        return dereference_bulk(self, select_related)
+
 class TwistableManager(models.Manager):
     """
     It's the base of the security model!!
@@ -39,13 +99,14 @@ class TwistableManager(models.Manager):
         Return a queryset of 100%-authorized objects. All (should) have the can_list perm to True.
         This is in fact a kind of 'has_permission(can_list)' method!
         
-        This method IS very slow. But you can speed things up if you pass either 'request' or '__account__' along the lines.
-        Be aware, however, that in this case you loose the 'safety belt' provided by the security model.
+        Network-restricted objects are filtered with a semi-join on the Network table
+        (the accounts that put the authenticated account in their network), so that
+        no join is added to the listing query itself.
         """
         # Check for anonymous query
-        import community, account, community
+        import community, account, network
         __account__ = self._getAuthenticatedAccount(__account__, request)
-        base_query_set = super(TwistableManager, self).get_query_set()
+        base_query_set = TwistableQuerySet(self.model, using = self._db)
             
         # System account: return all objects without asking any question. And with all permissions set.
         if __account__.id == account.SystemAccount.SYSTEMACCOUNT_ID:
@@ -70,18 +131,19 @@ class TwistableManager(models.Manager):
             return base_query_set
 
         # Regular check. Works for anonymous as well...
-        # network_ids = __account__.network_ids
         if not __account__.is_anonymous:
+            # Access networks this account belongs to, ie. Network.client where Network.target is the account.
+            # This is resolved by the (target_id, client_id) index, see models/sql/network.sql.
+            access_network_ids = network.Network.objects.filter(
+                target__id = __account__.id,
+            ).values_list("client", flat = True)
             qs = base_query_set.filter(
                 Q(
                     owner__id = __account__.id,
                     _p_can_list = roles.owner,
                 ) | Q(
-                    _access_network__targeted_network__target = __account__,
-                    _p_can_list = roles.network,
-                ) | Q(
-                    _access_network__targeted_network__target = __account__,
-                    _p_can_list = roles.public,
+                    _access_network__in = access_network_ids,
+                    _p_can_list__in = (roles.network, roles.public, ),
                 ) | Q(
                     # Anonymous stuff
                     _access_network__isnull = True,
@@ -127,15 +189,18 @@ class TwistableManager(models.Manager):
         # Didn't find anything. We must be anonymous.
         return AnonymousAccount()
                 
+    @profiled("_getAuthenticatedAccount")
     def _getAuthenticatedAccount(self, __account__ = None, request = None):
         """
-        Dig the stack to find the authenticated account object.
-        Return either a (possibly generic) account object or None.
+        Return the authenticated account object. Never returns None (AnonymousAccount is returned instead).
         
-        Views with a "request" parameter magically works with that.
-        If you want to use a system account, declare a '__account__' variable in your caller function.
+        Lookup order is:
+        - the '__account__' or 'request' parameters, if given ;
+        - the account pushed with account_context.as_account() (it always has precedence over the request) ;
+        - the request bound by AccountContextMiddleware ;
+        - the stack-digging fallback, only if TWISTRANET_ACCOUNT_STACK_FALLBACK is set.
         """
-        from account import Account, AnonymousAccount, UserAccount
+        from account import Account, AnonymousAccount
 
         # If we have the __account__ object, then it's quite obvious here...
         if isinstance(__account__, Account):
@@ -145,32 +210,55 @@ class TwistableManager(models.Manager):
         if request:
             return self.getCurrentAccount(request)
 
-        # We dig into the stack frame to find the request object.
+        # Explicit account, then request-bound account
+        auth = account_context.get_current_account()
+        if auth is not None:
+            return auth
+        request = account_context.get_current_request()
+        if request is not None:
+            return self.getCurrentAccount(request)
+            
+        # Legacy behaviour. Slow, so it's only here to help finding call sites to migrate.
+        if getattr(settings, 'TWISTRANET_ACCOUNT_STACK_FALLBACK', DEFAULT_TWISTRANET_ACCOUNT_STACK_FALLBACK):
+            return self._getAccountFromStack()
+
+        # Didn't find anything. We must be anonymous.
+        return AnonymousAccount()
+
+    def _getAccountFromStack(self, ):
+        """
+        Dig the stack to find the authenticated account object.
+        Views with a "request" local variable magically work with that,
+        and so does any caller declaring an '__account__' local variable.
+        
+        Each call site where this fallback actually finds an account is logged once,
+        so that it can be migrated to account_context.
+        """
+        from account import Account, AnonymousAccount, UserAccount
+
         frame = inspect.currentframe()
         try:
             while frame:
-                frame_members = dict(inspect.getmembers(frame))
+                _locals = frame.f_locals
+                found = None
                 
-                # Inspect 'locals' variables to get the request or __account__
-                _locals = frame_members.get('f_locals', None)
-                if _locals:
-                    # Check for an __acount__ variable holding a generic Account object. It always has precedence over 'request'
-                    if _locals.has_key('__account__') and isinstance(_locals['__account__'], Account):
-                        return _locals['__account__']
+                # Check for an __acount__ variable holding a generic Account object. It always has precedence over 'request'
+                if isinstance(_locals.get('__account__', None), Account):
+                    found = _locals['__account__']
                 
-                    # Check for a request.user User object
-                    if _locals.has_key('request'):
-                        u = getattr(_locals['request'], 'user', None)
-                        if isinstance(u, User):
-                            # We use this instead of the get_profile() method to avoid an infinite recursion here.
-                            # We mimic the _profile_cache behavior of django/contrib/auth/models.py to avoid doing a lot of requests on the same object
-                            if not hasattr(u, '_account_cache'):
-                                u._account_cache = UserAccount.objects.__booster__.get(user__id__exact = u.id)
-                                u._account_cache.user = u
-                            return u._account_cache
+                # Check for a request.user User object
+                elif _locals.has_key('request') and isinstance(getattr(_locals['request'], 'user', None), User):
+                    found = self.getCurrentAccount(_locals['request'])
+
+                if found is not None:
+                    where = (frame.f_code.co_filename, frame.f_lineno, )
+                    if where not in _stack_fallback_call_sites:
+                        _stack_fallback_call_sites.add(where)
+                        log.warning("Authenticated account found by digging the stack at %s:%d. Please use account_context instead." % where)
+                    return found
             
                 # Get back to the upper frame
-                frame = frame_members.get('f_back', None)
+                frame = frame.f_back
                         
             # Didn't find anything. We must be anonymous.
             return AnonymousAccount()
@@ -178,14 +266,13 @@ class TwistableManager(models.Manager):
         finally:
             # Avoid circular refs
             frame = None
-            stack = None
-            del _locals
+            _locals = None
 
 
     # Backdoor for performance purposes. Use it at your own risk as it breaks security.
     @property
     def __booster__(self):
-        return super(TwistableManager, self).get_query_set()
+        return TwistableQuerySet(self.model, using = self._db)
 
     @property
     def can_create(self,):
@@ -254,7 +341,7 @@ class Twistable(_AbstractTwistable):
     _access_network = models.ForeignKey("Account", null = True, blank = True, related_name = "+", db_index = True, )
     
     # Scoring information. This is stored directly on the object for performance reasons.
-    # Should be updated by BATCH, not necessarily 'live' (for perf reasons as well).
+    # Should be updated by BATCH, not necessarily 'live' (for perf reasons as well): see lib/scoring.py.
     static_score = models.IntegerField(default = 0)
         
     # The permissions. It's strongly forbidden to edit those roles by hand, use the 'permissions' property instead.
@@ -320,20 +407,25 @@ class Twistable(_AbstractTwistable):
         """
         Return actual picture for this content or default picture if not available.
         May return None!
-        XXX SHOULD CACHE THIS
+        Default pictures come from a process-wide registry, so picture-less objects don't cost any query.
+        The result is memoized on the object.
         """
         import resource
+        from twistranet.twistapp.lib import thumbnails
+        if hasattr(self, "_forced_picture"):
+            return self._forced_picture
         if issubclass(self.model_class, resource.Resource):
-            return self.object
-        try:
-            picture = self.picture
+            picture = self.object
+        else:
+            picture = None
+            if self.picture_id is not None:
+                try:
+                    picture = self.picture
+                except resource.Resource.DoesNotExist:
+                    pass
             if picture is None:
-                raise resource.Resource.DoesNotExist()
-        except resource.Resource.DoesNotExist:
-            try:
-                picture = resource.Resource.objects.get(slug = self.model_class.default_picture_resource_slug)
-            except resource.Resource.DoesNotExist:
-                return None
+                picture = thumbnails.get_default_picture(self.model_class.default_picture_resource_slug)
+        self._forced_picture = picture
         return picture
         
     def get_thumbnail(self, *args, **kw):
@@ -345,31 +437,26 @@ class Twistable(_AbstractTwistable):
             return default.backend.get_thumbnail(self.forced_picture.image, *args, **kw)
         except:
             # in rare situations (CMJK + PNG mode, sorl thumbnail raise an error)
-            import resource
-            picture = resource.Resource.objects.get(slug = self.model_class.default_picture_resource_slug)
+            from twistranet.twistapp.lib import thumbnails
+            picture = thumbnails.get_default_picture(self.model_class.default_picture_resource_slug)
             return default.backend.get_thumbnail(picture.image, *args, **kw)
         
     @property
     def thumbnails(self,):
         """
-        Return a dict of standard thumbnails methods.
-        XXX TODO: Cache this! And use lazy resolution!
+        Return a dict of standard thumbnails (see twistapp.lib.thumbnails),
+        ie. the ones of this object's picture.
         Some day resources will be able to have several DIFFERENT previews...
-        
-        Preview: Max = 500x500; Used when a large version should be available.
-        Summary: Max = 100x100;
-        Summary Preview: Max = Min = 100x100;
-        Medium:  Max = Min = 50x50;
-        Icon:    Max = Min = 16x16;
-        """
-        return {
-            "preview":           self.get_thumbnail("500x500", crop = "", upscale = False),
-            "summary":           self.get_thumbnail("100x100", crop = "", upscale = False),
-            "summary_preview":   self.get_thumbnail("100x100", crop = "center top", upscale = True),
-            "medium":            self.get_thumbnail("50x50", crop = "center top", upscale = True),
-            "big_icon":          self.get_thumbnail("32x32", upscale = False),
-            "icon":              self.get_thumbnail("16x16", crop = "center top", upscale = True),
-        }
+        """
+        from twistranet.twistapp.lib import thumbnails
+        import resource
+        if not issubclass(self.model_class, resource.Resource) and self.picture_id is None:
+            # Shared by all picture-less objects of this class
+            return thumbnails.get_default_thumbnails(self.model_class.default_picture_resource_slug)
+        picture = self.forced_picture
+        if picture is None:
+            return {}
+        return picture.thumbnails
                 
             
     #                                                                   #
@@ -385,6 +472,12 @@ class Twistable(_AbstractTwistable):
         
         auth = Twistable.objects._getAuthenticatedAccount()
 
+        # The picture may have changed
+        self.__dict__.pop("_forced_picture", None)
+        
+        # Objects created by the bulk fixture loader have their slug / unicity checked beforehand.
+        bulk_loader = getattr(self, "_bulk_loader", None)
+
         # Check if we're saving a real object and not a generic Content one (which is prohibited).
         # This must be a programming error, then.
         if self.__class__.__name__ == Twistable.__name__:
@@ -458,7 +551,7 @@ class Twistable(_AbstractTwistable):
             else:
                 self.slug = slugify(self.model_name)
             self.slug = self.slug[:40]
-        if created and self.__class__._FORCE_SLUG_CREATION:
+        if created and self.__class__._FORCE_SLUG_CREATION and not bulk_loader:
             while Twistable.objects.__booster__.filter(slug = self.slug).exists():
                 match = re.search("_(?P<num>[0-9]+)$", self.slug)
                 if match:
@@ -470,15 +563,40 @@ class Twistable(_AbstractTwistable):
                 self.slug = "%s_%i" % (root, num, )
         
         # Perform a full_clean on the model just to be sure it validates correctly
-        self.full_clean()
+        if bulk_loader:
+            self.clean_fields()
+            self.clean()
+        else:
+            self.full_clean()
             
-        # Save and update access network information
-        ret = super(Twistable, self).save(*args, **kw)
-        self._update_access_network()
+        # Save and update access network information.
+        # A new bulk-loaded object can't have dependant objects yet, so we compute its access network in memory.
+        if bulk_loader and created:
+            self._compute_access_network()
+            ret = super(Twistable, self).save(*args, **kw)
+            if self._access_network is self:
+                # An account restricted to its network is its own access network: it was assigned before
+                # the object had an id, so _access_network_id is still None (and was saved as such).
+                self._access_network_id = self.id
+                Twistable.objects.__booster__.filter(id = self.id).update(_access_network = self.id)
+        else:
+            ret = super(Twistable, self).save(*args, **kw)
+            self._update_access_network()
+        account_context.invalidate_request_caches()
 
         # Send TN's post-save signal
-        twistable_post_save.send(sender = self.__class__, instance = self, created = created)
+        self._send_signal(twistable_post_save, sender = self.__class__, instance = self, created = created)
         return ret
+        
+    def _send_signal(self, signal, **kwargs):
+        """
+        Send the given signal, or queue it if this object is being bulk-loaded.
+        """
+        bulk_loader = getattr(self, "_bulk_loader", None)
+        if bulk_loader is not None:
+            bulk_loader.defer(signal, **kwargs)
+        else:
+            signal.send(**kwargs)
 
     def _update_access_network(self, ):
         """
@@ -486,14 +604,42 @@ class Twistable(_AbstractTwistable):
         If save is False, won't save result (useful when save() is performed later).
         """
         # No id => this twistable doesn't control anything, we pass. Value will be set AFTER saving.
-        import account, community
         if not self.id:
             raise ValueError("Can't set _access_network before saving the object.")
+        obj = self._compute_access_network()
+
+        # Update this object itself without calling the save() method again
+        Twistable.objects.__booster__.filter(id = self.id).update(_access_network = self._access_network)
+
+        # Update dependant objects if current object's network changed for public role
+        Twistable.objects.__booster__.filter(
+            Q(_access_network__id = self.id) | Q(publisher = self.id),
+            _p_can_list = roles.public,
+        ).exclude(id = self.id).update(_access_network = obj)
+        
+        # This is an additional check to ensure that no _access_network = None object with _p_can_list|_p_can_view = public still remains
+        # glob = community.GlobalCommunity.get()
+        # Twistable.objects.__booster__.filter(
+        #     _access_network__isnull = True,
+        #     _p_can_list = roles.public
+        # ).update(_access_network = glob)
+        
+    def _compute_access_network(self, ):
+        """
+        Set self._access_network in memory, from the permissions and the publisher chain.
+        Return the object that dependant public objects must get as their access network.
+        
+        This can be called before the object is saved (see the bulk fixture loader), in which case
+        an account restricted to its network gets an _access_network only once it has an id.
+        """
+        import account, community
             
         # Update current object. We save current access and determine the more restrictive _p_can_list access permission.
         # Remember that a published content has its permissions determined by its publisher's can_VIEW permission!
-        _current_access_network = self._access_network
-        obj = self.object
+        if self.id is None:
+            obj = self
+        else:
+            obj = self.object
         if issubclass(obj.model_class, account.Account):
             _p_can_list = self._p_can_list
         else:
@@ -533,22 +679,7 @@ class Twistable(_AbstractTwistable):
                         raise ValueError("Unexpected can_list role found: %d on object %s" % (obj._p_can_list, obj))
         else:
             raise ValueError("Unexpected can_list role found: %d on object %s" % (obj._p_can_list, obj))
-
-        # Update this object itself without calling the save() method again
-        Twistable.objects.__booster__.filter(id = self.id).update(_access_network = self._access_network)
-
-        # Update dependant objects if current object's network changed for public role
-        Twistable.objects.__booster__.filter(
-            Q(_access_network__id = self.id) | Q(publisher = self.id),
-            _p_can_list = roles.public,
-        ).exclude(id = self.id).update(_access_network = obj)
-        
-        # This is an additional check to ensure that no _access_network = None object with _p_can_list|_p_can_view = public still remains
-        # glob = community.GlobalCommunity.get()
-        # Twistable.objects.__booster__.filter(
-        #     _access_network__isnull = True,
-        #     _p_can_list = roles.public
-        # ).update(_access_network = glob)
+        return obj
             
     def delete(self,):
         """
@@ -560,6 +691,7 @@ class Twistable(_AbstractTwistable):
         """
         self.clear_nullable_related()
         super(Twistable, self).delete()
+        account_context.invalidate_request_caches()
 
     def clear_nullable_related(self):
         """
@@ -5,6 +5,7 @@ This is from http://code.google.com/p/django-menu/
 
 from twistranet.twistapp.models import Menu, MenuItem  
 from django import template  
+from twistranet.twistapp.lib.profiling import profiled
 
 register = template.Library()  
    
@@ -22,6 +23,7 @@ class MenuObject(template.Node):
     def __init__(self, menu_name):  
         self.menu_name = menu_name  
    
+    @profiled("menubuilder")
     def render(self, context):  
         try:
             current_path = template.resolve_variable('path', context)
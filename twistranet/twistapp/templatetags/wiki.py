@@ -19,6 +19,7 @@ from django.core.urlresolvers import reverse
 from twistranet.twistapp.lib import slugify
 from twistranet.twistapp.models import Account, Content, Resource
 from  twistranet.twistapp.lib.log import log
+from twistranet.twistapp.lib.profiling import profiled
 
 register = template.Library()
 
@@ -96,6 +97,7 @@ class Subf(object):
         return subst
 
 
+@profiled("wiki")
 def escape_wiki(text, lookup = False, autoescape=None):
     """
     This safely escapes the HTML content and replace all links, @, etc by their TN counterpart.
@@ -5,6 +5,14 @@ from wall import WallTest
 from resources import ResourcesTest
 from account_security import AccountSecurityTest
 from menu import MenuTest
+from timeline import TimelineTest
+from notifier import NotifierTest
+from search import SearchTest
+from tags import TagsTest
+from scoring import ScoringTest
+from cursor import CursorTest
+from benchmark import BenchmarkTest
+from profiling import ProfilingTest
 # all brokens i think we can remove it
 # from views_test import ViewsTest
 
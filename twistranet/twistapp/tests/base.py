@@ -1,6 +1,9 @@
 from django.test import TestCase
 from django.conf import settings
+from django.core.cache import cache
 from twistranet.twistapp.models import *
+from twistranet.twistapp.lib import account_context
+from twistranet.twistapp.lib.account_context import set_current_account
 from twistranet.core import bootstrap
 
 class TNBaseTest(TestCase):
@@ -8,15 +11,27 @@ class TNBaseTest(TestCase):
         """
         Get A and B users
         """
+        # Database is rolled back between tests, cached ids must go as well
+        cache.clear()
         settings.TWISTRANET_IMPORT_SAMPLE_DATA = True
         # do not import cogip samples
         settings.TWISTRANET_IMPORT_COGIP = False
+        # Notifications are handled synchronously unless a test says otherwise
+        settings.TWISTRANET_NOTIFIER_QUEUE = False
+        settings.TWISTRANET_COMMUNITY_DIGEST_WINDOW = "immediate"
+        # Never index test contents in the real search index
+        settings.TWISTRANET_SEARCH_INDEX = ":memory:"
+        # Thumbnails are rendered synchronously
+        settings.TWISTRANET_THUMBNAIL_QUEUE = False
         bootstrap.bootstrap()
         bootstrap.repair()
         
-        __account__ = SystemAccount.get()
-        self.system = __account__
+        self.system = SystemAccount.get()
+        set_current_account(self.system)
         self.A = UserAccount.objects.get(user__username = "A").account_ptr
         self.B = UserAccount.objects.get(user__username = "B").account_ptr
         self.C = UserAccount.objects.get(user__username = "C").account_ptr
-        self.admin = UserAccount.objects.get(user__username = "admin").account_ptr
\ No newline at end of file
+        self.admin = UserAccount.objects.get(user__username = "admin").account_ptr
+
+    def tearDown(self):
+        account_context.clear()
@@ -0,0 +1,71 @@
+"""
+Benchmark runner tests.
+"""
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from twistranet.twistapp.lib import benchmark
+
+try:
+    # python 2.6
+    import json
+except:
+    # python 2.4 with simplejson
+    import simplejson as json
+
+class FakeResponse(object):
+    status_code = 200
+
+class FakeClient(object):
+    """
+    A client which runs a single query per request
+    """
+    def __init__(self):
+        self.requests = 0
+
+    def get(self, url, data = None):
+        self.requests += 1
+        list(Twistable.objects.__booster__.values_list("id", flat = True)[:1])
+        return FakeResponse()
+
+class BenchmarkTest(TNBaseTest):
+
+    def test_percentile(self):
+        values = range(11, 0, -1)           # Unsorted on purpose
+        self.failUnlessEqual(benchmark.percentile(values, 0), 1)
+        self.failUnlessEqual(benchmark.percentile(values, 50), 6)
+        self.failUnlessEqual(benchmark.percentile(values, 95), 11)
+        self.failUnlessEqual(benchmark.percentile(values, 100), 11)
+        self.failUnlessEqual(benchmark.percentile([ 42 ], 95), 42)
+        self.failUnlessEqual(benchmark.percentile([], 50), None)
+
+    def test_runner(self):
+        client = FakeClient()
+        runner = benchmark.Runner(client = client, iterations = 5, warmup = 2)
+        result = runner("fake", "/fake")
+        self.failUnlessEqual(client.requests, 7)
+        self.failUnlessEqual(set(result.keys()), set([
+            "name", "url", "status", "iterations", "p50_ms", "p95_ms", "mean_ms", "queries", "max_queries", "rows",
+        ]))
+        self.failUnlessEqual(result["name"], "fake")
+        self.failUnlessEqual(result["status"], 200)
+        self.failUnlessEqual(result["iterations"], 5)
+        self.failUnlessEqual(result["queries"], 1)
+        self.failUnlessEqual(result["max_queries"], 1)
+        self.failUnless(result["p50_ms"] <= result["p95_ms"])
+
+        # Results are JSON-serializable, as the twistranet_benchmark command dumps them
+        self.failUnlessEqual(json.loads(json.dumps(runner.results))[0]["name"], "fake")
+
+    def test_failing_benchmark(self):
+        """
+        A failing benchmark is recorded, and doesn't stop the run
+        """
+        def broken(run, context):
+            raise ValueError("Broken on purpose")
+        benchmark.BENCHMARKS.append(broken)
+        try:
+            runner = benchmark.Runner(client = FakeClient(), iterations = 1, warmup = 0)
+            results = runner.run(benchmark.BenchmarkContext(self.A), names = [ "broken" ])
+        finally:
+            benchmark.BENCHMARKS.remove(broken)
+        self.failUnlessEqual(results, [ {"name": "broken", "error": "ValueError: Broken on purpose"} ])
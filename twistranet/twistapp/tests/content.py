@@ -2,6 +2,8 @@
 This is a set of account permissions tests
 """
 from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account
+from twistranet.twistapp.lib.python_fixture import Fixture, BulkLoader
 from twistranet.twistapp.models import *
 from twistranet.content_types import *
 from twistranet.twistapp.lib import permissions, roles
@@ -17,4 +19,41 @@ class ContentTest(TNBaseTest):
     B  => admin
     """
 
+    def test_dereference_bulk(self):
+        """
+        as_concrete() returns subclasses, in the queryset's order, whatever their type.
+        """
+        set_current_account(self.A)
+        s1 = StatusUpdate(description = "Hello", permissions = "public")
+        s1.save()
+        d = Document(title = "A document", text = "Hello, World!", permissions = "public")
+        d.save()
+        s2 = StatusUpdate(description = "There", permissions = "public")
+        s2.save()
+        ids = [s1.id, d.id, s2.id]
+        objects = Content.objects.filter(id__in = ids).order_by("id").as_concrete()
+        self.failUnlessEqual([ o.id for o in objects ], ids)
+        self.failUnlessEqual([ o.__class__ for o in objects ], [StatusUpdate, Document, StatusUpdate])
+        self.failUnlessEqual([ o.id for o in dereference_bulk(Twistable.objects.filter(id__in = ids).order_by("-id")) ], ids[::-1])
 
+    def test_bulk_loader(self):
+        """
+        Bulk-loaded objects get the same permissions and access network as regularly saved ones.
+        """
+        set_current_account(self.system)
+        stats = BulkLoader([
+            Fixture(StatusUpdate, logged_account = "A", slug = "bulk_network", description = "Hello", permissions = "network"),
+            Fixture(StatusUpdate, logged_account = "A", slug = "bulk_public", description = "Hello", permissions = "public"),
+            Fixture(StatusUpdate, logged_account = "A", slug = "bulk_network", description = "Duplicate"),
+        ]).load()
+        self.failUnlessEqual((stats["created"], stats["skipped"]), (2, 1))
+        
+        set_current_account(self.A)
+        for permission in ("network", "public", ):
+            regular = StatusUpdate(description = "Hello", permissions = permission)
+            regular.save()
+            regular = Twistable.objects.__booster__.get(id = regular.id)
+            bulk = Twistable.objects.__booster__.get(slug = "bulk_%s" % permission)
+            self.failUnlessEqual(bulk._access_network_id, regular._access_network_id)
+            self.failUnlessEqual(bulk._p_can_list, regular._p_can_list)
+            self.failUnlessEqual(bulk.publisher_id, self.A.id)
@@ -0,0 +1,63 @@
+"""
+Keyset pagination tests.
+"""
+import datetime
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account
+from twistranet.twistapp.lib import cursor
+from twistranet.twistapp.models import *
+from twistranet.content_types import *
+
+class CursorTest(TNBaseTest):
+
+    def setUp(self):
+        """
+        Publish 5 status updates as A, the 3 last ones at the very same time.
+        """
+        super(CursorTest, self).setUp()
+        set_current_account(self.A)
+        self.ids = []
+        for i in range(5):
+            s = StatusUpdate(description = "Page me %d" % i, permissions = "public")
+            s.save()
+            self.ids.append(s.id)
+        self.ids.reverse()      # Most recent first
+        same_time = datetime.datetime(2011, 1, 1, 12, 0, 0, 123456)
+        Content.objects.__booster__.filter(id__in = self.ids[:3]).update(created_at = same_time)
+        Content.objects.__booster__.filter(id__in = self.ids[3:]).update(created_at = same_time - datetime.timedelta(days = 1))
+        self.qs = Content.objects.filter(id__in = self.ids)
+
+    def test_encode_decode(self):
+        created_at = datetime.datetime(2011, 1, 1, 12, 0, 0, 123456)
+        self.failUnlessEqual(cursor.decode_cursor(cursor.encode_cursor(created_at, 42)), (created_at, 42))
+
+    def test_invalid_tokens(self):
+        for token in (None, "", "garbage", u"\xe9t\xe9", "bm90IGEgZGF0ZXw0Mg==", cursor.encode_cursor(datetime.datetime.now(), 1)[:-4]):
+            self.failUnlessEqual(cursor.decode_cursor(token), None)
+        # An invalid token gives the first page
+        ids, next_token = cursor.keyset_page(self.qs, "garbage", 2)
+        self.failUnlessEqual(ids, self.ids[:2])
+
+    def test_ties(self):
+        """
+        Items sharing the same created_at are ordered by id, and none is skipped or repeated
+        """
+        ids, next_token = cursor.keyset_page(self.qs, None, 2)
+        self.failUnlessEqual(ids, self.ids[:2])
+        self.failUnless(next_token)
+        ids, next_token = cursor.keyset_page(self.qs, next_token, 2)
+        self.failUnlessEqual(ids, self.ids[2:4])
+        self.failUnless(next_token)
+
+        # Last page
+        ids, next_token = cursor.keyset_page(self.qs, next_token, 2)
+        self.failUnlessEqual(ids, self.ids[4:])
+        self.failUnlessEqual(next_token, None)
+
+    def test_exact_last_page(self):
+        """
+        No next page when the last page is full
+        """
+        ids, next_token = cursor.keyset_page(self.qs, None, 5)
+        self.failUnlessEqual(ids, self.ids)
+        self.failUnlessEqual(next_token, None)
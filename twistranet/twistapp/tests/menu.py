@@ -3,6 +3,7 @@
 Test basic menu features.
 """
 from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account
 from twistranet.twistapp.models import *
 from twistranet.content_types import *
 from twistranet.core import bootstrap
@@ -20,7 +21,7 @@ class MenuTest(TNBaseTest):
         """
         Create a menu and test if it's available
         """
-        __account__ = self.admin
+        set_current_account(self.admin)
         menu = Menu.objects.create(
             slug = "test",
             title = "Test Menu",
@@ -35,7 +36,7 @@ class MenuTest(TNBaseTest):
         self.failUnless(item in menu.children, "A menu item must appear in its children")
 
         # Check if sbd else can see the menu (they're public by default)
-        __account__ = self.A
+        set_current_account(self.A)
         self.failUnless(Menu.objects.filter(slug = 'test').exists())
         self.failUnless(MenuItem.objects.filter(slug = "menuitem").exists())
         item = MenuItem.objects.get(slug = "menuitem")
@@ -45,7 +46,7 @@ class MenuTest(TNBaseTest):
         """
         Create a menu and test if it's available
         """
-        __account__ = self.admin
+        set_current_account(self.admin)
         c = Community.objects.create(
             title = "Test community",
             permissions = "private",
@@ -70,7 +71,7 @@ class MenuTest(TNBaseTest):
         self.failUnless(cid in [ item.target_id for item in menu.children ], "The target must be visible in menu's children")
         
         # Check that sbd who can't see the community can't access the menu
-        __account__ = self.A
+        set_current_account(self.A)
         self.failIf(cid in [ item.target_id for item in menu.children ])
         
 
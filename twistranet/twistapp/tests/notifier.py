@@ -0,0 +1,201 @@
+"""
+Notifier queue tests.
+"""
+import pickle
+import datetime
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends import locmem
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account
+from twistranet.twistapp.models import *
+from twistranet.content_types import *
+from twistranet.notifier import queue, handlers, digest
+from twistranet.notifier.models import Notification, OutboxMessage, DigestEvent
+
+class FailingHandler(handlers.NotifierHandler):
+    key = "test:failing"
+    
+    def handle(self, sender, **kwargs):
+        raise IOError("SMTP server is down")
+
+class CountingBackend(locmem.EmailBackend):
+    connections = 0
+    
+    def __init__(self, *args, **kwargs):
+        CountingBackend.connections += 1
+        super(CountingBackend, self).__init__(*args, **kwargs)
+
+class NotifierTest(TNBaseTest):
+    """
+    A creates a community, B joins it.
+    """
+    def setUp(self):
+        super(NotifierTest, self).setUp()
+        settings.TWISTRANET_NOTIFIER_QUEUE = True
+        settings.TWISTRANET_NOTIFIER_DIGESTS = True
+        self._images_as_attachments = getattr(settings, "SEND_EMAIL_IMAGES_AS_ATTACHMENTS", True)
+        settings.SEND_EMAIL_IMAGES_AS_ATTACHMENTS = False
+        set_current_account(self.A)
+        self.community = Community(slug = "notified", permissions = "workgroup")
+        self.community.save()
+        self.community.join(self.B)
+
+    def tearDown(self):
+        settings.TWISTRANET_NOTIFIER_QUEUE = False
+        settings.TWISTRANET_NOTIFIER_DIGESTS = False
+        settings.TWISTRANET_COMMUNITY_DIGEST_WINDOW = "immediate"
+        settings.SEND_EMAIL_IMAGES_AS_ATTACHMENTS = self._images_as_attachments
+        super(NotifierTest, self).tearDown()
+
+    def test_queued_mail(self):
+        """
+        Posting only queues the notifications, the worker sends them.
+        """
+        mail.outbox = []
+        s = StatusUpdate(description = "Hello everybody", publisher = self.community)
+        s.save()
+        self.failIf(mail.outbox)
+        self.failUnless(OutboxMessage.objects.filter(handler__startswith = "MailHandler").exists())
+        
+        stats = queue.Worker(rate = 1000).run()
+        self.failUnlessEqual(stats["dead"], 0)
+        self.failUnlessEqual([ m.to for m in mail.outbox ], [ [ self.B.object.email ] ])
+        self.failIf(OutboxMessage.objects.exists())
+        
+        # The join_community notification has been created by the worker as well
+        set_current_account(self.system)
+        self.failUnless(Notification.objects.filter(publisher = self.community).exists())
+
+    def test_retry_and_dead_letter(self):
+        """
+        Failing rows are retried later, then flagged as dead.
+        """
+        handler = FailingHandler()
+        handler.register()
+        OutboxMessage.objects.all().delete()
+        message = queue.enqueue(handler, None, {"target": self.B, "message": "hello"})
+        worker = queue.Worker(rate = 1000, max_attempts = 2)
+        worker.run()
+        message = OutboxMessage.objects.get(id = message.id)
+        self.failUnlessEqual((message.status, message.attempts), (OutboxMessage.STATUS_PENDING, 1))
+        self.failUnless(message.next_attempt_at > datetime.datetime.now())
+        self.failUnless("SMTP server is down" in message.last_error)
+        
+        OutboxMessage.objects.filter(id = message.id).update(next_attempt_at = datetime.datetime.now())
+        worker.run()
+        message = OutboxMessage.objects.get(id = message.id)
+        self.failUnlessEqual((message.status, message.attempts), (OutboxMessage.STATUS_DEAD, 2))
+        
+        self.failUnlessEqual(queue.requeue_dead(), 1)
+        self.failUnlessEqual(OutboxMessage.objects.get(id = message.id).status, OutboxMessage.STATUS_PENDING)
+
+    def test_purge_dead(self):
+        """
+        Dead rows are deleted once they're older than the retention delay
+        """
+        OutboxMessage.objects.all().delete()
+        message = queue.enqueue(FailingHandler(), None, {"target": self.B, "message": "reset your password"})
+        OutboxMessage.objects.filter(id = message.id).update(status = OutboxMessage.STATUS_DEAD)
+        self.failUnlessEqual(queue.purge_dead(60), 0)
+        OutboxMessage.objects.filter(id = message.id).update(created_at = datetime.datetime.now() - datetime.timedelta(seconds = 120))
+        self.failUnlessEqual(queue.purge_dead(60), 1)
+        self.failIf(OutboxMessage.objects.exists())
+
+    def test_batched_mail(self):
+        """
+        Recipients of the same content get the same rendering, over a single connection.
+        """
+        self.community.join(self.C)
+        s = StatusUpdate(description = "Hello everybody", publisher = self.community)
+        s.save()
+        
+        backend = settings.EMAIL_BACKEND
+        settings.EMAIL_BACKEND = "twistranet.twistapp.tests.notifier.CountingBackend"
+        try:
+            mail.outbox = []
+            CountingBackend.connections = 0
+            stats = queue.Worker(rate = 1000).run()
+        finally:
+            settings.EMAIL_BACKEND = backend
+        messages = [ m for m in mail.outbox if m.subject == mail.outbox[0].subject ]
+        self.failUnlessEqual(sorted([ m.to[0] for m in messages ]), sorted([ self.B.object.email, self.C.object.email ]))
+        self.failUnlessEqual(messages[0].body, messages[1].body)
+        self.failIf(handlers.RECIPIENT_PLACEHOLDER in messages[0].body)
+        self.failUnlessEqual(CountingBackend.connections, 1)
+        self.failUnless(stats["per_second"] > 0)
+
+    def test_digest_mail(self):
+        """
+        B wants a daily digest: B gets nothing until the day is over, then a single email.
+        """
+        UserAccount.objects.__booster__.filter(id = self.B.id).update(notification_window = "daily")
+        queue.Worker(rate = 1000).run()
+        mail.outbox = []
+        for i in range(3):
+            StatusUpdate(description = "Hello #%d" % i, publisher = self.community).save()
+        queue.Worker(rate = 1000).run()
+        self.failIf(mail.outbox)
+        self.failUnlessEqual(DigestEvent.objects.filter(account = self.B).count(), 3)
+        
+        set_current_account(self.system)
+        self.failUnlessEqual(digest.flush(), 0)
+        self.failUnlessEqual(digest.flush(datetime.datetime.now() + datetime.timedelta(days = 1, seconds = 1)), 3)
+        self.failUnlessEqual([ m.to for m in mail.outbox ], [ [ self.B.object.email ] ])
+        self.failIf(DigestEvent.objects.exists())
+
+    def test_digests_disabled(self):
+        """
+        Without TWISTRANET_NOTIFIER_DIGESTS, nobody waits for a digest which would never be sent.
+        """
+        settings.TWISTRANET_NOTIFIER_DIGESTS = False
+        UserAccount.objects.__booster__.filter(id = self.B.id).update(notification_window = "daily")
+        queue.Worker(rate = 1000).run()
+        mail.outbox = []
+        StatusUpdate(description = "Hello", publisher = self.community).save()
+        queue.Worker(rate = 1000).run()
+        self.failIf(DigestEvent.objects.exists())
+        self.failUnless([ self.B.object.email ] in [ m.to for m in mail.outbox ])
+
+    def test_digest_notification(self):
+        """
+        Members joining a community in the same hour make a single notification.
+        """
+        queue.Worker(rate = 1000).run()
+        settings.TWISTRANET_COMMUNITY_DIGEST_WINDOW = "hourly"
+        set_current_account(self.A)
+        self.community.join(self.C)
+        self.community.join(self.admin)
+        queue.Worker(rate = 1000).run()
+        set_current_account(self.system)
+        before = Notification.objects.filter(publisher = self.community).count()
+        digest.flush(datetime.datetime.now() + datetime.timedelta(hours = 1, seconds = 1))
+        notifications = Notification.objects.filter(publisher = self.community).order_by("-id")
+        self.failUnlessEqual(notifications.count(), before + 1)
+        self.failUnlessEqual(sorted(notifications[0].parameters["client"]), sorted([ self.C.id, self.admin.id ]))
+        self.failUnless(notifications[0].message)
+
+    def test_notification_message(self):
+        """
+        Messages are stored as JSON, and rendered again when a parameter is renamed.
+        """
+        queue.Worker(rate = 1000).run()
+        set_current_account(self.system)
+        n = Notification.objects.filter(publisher = self.community).order_by("-id")[0]
+        self.failUnless(n._encoded_parameters.startswith("{"))
+        self.failUnless(n.message)
+        
+        set_current_account(self.A)
+        community = Community.objects.get(id = self.community.id)
+        community.title = "Renamed community"
+        community.save()
+        set_current_account(self.system)
+        notifications = list(Notification.objects.filter(publisher = self.community))
+        Notification.prepare_summaries(notifications)
+        for notification in notifications:
+            self.failUnless("Renamed community" in notification.message)
+        
+        # Pickled parameters are still readable
+        legacy = Notification.objects.get(id = n.id)
+        legacy._encoded_parameters = pickle.dumps(n.parameters)
+        self.failUnlessEqual(legacy.parameters, n.parameters)
@@ -0,0 +1,91 @@
+"""
+Request profiling tests.
+"""
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.models import *
+from twistranet.twistapp.lib import profiling
+from twistranet.core.middleware import ProfilingMiddleware, PROFILE_HEADER
+
+def _query():
+    list(Twistable.objects.__booster__.values_list("id", flat = True)[:1])
+
+@profiling.profiled("test.decorated")
+def _decorated():
+    _query()
+    return "done"
+
+class ProfilingTest(TNBaseTest):
+
+    def setUp(self):
+        super(ProfilingTest, self).setUp()
+        self._profiling = getattr(settings, "TWISTRANET_PROFILING", None)
+        self._debug = settings.DEBUG
+        self.hooked = []
+
+    def tearDown(self):
+        profiling.stop()
+        profiling.unregister_hook(self.hook)
+        settings.TWISTRANET_PROFILING = self._profiling
+        settings.DEBUG = self._debug
+        super(ProfilingTest, self).tearDown()
+
+    def hook(self, request, response, profile):
+        self.hooked.append(profile)
+
+    def test_nested_sections(self):
+        """
+        Sections are inclusive: the outer one counts the queries of the inner one
+        """
+        profile = profiling.start("/test")
+        with profiling.section("outer"):
+            _query()
+            with profiling.section("inner"):
+                _query()
+                _query()
+        with profiling.section("inner"):
+            _query()
+        profiling.stop()
+        self.failUnlessEqual(profile.sections["outer"][:2], [1, 3])
+        self.failUnlessEqual(profile.sections["inner"][:2], [2, 3])
+        self.failUnlessEqual(profile.queries, 4)
+
+    def test_profiled(self):
+        # No profile running: the function is just called
+        self.failUnlessEqual(_decorated(), "done")
+        profile = profiling.start("/test")
+        self.failUnlessEqual(_decorated(), "done")
+        self.failUnlessEqual(_decorated.__name__, "_decorated")
+        profiling.stop()
+        self.failUnlessEqual(profile.sections["test.decorated"][:2], [1, 1])
+
+    def test_middleware_disabled(self):
+        settings.TWISTRANET_PROFILING = False
+        self.failUnlessRaises(MiddlewareNotUsed, ProfilingMiddleware)
+
+    def test_middleware(self):
+        """
+        Hooks are called for each request, the header is only set in DEBUG mode
+        """
+        settings.TWISTRANET_PROFILING = True
+        profiling.register_hook(self.hook)
+        middleware = ProfilingMiddleware()
+        request = RequestFactory().get("/test")
+        for debug in (True, False, ):
+            settings.DEBUG = debug
+            middleware.process_request(request)
+            middleware.process_view(request, _decorated, (), {})
+            _decorated()
+            response = middleware.process_response(request, HttpResponse("ok"))
+            self.failUnlessEqual(response.has_header(PROFILE_HEADER), debug)
+        self.failUnlessEqual(len(self.hooked), 2)
+        self.failUnlessEqual(self.hooked[0].view, "_decorated")
+        self.failUnless(self.hooked[0].queries >= 1)
+
+        # Responses of unprofiled requests are left alone
+        response = HttpResponse("ok")
+        self.failUnless(middleware.process_response(request, response) is response)
+        self.failIf(response.has_header(PROFILE_HEADER))
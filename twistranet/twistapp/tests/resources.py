@@ -5,6 +5,8 @@ from twistranet.twistapp.tests.base import TNBaseTest
 from twistranet.twistapp.models import *
 from twistranet.content_types import *
 from twistranet.core import bootstrap
+from twistranet.twistorage import delivery
+from django.test.client import RequestFactory
 
 class ResourcesTest(TNBaseTest):
     """
@@ -20,6 +22,186 @@ class ResourcesTest(TNBaseTest):
         self.failUnless(self.A.picture)
         self.failUnless(self.B.picture)
 
+    def test_resource_delivery(self):
+        """
+        Resources are streamed, with range support and validators taken from the resource itself
+        """
+        from twistranet.twistapp.views.resource_views import _getResourceResponse
+        picture = self.A.picture
+        data = picture.resource_file.read()
+        factory = RequestFactory()
+
+        # Full response
+        response = _getResourceResponse(factory.get("/"), picture)
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(response["Accept-Ranges"], "bytes")
+        self.failUnlessEqual(int(response["Content-Length"]), len(data))
+        self.failUnlessEqual("".join(response), data)
+        self.failUnless(response["ETag"].startswith('"%d-' % picture.id))
+        etag = response["ETag"]
+        last_modified = response["Last-Modified"]
+
+        # Partial ones
+        response = _getResourceResponse(factory.get("/", HTTP_RANGE = "bytes=2-9"), picture)
+        self.failUnlessEqual(response.status_code, 206)
+        self.failUnlessEqual(response["Content-Range"], "bytes 2-9/%d" % len(data))
+        self.failUnlessEqual("".join(response), data[2:10])
+        response = _getResourceResponse(factory.get("/", HTTP_RANGE = "bytes=-4"), picture)
+        self.failUnlessEqual("".join(response), data[-4:])
+        response = _getResourceResponse(factory.get("/", HTTP_RANGE = "bytes=%d-" % len(data)), picture)
+        self.failUnlessEqual(response.status_code, 416)
+        response = _getResourceResponse(factory.get("/", HTTP_RANGE = "bytes=2-9", HTTP_IF_RANGE = '"outdated"'), picture)
+        self.failUnlessEqual(response.status_code, 200)
+
+        # Conditional GETs
+        response = _getResourceResponse(factory.get("/", HTTP_IF_NONE_MATCH = etag), picture)
+        self.failUnlessEqual(response.status_code, 304)
+        response = _getResourceResponse(factory.get("/", HTTP_IF_MODIFIED_SINCE = last_modified), picture)
+        self.failUnlessEqual(response.status_code, 304)
+
+    def test_offload(self):
+        """
+        With TWISTRANET_SENDFILE, the front server sends the file
+        """
+        from django.conf import settings
+        from twistranet.twistapp.views.resource_views import _getResourceResponse
+        picture = self.A.picture
+        fullpath = picture.resource_file.path
+        request = RequestFactory().get("/", HTTP_RANGE = "bytes=2-9")
+        try:
+            settings.TWISTRANET_SENDFILE = "x-sendfile"
+            response = _getResourceResponse(request, picture)
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual(response["X-Sendfile"], fullpath)
+            self.failUnlessEqual(response.content, "")
+            self.failUnless(response.has_header("ETag"))
+
+            settings.TWISTRANET_SENDFILE = "x-accel-redirect"
+            response = _getResourceResponse(request, picture)
+            self.failUnlessEqual(response["X-Accel-Redirect"], "/protected/%s" % picture.resource_file.name)
+            self.failIf(response.has_header("X-Sendfile"))
+        finally:
+            settings.TWISTRANET_SENDFILE = None
+
+    def test_storage_permission_cache(self):
+        """
+        Within a request, a file's directory is authorized once
+        """
+        from twistranet.twistapp.lib import account_context
+        from twistranet.twistorage.storage import Twistorage, directories
+        storage = Twistorage()
+        name = self.A.picture.resource_file.name
+        account_context.set_current_request(RequestFactory().get("/"))
+        try:
+            storage.path(name)
+            self.assertNumQueries(0, storage.path, name)
+            self.assertNumQueries(0, storage.exists, name)
+            self.assertNumQueries(0, storage.size, name)
+            self.failUnlessEqual(directories.get(name.split("/")[0]), self.A.picture.publisher_id)
+        finally:
+            account_context.set_current_request(None)
+
+    def test_directory_cache(self):
+        """
+        The least recently used directories are evicted first
+        """
+        from twistranet.twistorage.storage import DirectoryCache
+        cache = DirectoryCache(size = 2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.failUnlessEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.failUnlessEqual(cache.get("b"), None)
+        self.failUnlessEqual((cache.get("a"), cache.get("c"), ), (1, 3, ))
+        cache.set("alias", 3)
+        cache.discard(3)
+        self.failUnlessEqual((cache.get("c"), cache.get("alias"), ), (None, None, ))
+        self.failUnlessEqual(list(cache.order), [])
+
+    def test_thumbnails(self):
+        """
+        Thumbnails are rendered when the resource is saved, then read from its manifest
+        """
+        from django.core.cache import cache
+        from twistranet.twistapp.lib import thumbnails
+        picture = Resource.objects.get(id = self.A.picture.id)
+        manifest = thumbnails.get_manifest(picture)
+        self.failUnlessEqual(manifest["source"], picture.resource_file.name)
+        self.failUnlessEqual(set(manifest["sizes"].keys()), set([ size for size, geometry, options in thumbnails.THUMBNAIL_SIZES ]))
+
+        # Same thumbnails as sorl's, without loading anything
+        medium = picture.thumbnails["medium"]
+        self.assertNumQueries(0, lambda: medium.url)
+        self.failUnlessEqual(medium.url, picture.get_thumbnail("50x50", crop = "center top", upscale = True).url)
+        self.failUnless(medium.width <= 50 and medium.height <= 50)
+        self.failIf(medium.is_placeholder)
+
+        # Accounts use their picture's thumbnails
+        self.failUnlessEqual(self.A.thumbnails["medium"].url, medium.url)
+
+        # Missing thumbnails are replaced by the original file
+        thumbnails.delete_manifest(picture.id)
+        picture = Resource.objects.get(id = picture.id)
+        self.failUnless(picture.thumbnails["icon"].is_placeholder)
+        self.failUnlessEqual(picture.thumbnails["icon"].url, picture.get_absolute_url())
+
+        # ...until they're rendered again
+        thumbnails.enqueue(picture)
+        self.failIf(Resource.objects.get(id = picture.id).thumbnails["icon"].is_placeholder)
+
+    def test_thumbnails_queue(self):
+        """
+        With TWISTRANET_THUMBNAIL_QUEUE, thumbnails are rendered by the worker
+        """
+        from django.conf import settings
+        from twistranet.twistapp.lib import thumbnails
+        picture = Resource.objects.get(id = self.A.picture.id)
+        thumbnails.delete_manifest(picture.id)
+        picture = Resource.objects.get(id = picture.id)
+        try:
+            settings.TWISTRANET_THUMBNAIL_QUEUE = True
+            thumbnails.enqueue(picture)
+            self.failUnless(Resource.objects.get(id = picture.id).thumbnails["icon"].is_placeholder)
+            self.failUnless(thumbnails.run() >= 1)
+            self.failIf(Resource.objects.get(id = picture.id).thumbnails["icon"].is_placeholder)
+            self.failUnlessEqual(thumbnails.run(), 0)
+        finally:
+            settings.TWISTRANET_THUMBNAIL_QUEUE = False
+
+    def test_default_pictures(self):
+        """
+        Default pictures and mimetype icons are loaded once, so that picture-less objects cost no query
+        """
+        from twistranet.twistapp.lib import thumbnails
+        account = Account.objects.get(id = self.A.id)
+        account.picture = None
+        default_thumbnails = thumbnails.get_default_thumbnails("default_account_picture")
+        self.failIf(default_thumbnails["medium"].is_placeholder)
+        self.assertNumQueries(0, lambda: account.thumbnails["medium"].url)
+        self.failUnlessEqual(account.thumbnails["medium"].url, default_thumbnails["medium"].url)
+        self.failUnlessEqual(account.forced_picture.slug, "default_account_picture")
+
+        # Mimetype icons
+        self.assertNumQueries(0, lambda: Resource(mimetype = "application/pdf").mimetype_icon_resource)
+        self.failUnlessEqual(Resource(mimetype = "application/pdf").mimetype_icon_resource.slug, "application_pdf")
+        self.failUnlessEqual(Resource(mimetype = "application/x-twistranet").mimetype_icon_resource.slug, "default_resource_picture")
+
+        # The registry is refreshed when a default picture is saved
+        picture = thumbnails.get_default_picture("default_account_picture")
+        picture.title = "Nobody"
+        picture.save()
+        self.failUnlessEqual(thumbnails.get_default_picture("default_account_picture").title, "Nobody")
+
+    def test_parse_range(self):
+        self.failUnlessEqual(delivery.parse_range("bytes=0-99", 1000), (0, 99))
+        self.failUnlessEqual(delivery.parse_range("bytes=0-0", 1000), (0, 0))
+        self.failUnlessEqual(delivery.parse_range("bytes=900-", 1000), (900, 999))
+        self.failUnlessEqual(delivery.parse_range("bytes=-100", 1000), (900, 999))
+        self.failUnlessEqual(delivery.parse_range("bytes=500-5000", 1000), (500, 999))
+        self.failUnlessEqual(delivery.parse_range("bytes=0-1,5-6", 1000), None)
+        self.failUnlessEqual(delivery.parse_range("bytes=1000-", 1000), False)
+        self.failUnlessEqual(delivery.parse_range(None, 1000), None)
+
     # XXX PJ test is failing > renamed twist
     def twist_public_resource(self):
         """
@@ -0,0 +1,38 @@
+import datetime
+from haystack.query import SearchQuerySet
+from twistranet.twistapp.models import *
+from twistranet.content_types.models import *
+from twistranet.sharing.models import Like
+from twistranet.twistapp.lib import scoring
+from twistranet.twistapp.lib.account_context import set_current_account
+from base import TNBaseTest
+
+class ScoringTest(TNBaseTest):
+
+    def test_compute_score(self):
+        self.failUnlessEqual(scoring.compute_score(0, 0, 0, 0, 3600), scoring.SCORE_SCALE)
+        self.failUnlessEqual(scoring.compute_score(0, 0, 0, 3600, 3600), scoring.SCORE_SCALE / 2)
+        self.failUnless(scoring.compute_score(1, 0, 0, 0, 3600) < scoring.compute_score(0, 1, 0, 0, 3600))
+
+    def test_update_scores(self):
+        """
+        Liked and commented contents score more, and scores are written back to the DB and the search index.
+        """
+        set_current_account(self.A)
+        liked = StatusUpdate(description = "Scored content", permissions = "public")
+        liked.save()
+        plain = StatusUpdate(description = "Scored content", permissions = "public")
+        plain.save()
+        Like.objects.create(who = self.B, what = liked)
+
+        now = datetime.datetime.now()
+        stats = scoring.update_scores(now = now)
+        self.failUnless(stats["updated"] >= 2)
+        liked = StatusUpdate.objects.get(id = liked.id)
+        plain = StatusUpdate.objects.get(id = plain.id)
+        self.failUnless(liked.static_score > plain.static_score > 0)
+        self.failUnlessEqual(scoring.update_scores(now = now)["updated"], 0)
+
+        # Search results can be sorted on scores
+        results = SearchQuerySet().auto_query("scored").order_by("-static_score")
+        self.failUnlessEqual([ result.pk for result in results ], [ liked.id, plain.id ])
@@ -0,0 +1,142 @@
+from haystack import site
+from haystack.query import SearchQuerySet
+from twistranet.twistapp.models import *
+from twistranet.content_types.models import *
+from twistranet.twistapp.lib.account_context import set_current_account
+from base import TNBaseTest
+
+class SearchTest(TNBaseTest):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        site.get_index(StatusUpdate).backend.clear()
+
+    def search(self, query, *models):
+        sqs = SearchQuerySet()
+        if models:
+            sqs = sqs.models(*models)
+        return [ result.pk for result in sqs.auto_query(query) ]
+
+    def test_incremental_index(self):
+        """
+        Contents are indexed when saved, updated and removed from the index when deleted.
+        """
+        set_current_account(self.A)
+        s = StatusUpdate(description = "Pangolins are scaly mammals", permissions = "public")
+        s.save()
+        self.failUnlessEqual(self.search("pangolins scaly"), [ s.id ])
+        self.failUnlessEqual(self.search("pangol"), [ s.id ])
+        self.failUnlessEqual(self.search("pangolins -scaly"), [])
+        self.failUnlessEqual(self.search("pangolins", Account), [])
+
+        s.description = "Armadillos"
+        s.save()
+        self.failUnlessEqual(self.search("pangolins"), [])
+        self.failUnlessEqual(self.search("armadillos"), [ s.id ])
+
+        s.delete()
+        self.failUnlessEqual(self.search("armadillos"), [])
+
+    def test_ranking_and_pagination(self):
+        """
+        Best matches come first and only the requested page is fetched.
+        """
+        set_current_account(self.A)
+        ids = []
+        for description in ("okapi with a long striped tail and a lot of other words", "okapi okapi okapi", "okapi", "a zebra", "a lion"):
+            s = StatusUpdate(description = description, permissions = "public")
+            s.save()
+            ids.append(s.id)
+        sqs = SearchQuerySet().auto_query("okapi")
+        self.failUnlessEqual(sqs.count(), 3)
+        self.failUnlessEqual([ result.pk for result in sqs[:2] ], [ ids[1], ids[2] ])
+        self.failUnlessEqual([ result.pk for result in SearchQuerySet().auto_query("okapi")[2:4] ], [ ids[0] ])
+
+    def test_security_filter(self):
+        """
+        Search results are what the current account can list, no more, no less.
+        """
+        set_current_account(self.A)
+        ids = []
+        for permissions in ("public", "network", "private", ):
+            s = StatusUpdate(description = "Quokka", permissions = permissions)
+            s.save()
+            ids.append(s.id)
+        for account in (self.A, self.B, self.C, AnonymousAccount(), self.system, ):
+            set_current_account(account)
+            allowed = set(StatusUpdate.objects.filter(id__in = ids).values_list("id", flat = True))
+            self.failUnlessEqual(set(self.search("quokka")), allowed)
+            self.failUnlessEqual(SearchQuerySet().auto_query("quokka").count(), len(allowed))
+        set_current_account(AnonymousAccount())
+        self.failUnlessEqual(self.search("quokka"), [ ids[0] ])
+        set_current_account(self.system)
+        self.failUnlessEqual(set(self.search("quokka")), set(ids))
+
+    def test_live_search(self):
+        """
+        Type-ahead looks up titles by prefix and returns precomputed display data.
+        """
+        set_current_account(self.A)
+        s = StatusUpdate(description = "Wombats dig burrows", permissions = "private")
+        s.save()
+        backend = site.get_index(StatusUpdate).backend
+        results, hits, more = backend.live_search("womb", 5)
+        self.failUnlessEqual(hits, 1)
+        self.failIf(more)
+        self.failUnlessEqual(results[0]["type"], "StatusUpdate")
+        self.failUnlessEqual(results[0]["title"], self.A.title)
+        self.failUnlessEqual(results[0]["link"], self.A.get_absolute_url())
+        self.failUnlessEqual(backend.live_search("burrows", 5)[1], 1)
+        self.failUnlessEqual(backend.live_search("dig", 5)[1], 1)
+        
+        # Private stuff doesn't show up for others
+        set_current_account(self.B)
+        self.failUnlessEqual(backend.live_search("womb", 5), ([], 0, False))
+
+        # Hit count is capped
+        set_current_account(self.A)
+        for i in range(4):
+            StatusUpdate(description = "Wombat #%d" % i, permissions = "public").save()
+        results, hits, more = backend.live_search("wombat", 2, max_hits = 3)
+        self.failUnlessEqual(len(results), 2)
+        self.failUnlessEqual(hits, 3)
+        self.failUnless(more)
+
+    def test_security_propagation(self):
+        """
+        Dependant objects' security is reindexed only when an account's own security changes.
+        """
+        backend = site.get_index(Account).backend
+        propagated = []
+        backend.update_security = lambda rows, commit = True: propagated.append(list(rows))
+        try:
+            set_current_account(self.A)
+            self.A.save()
+            del propagated[:]
+            self.A.description = "Nothing to do with security"
+            self.A.save()
+            self.failUnlessEqual(propagated, [])
+            self.A.permissions = "intranet"
+            self.A.save()
+            self.failUnlessEqual(len(propagated), 1)
+        finally:
+            del backend.update_security
+
+    def test_index_errors(self):
+        """
+        Contents are saved even if the search index can't be written.
+        """
+        import sqlite3
+        backend = site.get_index(StatusUpdate).backend
+        def locked(*args, **kw):
+            raise sqlite3.OperationalError("database is locked")
+        backend.update = backend.remove = locked
+        try:
+            set_current_account(self.A)
+            s = StatusUpdate(description = "Echidnas lay eggs", permissions = "public")
+            s.save()
+            self.failUnless(StatusUpdate.objects.filter(id = s.id).exists())
+            s.delete()
+        finally:
+            del backend.update, backend.remove
+        self.failUnlessEqual(self.search("echidnas"), [])
@@ -2,10 +2,13 @@
 This is a basic wall test.
 """
 from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account, set_current_request, as_account, get_request_cache
 from twistranet.twistapp.models import *
 from twistranet.content_types import *
 from twistranet.twistapp.lib import permissions, roles
+from twistranet.core import caches
 from django.core.exceptions import ValidationError, PermissionDenied
+from django.conf import settings
 
 from twistranet.core import bootstrap
 from twistranet import notifier
@@ -22,7 +25,7 @@ class SecurityTest(TNBaseTest):
         """
         Test various has_role conditions
         """
-        __account__ = self.system
+        set_current_account(self.system)
         #import sys;sys.stdout=sys.__stdout__;sys.stderr=sys.__stderr__;import ipdb; ipdb.set_trace()
         obj = GlobalCommunity.objects.get()
         self.failUnless(self.system.has_role(roles.system, obj))
@@ -30,9 +33,9 @@ class SecurityTest(TNBaseTest):
         self.failIf(self.admin.has_role(roles.system, obj))
         # self.failUnless(self.admin.has_role(roles.owner, obj))    XXX TODO: re-enable when mgr role is ok
         self.failUnless(self.admin.has_role(roles.network, obj))
-        __account__ = self.A
+        set_current_account(self.A)
         obj = GlobalCommunity.objects.get()
-        self.failIf(__account__.has_role(roles.owner, obj))
+        self.failIf(self.A.has_role(roles.owner, obj))
         
 
     # XXX PJ test is failing > renamed twist
@@ -40,11 +43,11 @@ class SecurityTest(TNBaseTest):
         """
         Check if can_join permissions seem ok.
         """
-        __account__ = self.A
+        set_current_account(self.A)
         adm = Community.objects.get(slug = "administrators")
         self.failIf(adm.can_join)
         self.failIf(adm.can_leave)
-        __account__ = self.admin
+        set_current_account(self.admin)
         self.failUnless(adm.can_join)        
         self.failIf(adm.can_leave, "Administrator is the last account on this community, it shouldn't be able to leave")
 
@@ -53,13 +56,13 @@ class SecurityTest(TNBaseTest):
         """
         Check some basic edition rights
         """
-        __account__ = self.A
+        set_current_account(self.A)
         adm = Community.objects.get(slug = "administrators")
         self.failIf(adm.can_edit)
-        __account__ = self.A
+        set_current_account(self.A)
         self.failIf(adm.is_manager)
         self.failIf(adm.can_edit)
-        __account__ = self.admin
+        set_current_account(self.admin)
         # self.failUnless(adm.is_manager)     #   XXX REMOVED THAT because Administrator is not (yet) 100% admin
         # The two following may be true or false depending wether admin is a community manager on administrators.
         self.failIf(self.admin.has_role(roles.owner, adm))
@@ -70,7 +73,7 @@ class SecurityTest(TNBaseTest):
         Check private content behavior
         """
         # A creates a private object
-        __account__ = self.A
+        set_current_account(self.A)
         s = Document.objects.create(
             text = "Hello, World!",
             permissions = "private"
@@ -84,39 +87,39 @@ class SecurityTest(TNBaseTest):
         # self.failUnless(s.content_ptr not in Content.objects.all())
         
         # B must not see it
-        __account__ = self.B
+        set_current_account(self.B)
         self.failUnless(s.content_ptr not in Content.objects.all())
         
         # B creates a private object, same kind of tests
-        __account__ = self.B
+        set_current_account(self.B)
         s = Document.objects.create(text = "Hello", permissions = "private")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.admin
+        set_current_account(self.admin)
         # XXX TODO: Re-enable this test if we decide to have really private content
         # self.failUnless(s.content_ptr not in Content.objects.all())
-        __account__ = self.A
+        set_current_account(self.A)
         self.failUnless(s.content_ptr not in Content.objects.all())
-        __account__ = self.B
+        set_current_account(self.B)
         self.failUnless(s.content_ptr in Content.objects.all())
         
         # Oh, by the way, the system account must see 'em !
-        __account__ = self.system
+        set_current_account(self.system)
         self.failUnless(s.content_ptr in Content.objects.all())
         
     def test_network_content(self):
         """
         Check if network-protected content is accessible to NW only
         """
-        __account__ = self.A
+        set_current_account(self.A)
         s = Document(text = "Hello, World!", permissions = "network")
         s.save()
         
         # Check if 'view' permission is ok in permissionmapping
         self.failUnless(Content.objects.filter(id = s.id))
-        __account__ = self.admin       # admin is in A's network
+        set_current_account(self.admin)       # admin is in A's network
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.B        # B is not
+        set_current_account(self.B)        # B is not
         self.failUnless(s.content_ptr not in Content.objects.all())
             
     # def test_silent_permissions(self):
@@ -135,13 +138,13 @@ class SecurityTest(TNBaseTest):
         """
         Check if public content on an account is visible by anyone
         """
-        __account__ = self.A
+        set_current_account(self.A)
         s = StatusUpdate(description = "Hello, World!", permissions = "public")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.admin       # admin is in A's network
+        set_current_account(self.admin)       # admin is in A's network
         self.failUnless(s.content_ptr in Content.objects.all())
-        __account__ = self.B        # B is not
+        set_current_account(self.B)        # B is not
         self.failUnless(s.content_ptr in Content.objects.all())
         
     # XXX PJ test is failing > renamed twist
@@ -150,7 +153,7 @@ class SecurityTest(TNBaseTest):
         Check if I can delete my own content
         """
         # I should be able to delete a content I wrote
-        __account__ = self.A
+        set_current_account(self.A)
         StatusUpdate(description = "Hi, there.").save()
         c = StatusUpdate.objects.filter(owner = self.A)[0]
         _id = c.id
@@ -173,35 +176,47 @@ class SecurityTest(TNBaseTest):
         self.failUnlessEqual(StatusUpdate.objects.count(), 0)
         
         # Become an internet. There should be some content available
-        __account__ = self.system
+        set_current_account(self.system)
         glob = GlobalCommunity.objects.get()
         glob.permissions = "internet"
         glob.save()
-        del __account__
+        set_current_account(None)
         self.failUnlessEqual(StatusUpdate.objects.count(), 0)
 
         # Get back to intranet. No more content please.
-        __account__ = self.system
+        set_current_account(self.system)
         glob = GlobalCommunity.objects.get()
         glob.permissions = "intranet"
         glob.save()
-        del __account__
+        set_current_account(None)
         self.failUnlessEqual(list(StatusUpdate.objects.all()), [])
         
     def test_hassystem_account(self):
         """
         Is system account created and working?
         """
-        __account__ = self.system
+        set_current_account(self.system)
         system_accounts = SystemAccount.objects.all()
         self.failUnlessEqual(len(system_accounts), 1)
-    
+
+    def test_account_context(self):
+        """
+        as_account() takes precedence and restores the previous account on exit.
+        """
+        set_current_account(self.A)
+        self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.A.id)
+        with as_account(self.system):
+            self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.system.id)
+        self.failUnlessEqual(Twistable.objects._getAuthenticatedAccount().id, self.A.id)
+        set_current_account(None)
+        self.failUnless(Twistable.objects._getAuthenticatedAccount().is_anonymous)
+
     
     def testsystem_account(self):
         """
         Check if system account can access all communities
         """
-        __account__ = self.system
+        set_current_account(self.system)
         self.failUnlessEqual(len(Community.objects.all()), 2)
         
     def test_default_communities(self):
@@ -209,7 +224,7 @@ class SecurityTest(TNBaseTest):
         There should be one global com. and one member-only com.
         AND the system account must see them all.
         """
-        __account__ = self.system
+        set_current_account(self.system)
         self.failUnlessEqual(len(AdminCommunity.objects.filter(model_name = "AdminCommunity")), 1)
         self.failUnlessEqual(len(GlobalCommunity.objects.filter(model_name = "GlobalCommunity")), 1)
         self.failUnlessEqual(AdminCommunity.objects.get().model_name, "AdminCommunity")
@@ -219,12 +234,12 @@ class SecurityTest(TNBaseTest):
         """
         Check if system is NOT in the community.
         """
-        __account__ = self.system
+        set_current_account(self.system)
         self.failUnlessEqual(len(self.system.communities), 0)
         self.failUnlessEqual(len(Community.objects.all()), 2)
         
     def test_membership(self):
-        __account__ = self.system
+        set_current_account(self.system)
         self.failUnlessEqual(len(self.A.communities), 1)
         c = Community.objects.create(title = "Test Community", permissions = "ou")
         c.save()
@@ -237,12 +252,80 @@ class SecurityTest(TNBaseTest):
         """
         Check if can_view permission works as expected
         """
-        __account__ = self.B
+        set_current_account(self.B)
         self.B.permissions = "private"
         self.B.object.save()
         hello = StatusUpdate(description = "Hello there", permissions = "public")
         hello.save()
         self.failUnless(hello.can_view)
         
+    def test_permission_cache(self):
+        """
+        Permissions are memoized during a request and forgotten when something is saved.
+        """
+        set_current_account(self.A)
+        self.failUnlessEqual(get_request_cache("permissions"), None)
+        s = StatusUpdate(description = "Hello there", permissions = "public")
+        s.save()
+        set_current_request(object())
+        self.failUnless(s.can_edit)
+        self.failUnlessEqual(get_request_cache("permissions")[(self.A.id, s.id, permissions.can_edit)], True)
+        s.save()
+        self.failIf(get_request_cache("permissions"))
+        
+        # Bulk version gives the same results
+        set_current_account(self.B)
+        ret = self.B.has_permissions_bulk([s], (permissions.can_view, permissions.can_edit, ))
+        self.failUnlessEqual(ret, {s.id: {permissions.can_view: True, permissions.can_edit: False}})
+        self.failUnlessEqual(ret[s.id][permissions.can_edit], s.can_edit)
         
+    def test_account_cache(self):
+        """
+        Network and membership ids are shared across instances and invalidated by relations changes.
+        """
+        settings.TWISTRANET_SHARED_CACHE = True
+        try:
+            set_current_account(self.system)
+            c = Community.objects.create(title = "Cached Community", permissions = "ou")
+            c.save()
+            caches.reset_stats()
+            self.failIf(self.A.id in Community.objects.get(id = c.id).member_ids)
+            self.failIf(self.A.id in Community.objects.get(id = c.id).member_ids)
+            self.failUnlessEqual(caches.get_stats()["member_ids"], {"hits": 1, "misses": 1})
+            c.join(self.A)
+            self.failUnless(self.A.id in Community.objects.get(id = c.id).member_ids)
+            self.failUnless(c.id in Account.objects.__booster__.get(id = self.A.id).community_ids)
+            c.leave(self.A)
+            self.failIf(c.id in Account.objects.__booster__.get(id = self.A.id).community_ids)
 
+            # Following someone changes its network ids
+            self.failIf(self.C.id in Account.objects.__booster__.get(id = self.B.id).network_ids)
+            self.C.useraccount.follow(self.B)
+            self.failUnless(self.C.id in Account.objects.__booster__.get(id = self.B.id).network_ids)
+            self.C.useraccount.unfollow(self.B)
+            self.failIf(self.C.id in Account.objects.__booster__.get(id = self.B.id).network_ids)
+        finally:
+            settings.TWISTRANET_SHARED_CACHE = None
+
+    def test_account_cache_not_shared(self):
+        """
+        With a per-process cache backend, account security data is only memoized for the current request.
+        """
+        from django.core.cache import cache
+        settings.TWISTRANET_SHARED_CACHE = False
+        try:
+            self.failIf(caches.is_shared())
+            account = Account.objects.__booster__.get(id = self.A.id)
+            self.failUnless(self.A.id in account.network_ids)
+            self.failUnlessEqual(cache.get("AC%d#network_ids" % self.A.id), None)
+            set_current_request(object())
+            try:
+                caches.reset_stats()
+                self.failIf(Account.objects.__booster__.get(id = self.B.id).is_admin)
+                self.failIf(Account.objects.__booster__.get(id = self.B.id).is_admin)
+                self.failUnlessEqual(caches.get_stats()["is_admin"], {"hits": 1, "misses": 1})
+                self.failUnlessEqual(cache.get("AC%d#is_admin" % self.B.id), None)
+            finally:
+                set_current_request(None)
+        finally:
+            settings.TWISTRANET_SHARED_CACHE = None
@@ -0,0 +1,87 @@
+from twistranet.twistapp.models import *
+from twistranet.content_types.models import *
+from twistranet.tagging.models import Tag, TagUsage, TagExpert, compute_experts
+from twistranet.twistapp.lib.account_context import set_current_account
+from base import TNBaseTest
+
+class TagsTest(TNBaseTest):
+
+    def usage(self, tag):
+        return TagUsage.objects.get(tag = tag).count
+
+    def test_search(self):
+        """
+        Tags are found by the normalized prefix of any of their words.
+        """
+        electricity = Tag(title = u"\xc9lectricit\xe9 statique")
+        electricity.save()
+        elephants = Tag(title = u"Elephants")
+        elephants.save()
+        self.failUnlessEqual(set(Tag.search("ele")), set([ electricity, elephants ]))
+        self.failUnlessEqual(list(Tag.search(u"stat \xe9lec")), [ electricity ])
+        self.failUnlessEqual(list(Tag.search("ctricit")), [])
+        self.failUnlessEqual(list(Tag.search(" ")), [])
+
+        # Renaming a tag updates its words
+        elephants.title = u"Mammoths"
+        elephants.save()
+        self.failUnlessEqual(list(Tag.search("ele")), [ electricity ])
+
+    def test_usage(self):
+        """
+        Usage counters follow the tags relation, from both sides.
+        """
+        tag1 = Tag(title = u"Counted")
+        tag1.save()
+        tag2 = Tag(title = u"Counted twice")
+        tag2.save()
+        set_current_account(self.A)
+        s = StatusUpdate(description = "Tagged", permissions = "public")
+        s.save()
+        s.tags.add(tag1, tag2)
+        s.tags.add(tag1)
+        self.failUnlessEqual((self.usage(tag1), self.usage(tag2)), (1, 1))
+        tag2.tagged.add(self.A)
+        self.failUnlessEqual(self.usage(tag2), 2)
+        self.failUnlessEqual(list(Tag.search("counted")), [ tag2, tag1 ])
+        popular = Tag.get_popular(100)
+        self.failUnless(popular.index(tag2) < popular.index(tag1))
+        self.failUnlessEqual(popular[popular.index(tag2)].count, 2)
+
+        s.tags.remove(tag1)
+        s.tags.remove(tag1)
+        self.failUnlessEqual(self.usage(tag1), 0)
+        s.delete()
+        self.failUnlessEqual(self.usage(tag2), 1)
+        tag2.tagged.clear()
+        self.failUnlessEqual(self.usage(tag2), 0)
+
+    def scores(self, tag):
+        return dict(TagExpert.objects.filter(tag = tag, score__gt = 0).values_list("account", "score"))
+
+    def test_experts(self):
+        """
+        Expert scores are maintained incrementally, and match a full computation.
+        """
+        tag = Tag(title = u"Expertise")
+        tag.save()
+        self.A.tags.add(tag)
+        set_current_account(self.B)
+        s = StatusUpdate(description = "I know", permissions = "public")
+        s.save()
+        s.tags.add(tag)
+        set_current_account(self.system)
+        self.failUnlessEqual([ (u.id, u.score) for u in Tag.objects.get(id = tag.id).get_experts() ], [ (self.A.id, 5), (self.B.id, 1) ])
+
+        # B's own statuses are published on B's wall: tagging B makes them contributions
+        self.B.tags.add(tag)
+        scores = self.scores(tag)
+        self.failUnless(scores[self.B.id] > 6)
+        compute_experts([ tag.id ])
+        self.failUnlessEqual(self.scores(tag), scores)
+
+        set_current_account(self.B)
+        s.delete()
+        scores = self.scores(tag)
+        compute_experts([ tag.id ])
+        self.failUnlessEqual(self.scores(tag), scores)
@@ -0,0 +1,47 @@
+"""
+Home timeline tests.
+"""
+from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account
+from twistranet.twistapp.models import *
+from twistranet.content_types import *
+from twistranet.timeline import models as timeline
+
+class TimelineTest(TNBaseTest):
+    """
+    admin follows A, B doesn't.
+    """
+    def setUp(self):
+        super(TimelineTest, self).setUp()
+        self.admin.useraccount.follow(self.A)
+
+    def test_fan_out(self):
+        """
+        Content published by A goes to the timeline of A and of the people following A
+        """
+        set_current_account(self.A)
+        s = StatusUpdate(description = "Fan me out", permissions = "public")
+        s.save()
+        self.failUnless(s.content_ptr in timeline.get_timeline(self.A))
+        set_current_account(self.admin)
+        self.failUnless(s.content_ptr in timeline.get_timeline(self.admin))
+        set_current_account(self.B)
+        self.failIf(s.content_ptr in timeline.get_timeline(self.B))
+
+    def test_unfollow(self):
+        """
+        Unfollowing removes the content from the inbox
+        """
+        set_current_account(self.A)
+        s = StatusUpdate(description = "Going away", permissions = "public")
+        s.save()
+        self.admin.useraccount.unfollow(self.A)
+        set_current_account(self.admin)
+        self.failIf(s.content_ptr in timeline.get_timeline(self.admin))
+
+    def test_trim(self):
+        set_current_account(self.A)
+        for i in range(3):
+            StatusUpdate(description = "Status %d" % i, permissions = "public").save()
+        timeline.trim(self.A.id, 2)
+        self.failUnlessEqual(timeline.TimelineEntry.objects.filter(account__id = self.A.id).count(), 2)
@@ -2,6 +2,7 @@
 This is a basic wall test.
 """
 from twistranet.twistapp.tests.base import TNBaseTest
+from twistranet.twistapp.lib.account_context import set_current_account
 from twistranet.twistapp.models import *
 from twistranet.content_types import *
 from twistranet.core import bootstrap
@@ -14,7 +15,7 @@ class WallTest(TNBaseTest):
         A and admin are in the same network.
         If A creates a private, it must not be visible in admin's wall (even with A account)
         """
-        __account__ = self.A
+        set_current_account(self.A)
         s = Document(text = "Private", permissions = "private")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
@@ -29,7 +30,7 @@ class WallTest(TNBaseTest):
         We check everything from A's eyes
         """
         # Check networked content availability
-        __account__ = self.A
+        set_current_account(self.A)
         s = StatusUpdate(description = "NWK", permissions = "network")
         s.save()
         self.failUnless(s.content_ptr in Content.objects.all())
@@ -55,12 +56,12 @@ class WallTest(TNBaseTest):
         self.failUnlessEqual(self.B.useraccount.user.username, "B")
         
         # Check public objects. Must be empty (unless I put truly public objects in the fixture?)
-        __account__ = None
+        set_current_account(None)
         public_list = Content.objects.all()
         self.failUnlessEqual(len(public_list), 0)
 
         # Check wall objects. First one should be older than, say, the third one.
-        __account__ = self.B
+        set_current_account(self.B)
         latest = self.B.content.all().order_by('-created_at')[:5]
         self.failUnlessEqual(len(latest), 5)
         self.failUnless(latest[0].created_at >= latest[3].created_at, "Invalid date order for the wall")
@@ -72,12 +73,12 @@ class WallTest(TNBaseTest):
         """
         # A creates a private content. B shouldn't see it.
         from twistranet.content_types import StatusUpdate
-        __account__ = self.B
+        set_current_account(self.B)
         b_initial_list = self.B.content.all()
         b_initial_followed = self.B.followed_content.all()
         
         # Test content creation
-        __account__ = self.A
+        set_current_account(self.A)
         s = Document.objects.create()
         s.text = "Hello, this is A speaking"
         s.permissions = "private"
@@ -86,15 +87,15 @@ class WallTest(TNBaseTest):
         self.failUnlessEqual(s.publisher, self.A)
         
         # Check if B can see A's content (it shouldn't, as it's private
-        __account__ = self.B
+        set_current_account(self.B)
         b_final_list = self.B.content.all()
         self.failUnlessEqual(len(b_initial_list), len(b_final_list))
         
         # A creates / edits public content. B should see it even if he doesn't follow A
-        __account__ = self.A
+        set_current_account(self.A)
         s.permissions = "public"
         s.save()
-        __account__ = self.B
+        set_current_account(self.B)
         b_final_list = self.B.content.all()
         self.failUnlessEqual(len(b_initial_list) + 1, len(b_final_list))
 
@@ -108,7 +109,7 @@ class WallTest(TNBaseTest):
         Check if content I write is displayed
         """
         from twistranet.content_types import StatusUpdate
-        __account__ = self.A
+        set_current_account(self.A)
         s = Document.objects.create()
         s.text = "Hello, this is A speaking"
         s.permissions = "private"
@@ -20,6 +20,8 @@ from twistranet.twistapp.signals import invite_user, reset_password
 from twistranet.twistapp.models import *
 from twistranet.twistapp.forms import account_forms, registration_forms
 from twistranet.twistapp.lib.slugify import slugify
+from twistranet.twistapp.lib.account_context import as_account
+from twistranet.timeline import models as timeline
 from twistranet.actions import *
 from twistranet.core.views import *
 
@@ -74,22 +76,6 @@ class UserAccountView(BaseWallView):
     def get_objects_list(self,):
         return Content.objects.getActivityFeed(self.object)
 
-    def get_recent_content_list(self):
-        """
-        Retrieve recent content list for the given account.
-        XXX TODO: Optimize this by adding a (first_twistable_on_home, last_twistable_on_home) values pair on the Account object.
-        This way we can just query objects with id > last_twistable_on_home
-        """
-        nb_all = self.objects_list.count()
-        batch = self.batch_list(nb_all)
-        nb_from = batch[0]
-        nb_to = batch[1]
-        if nb_from < nb_all:
-            objects_list = self.objects_list.order_by("-id").values_list('id', flat = True)[nb_from:nb_to]
-            latest_list = Content.objects.__booster__.filter(id__in = tuple(objects_list)).select_related(*self.select_related_summary_fields).order_by("-created_at")
-            return latest_list
-        return []
-
     def get_title(self,):
         """
         We override get_title in a way that it could be removed easily in subclasses.
@@ -109,13 +95,12 @@ class HomepageView(UserAccountView):
     def get_objects_list(self):
         """
         Retrieve recent content list for the given account.
-        XXX TODO: Optimize this by adding a (first_twistable_on_home, last_twistable_on_home) values pair on the Account object.
-        This way we can just query objects with id > last_twistable_on_home
+        Followed content is read from the account's timeline inbox, see twistranet.timeline.
         """
         objects_list = None
         if not self.auth.is_anonymous:
             if Content.objects.filter(publisher = self.auth).exists():
-                objects_list = Content.objects.followed.exclude(model_name = "Comment")
+                objects_list = timeline.get_timeline(self.auth)
         if objects_list is None:
             objects_list = Content.objects.exclude(model_name = "Comment")
         return objects_list
@@ -275,10 +260,9 @@ class AccountDelete(BaseObjectActionView):
             raise ValueError("You're not allowed to delete this account")
         name = self.useraccount.title
         underlying_user = self.useraccount.user
-        __account__ = SystemAccount.get()
-        # self.useraccount.delete()
-        underlying_user.delete()
-        del __account__
+        with as_account(SystemAccount.get()):
+            # self.useraccount.delete()
+            underlying_user.delete()
         messages.info(
             self.request, 
             _("'%(name)s' account has been deleted.") % {'name': name},
@@ -531,25 +515,24 @@ class AccountJoin(UserAccountEdit):
                 messages.warning(self.request, _("A user with this name already exists."))
             else:
                 # Create user and set information
-                __account__ = SystemAccount.get()
-                u = User.objects.create(
-                    username = cleaned_data["username"],
-                    first_name = cleaned_data["first_name"],
-                    last_name = cleaned_data["last_name"],
-                    email = cleaned_data["email"],
-                    is_superuser = is_admin,
-                    is_active = True,
-                )
-                u.set_password(cleaned_data["password"])
-                u.save()
-                useraccount = UserAccount.objects.get(user = u)
-                useraccount.title = u"%s %s" % (cleaned_data["first_name"], cleaned_data["last_name"])
-                useraccount.save()
-                if is_admin:
-                    admin_community = AdminCommunity.objects.get()
-                    if not admin_community in useraccount.communities:
-                        admin_community.join(useraccount, is_manager = True)
-                del __account__
+                with as_account(SystemAccount.get()):
+                    u = User.objects.create(
+                        username = cleaned_data["username"],
+                        first_name = cleaned_data["first_name"],
+                        last_name = cleaned_data["last_name"],
+                        email = cleaned_data["email"],
+                        is_superuser = is_admin,
+                        is_active = True,
+                    )
+                    u.set_password(cleaned_data["password"])
+                    u.save()
+                    useraccount = UserAccount.objects.get(user = u)
+                    useraccount.title = u"%s %s" % (cleaned_data["first_name"], cleaned_data["last_name"])
+                    useraccount.save()
+                    if is_admin:
+                        admin_community = AdminCommunity.objects.get()
+                        if not admin_community in useraccount.communities:
+                            admin_community.join(useraccount, is_manager = True)
                 
                 # Display a nice success message and redirect to login page
                 messages.success(self.request, _("Your account is now created. You can login to twistranet."))
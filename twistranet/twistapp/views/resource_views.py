@@ -24,7 +24,6 @@ from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied, SuspiciousOperation
 from django.utils.http import http_date                 
 from django.conf import settings
-from django.views.static import was_modified_since
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.context_processors import csrf
 from django.utils.translation import ugettext as _
@@ -34,73 +33,22 @@ from twistranet.twistapp.forms.resource_forms import ResourceForm, ResourceBrows
 from twistranet.twistapp.lib.decorators import require_access
 from twistranet.twistapp.lib.log import log
 from twistranet.twistorage.storage import Twistorage
+from twistranet.twistorage import delivery
 from twistranet.twistapp.lib import utils
 from twistranet.core.views import *
 
-def serve(request, path, document_root = None, show_indexes = False, nocache = False):
+def serve(request, path, document_root = None, show_indexes = False):
     """
-    Adapted from django.views.static to handle the creation/modification date of the resource's publisher
-    instead of only the file's value.
-    
     Serve static files below a given point in the directory structure.
-
-    To use, put a URL pattern such as::
-
-        (r'^(?P<path>.*)$', 'django.views.static.serve', {'document_root' : '/path/to/my/files/'})
-
-    in your URLconf. You must provide the ``document_root`` param. You may
-    also set ``show_indexes`` to ``True`` if you'd like to serve a basic index
-    of the directory.  This index view will use the template hardcoded below,
-    but if you'd like to override it, you can create a template called
-    ``static/directory_index.html``.
+    Files are streamed and Range requests are supported, see twistorage.delivery.
     """
-
-    # Clean up given path to only allow serving files below document_root.
-    path = urllib.unquote(path).lstrip('/')
-    newpath = ''
-    for part in path.split('/'):
-        if not part:
-            # Strip empty path components.
-            continue
-        drive, part = os.path.splitdrive(part)
-        head, part = os.path.split(part)
-        if part in (os.curdir, os.pardir):
-            # Strip '.' and '..' in path.
-            continue
-        newpath = os.path.join(newpath, part).replace('\\', '/')
-    if newpath and path != newpath:
-        return HttpResponseRedirect(newpath)
-    fullpath = os.path.join(document_root, newpath)
-    if os.path.isdir(fullpath):
-        # if show_indexes:
-        #     return directory_index(newpath, fullpath)
-        raise Http404("Directory indexes are not allowed here.")
-    if not os.path.exists(fullpath):
-        raise Http404('"%s" does not exist' % fullpath)
-    
-    # Respect the If-Modified-Since header.
-    statobj = os.stat(fullpath)
-    mimetype = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
-    # XXX TODO: Handle this correctly!!! Disabled to avoid using file mod. time instead of obj mod. time
-    if not nocache:
-        if not was_modified_since(
-            request.META.get(
-                'HTTP_IF_MODIFIED_SINCE'),
-                    statobj[stat.ST_MTIME], statobj[stat.ST_SIZE]
-        ):
-            return HttpResponseNotModified(mimetype=mimetype)
-            
-    # XXX This is subsubsuboptimal!
-    contents = open(fullpath, 'rb').read()
-    response = HttpResponse(contents, mimetype=mimetype)
-    response["Last-Modified"] = http_date(statobj[stat.ST_MTIME])
-    response["Content-Length"] = len(contents)
-    return response
+    return delivery.serve(request, path, document_root = document_root, show_indexes = show_indexes)
 
 def _getResourceResponse(request, resource, last_modified = None, force_download = False):
     """
-    Return the proper HTTP stream for a resource object
-    XXX TODO: Handle the last_modified parameter
+    Return the proper HTTP stream for a resource object.
+    Last-Modified and ETag are derived from the resource's modified_at (or last_modified if given)
+    rather than from the file's mtime.
     If force_download is True, then we return attachment instead of inline.
     """
     # Determinate the appropriate rendering scheme: file or URL
@@ -109,9 +57,13 @@ def _getResourceResponse(request, resource, last_modified = None, force_download
     
     # Resource file: get storage and check if path exists
     elif resource.resource_file:
-        path = resource.resource_file.name      # XXX TODO: Handle subdirectories somehow here
         storage = Twistorage()
-        if not storage.exists(path):
+        fullpath = storage.path(resource.resource_file.name)
+        try:
+            statobj = os.stat(fullpath)
+        except OSError:
+            raise Http404
+        if not stat.S_ISREG(statobj[stat.ST_MODE]):
             raise Http404
 
     # Neither a file nor a URL? Then it's probably invalid.
@@ -119,12 +71,18 @@ def _getResourceResponse(request, resource, last_modified = None, force_download
     else:
         raise ValueError("Invalid resource: %s" % resource)
 
-    # Return the underlying file, adapt the Last-Modified header as necessary
-    response = serve(request, path, document_root = storage.location, show_indexes = False, nocache = True)
-    response["Content-Type"] = resource.mimetype
-    content_disposition = force_download and "attachment" or "inline"
-    response["Content-Disposition"] = "%s; filename=\"%s\"" % (content_disposition, urllib.quote(resource.filename.encode("ascii", "ignore")))
-    return response
+    # Stream the underlying file
+    last_modified = last_modified or resource.modified_at
+    timestamp = delivery.get_timestamp(last_modified)
+    return delivery.serve_file(
+        request, fullpath,
+        mimetype = resource.mimetype,
+        last_modified = timestamp,
+        etag = delivery.get_etag(resource.id, timestamp, statobj[stat.ST_SIZE]),
+        filename = resource.filename,
+        force_download = force_download,
+        statobj = statobj,
+    )
     
 @require_access
 def resource_cache(request, cache_path):
@@ -480,7 +438,7 @@ def resource_quickupload_file(request):
             )
             is_image = resource.is_image
             type = is_image and 'image' or 'file'
-            # Generate the preview thumbnails
+            # Thumbnails are being rendered in the background: until they're done, their URL is the file's one
             thumbnails = resource.thumbnails
             msg = {
                 'success':       True,
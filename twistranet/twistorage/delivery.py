@@ -0,0 +1,218 @@
+"""
+File delivery for resources and static files.
+
+Files are streamed by fixed-size chunks instead of being read in memory, and we handle:
+- conditional GETs (If-None-Match / If-Modified-Since => 304) ;
+- single byte ranges (Range / If-Range => 206), for resumable downloads and video seeking.
+
+Callers give the Last-Modified date and ETag of what they serve when they know better than
+the file system (eg. a Resource's modified_at), otherwise they're derived from the file itself.
+
+Transfers can be offloaded to the front server with the TWISTRANET_SENDFILE setting:
+- None (default): files are streamed by Python ;
+- "x-sendfile": an empty response with an X-Sendfile header is returned (Apache's mod_xsendfile, lighttpd) ;
+- "x-accel-redirect": an empty response with an X-Accel-Redirect header is returned (nginx).
+  Only files below TWISTRANET_MEDIA_ROOT are offloaded then, through the TWISTRANET_SENDFILE_URL internal location,
+  which must alias TWISTRANET_MEDIA_ROOT.
+Security checks are still done by the views before calling serve_file(); the front server only sends the bytes
+(and handles ranges by itself).
+"""
+import os
+import re
+import time
+import stat
+import mimetypes
+import urllib
+import datetime
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_TWISTRANET_SENDFILE = None
+DEFAULT_TWISTRANET_SENDFILE_URL = "/protected/"
+
+RANGE_REGEX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class FileIterator(object):
+    """
+    Iterate over length bytes of a file starting at offset, by chunks. The file is closed at the end.
+    """
+    def __init__(self, fullpath, offset = 0, length = None, chunk_size = CHUNK_SIZE):
+        self.fullpath = fullpath
+        self.offset = offset
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        f = open(self.fullpath, 'rb')
+        try:
+            f.seek(self.offset)
+            remaining = self.length
+            while remaining is None or remaining > 0:
+                size = remaining is None and self.chunk_size or min(self.chunk_size, remaining)
+                data = f.read(size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+        finally:
+            f.close()
+
+def parse_range(header, size):
+    """
+    Return the (first, last) byte positions of a "bytes=x-y" Range header, None if there's no usable range
+    (missing, malformed or multiple ranges: the whole file is sent then), or False if it's unsatisfiable.
+    """
+    if not header:
+        return None
+    match = RANGE_REGEX.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last n bytes
+        length = int(last)
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last:
+        last = min(int(last), size - 1)
+    else:
+        last = size - 1
+    if first >= size or last < first:
+        return False
+    return first, last
+
+def get_timestamp(last_modified):
+    """
+    Return a timestamp from a datetime or a timestamp.
+    """
+    if isinstance(last_modified, datetime.datetime):
+        return int(time.mktime(last_modified.timetuple()))
+    return int(last_modified)
+
+def get_etag(*parts):
+    return '"%s"' % "-".join([ str(p) for p in parts ])
+
+def is_not_modified(request, etag, timestamp):
+    """
+    True if the client's cached copy is still valid.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag in [ tag.strip() for tag in if_none_match.split(",") ] or if_none_match.strip() == "*"
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and timestamp <= if_modified_since
+
+def get_offload_header(fullpath):
+    """
+    Return the (header, value) the front server needs to send the file by itself, or None if we have to stream it.
+    """
+    mode = getattr(settings, "TWISTRANET_SENDFILE", DEFAULT_TWISTRANET_SENDFILE)
+    if not mode:
+        return None
+    fullpath = os.path.abspath(fullpath)
+    if mode == "x-sendfile":
+        return "X-Sendfile", fullpath
+    if mode == "x-accel-redirect":
+        root = os.path.abspath(settings.TWISTRANET_MEDIA_ROOT)
+        if not fullpath.startswith(root + os.path.sep):
+            return None
+        url = getattr(settings, "TWISTRANET_SENDFILE_URL", DEFAULT_TWISTRANET_SENDFILE_URL)
+        relpath = fullpath[len(root) + 1:].replace(os.path.sep, '/')
+        return "X-Accel-Redirect", url.rstrip('/') + '/' + urllib.quote(relpath)
+    raise ValueError("Invalid TWISTRANET_SENDFILE setting: %s" % mode)
+
+def serve_file(request, fullpath, mimetype = None, last_modified = None, etag = None, filename = None, force_download = False, statobj = None):
+    """
+    Return a streamed response for the given file. See module docstring.
+    last_modified is a datetime or a timestamp, and defaults to the file's mtime.
+    If filename is given, a Content-Disposition header is set (attachment if force_download is True).
+    Pass statobj if you already have it, to avoid statting the file twice.
+    """
+    statobj = statobj or os.stat(fullpath)
+    size = statobj[stat.ST_SIZE]
+    mimetype = mimetype or mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+    if last_modified is None:
+        timestamp = statobj[stat.ST_MTIME]
+    else:
+        timestamp = get_timestamp(last_modified)
+    etag = etag or get_etag(timestamp, size)
+
+    if is_not_modified(request, etag, timestamp):
+        response = HttpResponseNotModified(mimetype = mimetype)
+        response["ETag"] = etag
+        return response
+
+    # Let the front server do the job if it can
+    offload = get_offload_header(fullpath)
+    if offload:
+        response = HttpResponse(mimetype = mimetype)
+        header, value = offload
+        response[header] = value
+        return _set_headers(response, timestamp, etag, filename, force_download)
+
+    # Range requests. If-Range means "only if my partial copy is still the current one".
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range and if_range and if_range != etag and parse_http_date_safe(if_range) != timestamp:
+        byte_range = None
+    if byte_range is False:
+        response = HttpResponse(status = 416)
+        response["Content-Range"] = "bytes */%d" % size
+        return response
+
+    if byte_range:
+        first, last = byte_range
+        response = HttpResponse(FileIterator(fullpath, first, last - first + 1), mimetype = mimetype, status = 206)
+        response["Content-Range"] = "bytes %d-%d/%d" % (first, last, size, )
+        response["Content-Length"] = last - first + 1
+    else:
+        response = HttpResponse(FileIterator(fullpath), mimetype = mimetype)
+        response["Content-Length"] = size
+    response["Accept-Ranges"] = "bytes"
+    return _set_headers(response, timestamp, etag, filename, force_download)
+
+def _set_headers(response, timestamp, etag, filename, force_download):
+    """
+    Set the validators and Content-Disposition headers of a file response.
+    """
+    response["Last-Modified"] = http_date(timestamp)
+    response["ETag"] = etag
+    if filename:
+        content_disposition = force_download and "attachment" or "inline"
+        response["Content-Disposition"] = "%s; filename=\"%s\"" % (content_disposition, urllib.quote(filename.encode("ascii", "ignore")))
+    return response
+
+def serve(request, path, document_root = None, show_indexes = False):
+    """
+    Streaming replacement for django.views.static.serve: serve files below document_root.
+    Directory indexes are never served, show_indexes is only here for URLconf compatibility.
+    """
+    # Clean up given path to only allow serving files below document_root.
+    path = urllib.unquote(path).lstrip('/')
+    newpath = ''
+    for part in path.split('/'):
+        if not part:
+            # Strip empty path components.
+            continue
+        drive, part = os.path.splitdrive(part)
+        head, part = os.path.split(part)
+        if part in (os.curdir, os.pardir):
+            # Strip '.' and '..' in path.
+            continue
+        newpath = os.path.join(newpath, part).replace('\\', '/')
+    if newpath and path != newpath:
+        return HttpResponseRedirect(newpath)
+    fullpath = os.path.join(document_root, newpath)
+    if os.path.isdir(fullpath):
+        raise Http404("Directory indexes are not allowed here.")
+    if not os.path.exists(fullpath):
+        raise Http404('"%s" does not exist' % fullpath)
+    return serve_file(request, fullpath)
@@ -3,6 +3,8 @@ import sys
 import errno
 import urlparse
 import itertools
+import threading
+from collections import deque
 
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
@@ -18,6 +20,78 @@ from django.core.files.storage import FileSystemStorage
 
 from django.conf import settings
 
+from twistranet.twistapp.lib import account_context
+from twistranet.twistapp.signals import twistable_post_save
+
+DIRECTORY_CACHE_SIZE = 1000
+
+class DirectoryCache(object):
+    """
+    A bounded LRU mapping account directory names (ids or slugs) to account ids.
+    Process-wide, as it holds no security information: permissions are checked against the resolved id.
+    'order' holds the directories from the least to the most recently used one.
+    """
+    def __init__(self, size = DIRECTORY_CACHE_SIZE):
+        self.size = size
+        self.entries = {}
+        self.order = deque()
+        self.lock = threading.Lock()
+
+    def get(self, directory):
+        self.lock.acquire()
+        try:
+            account_id = self.entries.get(directory)
+            if account_id is not None:
+                self.order.remove(directory)
+                self.order.append(directory)
+            return account_id
+        finally:
+            self.lock.release()
+
+    def set(self, directory, account_id):
+        self.lock.acquire()
+        try:
+            if directory in self.entries:
+                self.order.remove(directory)
+            self.entries[directory] = account_id
+            self.order.append(directory)
+            while len(self.order) > self.size:
+                del self.entries[self.order.popleft()]
+        finally:
+            self.lock.release()
+
+    def discard(self, account_id):
+        """
+        Forget every directory resolved to account_id (its slug may have changed).
+        """
+        self.lock.acquire()
+        try:
+            for directory in [ d for d, id in self.entries.items() if id == account_id ]:
+                del self.entries[directory]
+                self.order.remove(directory)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.order.clear()
+        finally:
+            self.lock.release()
+
+directories = DirectoryCache()
+
+def account_saved(sender, instance, **kwargs):
+    """
+    An account's slug may have changed: don't resolve its old directory name anymore.
+    """
+    from twistranet.twistapp.models import Account
+    if isinstance(instance, Account):
+        directories.discard(instance.id)
+
+twistable_post_save.connect(account_saved)
+
 class Twistorage(FileSystemStorage):
     """
     The Twistorage gives you a way to make upload/download of files
@@ -114,35 +188,58 @@ class Twistorage(FileSystemStorage):
         Try to read name from the repository.
         Mode is 'w' if write access is required, 'r' if only read access is necessary
         """
+        # Fetch account directory, join with self.location.
+        # This avoids having files in the 'root' section of TN.
+        # Note that we de-reference TWISTRANET_MEDIA_ROOT before, so that we always work with absolute paths.
+        path = safe_join(self.location, name)
+        relpath = path[len(self.location) + 1:]
+        account_str, fname = relpath.split(os.path.sep, 1)
+        if not self.is_allowed(account_str, mode):
+            raise SuspiciousOperation("Attempted access to '%s' denied." % name)
+            
+        # Things are ok and check now. Return the actual path.
+        return os.path.normpath(path)
+
+    def is_allowed(self, account_str, mode = 'r'):
+        """
+        Return True if the authenticated account can access the account_str directory with the given mode.
+        Decisions are memoized for the duration of the request, so that exists() + open() on the same
+        file don't check permissions twice.
+        """
+        from twistranet.twistapp.models import Account
+        auth = Account.objects._getAuthenticatedAccount()
+        cache = account_context.get_request_cache("twistorage")
+        key = (auth.id, account_str, mode == 'r', )
+        if cache is not None and key in cache:
+            return cache[key]
+        ret = self._is_allowed(auth, account_str, mode)
+        if cache is not None:
+            cache[key] = ret
+        return ret
+
+    def _is_allowed(self, auth, account_str, mode):
+        """
+        Actually compute is_allowed(), with a single (secured) account lookup.
+        """
         from twistranet.twistapp.models import Account, SystemAccount
         try:
-            # Fetch account id, join with self.location.
-            # This avoids having files in the 'root' section of TN.
-            # Note that we de-reference TWISTRANET_MEDIA_ROOT before, so that we always work with absolute paths.
-            path = safe_join(self.location, name)
-            relpath = path[len(self.location) + 1:]
-            account_str, fname = relpath.split(os.path.sep, 1)
-            
             # Fetch the account, check rights
-            try:
-                account_id = int(account_str)
+            account_id = directories.get(account_str)
+            if account_id is not None:
                 account = Account.objects.get(id = account_id)
-            except Account.DoesNotExist:
-                account = Account.objects.get(slug = account_str)
+            else:
+                try:
+                    account = Account.objects.get(id = int(account_str))
+                except (ValueError, Account.DoesNotExist, ):
+                    account = Account.objects.get(slug = account_str)
+                directories.set(account_str, account.id)
             if mode == 'r':
-                if not account.can_list:
-                    raise SuspiciousOperation("Attempted access to '%s' denied." % name)
-            elif not account.can_edit:
-                raise SuspiciousOperation("Attempted access to '%s' denied." % name)
-            
+                return account.can_list
+            return account.can_edit
+
         except Account.DoesNotExist:
             # We're very sweet with admin accounts ;)
-            auth = Account.objects._getAuthenticatedAccount()
-            if not isinstance(auth, SystemAccount):
-                raise SuspiciousOperation("Attempted access to '%s' denied." % name)
-            
-        # Things are ok and check now. Return the actual path.
-        return os.path.normpath(path)
+            return isinstance(auth, SystemAccount)
 
     def size(self, name):
         return os.path.getsize(self.path(name, 'r'))
@@ -8,7 +8,7 @@ from django.conf import settings
 urlpatterns = patterns('',
     url(
         r'^(?P<path>.*)$', 
-        'django.views.static.serve',    
+        'twistranet.twistorage.delivery.serve',
         {'document_root': "%s" % settings.TWISTRANET_STATIC_PATH },
         name = "static",
     ),
@@ -2,7 +2,7 @@
 These view handle file downlaod for TN files.
 """
 from django.http import HttpResponse, HttpResponseRedirect
-from django.views.static import serve
+from twistorage.delivery import serve
 from django.http import Http404
 from twistorage.storage import Twistorage
 
@@ -15,6 +15,6 @@ def download(request, path):
     if not storage.exists(path):
         raise Http404
     
-    # Return the underlying file
-    return serve(request, path, document_root = storage.location, show_indexes = True)
+    # Stream the underlying file
+    return serve(request, path, document_root = storage.location)
 